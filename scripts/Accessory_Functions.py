@@ -1,5 +1,9 @@
 from snakemake import shell
+import os
 import sys
+import json
+import shlex
+import shutil
 import subprocess
 import re
 
@@ -61,6 +65,27 @@ def get_adapter_size(name):
     return(adapter_size)
 
 
+# ----------------------------------------------------------------------------- # counts the reads per cell barcode
+# command of count_cell_barcodes.py with the cell barcode position of the
+# sample; the input and output files are appended by the rules
+def count_cell_barcodes_command(python, script, name, threads):
+    cb_adapter = adapter_params(name, 'cell_barcode')
+    command = ' '.join([
+        python, os.path.join(script, 'count_cell_barcodes.py'),
+        '--start',   str(cb_adapter['start']),
+        '--length',  str(cb_adapter['length']),
+        '--threads', str(threads)
+    ])
+    return(command)
+
+
+# ----------------------------------------------------------------------------- # length of the barcode reads (R1): the end of the cell or umi barcode
+def get_barcode_read_length(name):
+    method = SAMPLE_SHEET.fetch_field(name,'method')[0]
+    adapter_params = ADAPTER_PARAMETERS[method]
+    return(max([adapter_params['cell_barcode']['base_max'], adapter_params['umi_barcode']['base_max']]))
+
+
 # ---------------------------------------------------------------------------- #
 # given a app name calls the help and parses the parameters
 def get_app_params(app_name):
@@ -84,18 +109,73 @@ def get_star_params():
 
 
 # ---------------------------------------------------------------------------- #
-# WRITE TESTS FOR THIS FUNCTION!!!
+# the parsed parameters of the tools are kept in memory, and in a cache file in
+# the output directory - keyed by the resolved path and the modification time
+# of the executable, so that the help of a tool is parsed once per tool version
+TOOL_PARAMS_MEMO = {}
+
+def get_tool_params_cache_path():
+    return(os.path.join(config['locations']['output-dir'], '.cache', 'tool_params.json'))
+
+# returns the cache key of a tool, or None if the executable is not found
+def get_tool_params_key(app_name):
+    executable = shutil.which(shlex.split(SOFTWARE[app_name]['executable'])[0])
+    if executable is None:
+        return(None)
+    executable = os.path.realpath(executable)
+    return(' '.join([app_name, executable, str(os.stat(executable).st_mtime_ns), SOFTWARE[app_name]['help']]))
+
+def read_tool_params_cache():
+    try:
+        with open(get_tool_params_cache_path()) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return({})
+    return(cache if isinstance(cache, dict) else {})
+
+# jobs can write the cache at the same time - every job replaces the file
+# atomically, an entry which is lost is parsed again by the next job
+def write_tool_params_cache(key, params):
+    path  = get_tool_params_cache_path()
+    cache = read_tool_params_cache()
+    cache[key] = params
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        path_tmp = path + '.' + str(os.getpid()) + '.tmp'
+        with open(path_tmp, 'w') as f:
+            json.dump(cache, f)
+        os.replace(path_tmp, path)
+    except OSError as error:
+        print('Could not write the tool parameter cache: ' + str(error), file=sys.stderr)
+
+# returns the parameters of a tool: from memory, from the cache file, or
+# parsed from the help of the tool
+def fetch_tool_params(app_name):
+    key = get_tool_params_key(app_name)
+    if key is None:
+        key = app_name
+    if key in TOOL_PARAMS_MEMO:
+        return(TOOL_PARAMS_MEMO[key])
+
+    params = read_tool_params_cache().get(key) if key != app_name else None
+    if params is None:
+        params = get_star_params() if app_name == 'STAR' else get_app_params(app_name)
+        if key != app_name:
+            write_tool_params_cache(key, params)
+
+    TOOL_PARAMS_MEMO[key] = params
+    return(params)
+
+
+# ---------------------------------------------------------------------------- #
 def join_params(app, app_params, params_set):
     app_name    = os.path.basename(app)
-    if app == 'STAR':
-        params_all = get_star_params()
-    else:
-        params_all  = get_app_params(app_name)
-    
+
     # checks whether any parameters are defined
     if params_set == None:
         params = ""
     else:
+        params_all  = fetch_tool_params(app_name)
         names       = set(params_all.keys())
         params_diff = set(params_set) - names
         if len(params_diff) > 0:
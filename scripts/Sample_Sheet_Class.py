@@ -5,7 +5,10 @@ import sys
 import pandas as pd
 import re
 import magic as mg
-import gzip
+import concurrent.futures
+import threading
+import json
+import stat
 
 # ---------------------------------------------------------------------------- #
 ## Experiment Class
@@ -18,9 +21,16 @@ class experiment:
         # contains merged technical replicates
         self.merged_replicates = {}
 
+        # merged technical replicates indexed by sample name: sample_name -> {column : value}
+        self.sample_records = {}
+        self.merged_columns = set()
+
         # sample sheet with sample descriptors
         self.SAMPLE_SHEET = []
 
+        # per thread libmagic instances for the validation of the input files
+        self.magic_instances = threading.local()
+
     # ------------------------------------------------------------------------ #
     def init_SAMPLE_SHEET(self, PATH_SAMPLE_SHEET):
         """Load the SAMPLE_SHEET as csv and set the *SAMPLE_SHEET* attribute"""
@@ -55,14 +65,15 @@ class experiment:
         # Check if any of the input files are generated by unsupported single-cell rna-seq methods
         methods = set(self.config['adapter_parameters'].keys())
         message = ''
+        # methods of the technical replicates of each sample
+        sample_methods = sample_sheet.groupby('sample_name')['method'].apply(set).to_dict()
         for sample_name in sample_sheet['sample_name']:
 
             # check whether sample names contains strings R1/R2 - these strings should not be in the sample names
             if re.search('(R1)|(R2)', sample_name) is not None:
                 message = message + 'Sample: ', + str(sample_name), 'contains R1 or R2. Please remove those strings.\n'
 
-            sample = sample_sheet[sample_sheet.sample_name == sample_name]
-            method = set(sample['method'])
+            method = sample_methods[sample_name]
             # checks whether all technical replicates have the same protocol
             if len(method) > 1:
                 message = message + 'Technical replicates have differing protocols: ' + str(sample_name) + '\n'
@@ -82,49 +93,32 @@ class experiment:
 
         # ----------------------------------------------------------------- #
         # Checks basic properties of input files
-        for index, row in sample_sheet.iterrows():
-            filenames = [row.barcode,row.reads]
-
-            for file_index in range(len(filenames)):
-                filename = filenames[file_index]
-                fullpath = os.path.join(self.config['locations']['reads-dir'], filename)
-                # --------------------------------------------------------- #
-                # Check that reads files exist
-                if not os.path.isfile(fullpath):
-                    raise Exception('ERROR: missing reads file: {}'.format(fullpath))
-
-                # --------------------------------------------------------- #
-                # Check that the files are gzipped
-                file_type = mg.from_file(os.path.realpath(fullpath), mime=True)
-                if not file_type.find('gzip') > 0:
-                    message = message + 'Input file should be gzipped: ' + fullpath + '\n'
-
-                # --------------------------------------------------------- #
-                # Check that the barcode files have the desired length
-                # really ugly code
-                else:
-                    # check whether barcode file
-                    if file_index == 0:
-                        adapter = self.config['adapter_parameters'][row.method]
-                        adapter_length = max([adapter['cell_barcode']['base_max'], adapter['umi_barcode']['base_max']])
-
-
-                        # loops over 10000 lines and checks whether the adapter length is ok; otherwise STAR will fail with hard to fish out error
-                        line_ind = 0
-                        with gzip.open(fullpath,'rt') as f:
-
-                            for line in f:
-                                line_ind = line_ind + 1
-                                # check whether the line corresponds to sequence or quality
-                                if (line_ind % 4 == 2 ) or (line_ind % 4 == 0):
-
-                                    # adapter_length + 1 because of newline
-                                    if not len(line) == (adapter_length + 1):
-                                        message = message + 'Input barcode file does not have the appropriate adapter length: ' + str(adapter_length) + ' : ' + fullpath + '\n'
-                                        break
-                                if line_ind > 10000:
-                                    break
-
+        # the files are checked concurrently - the checks mostly wait for
+        # the file system, which is slow on network storage
+        # the lengths of the barcode reads are checked by the
+        # validate_barcode_reads rule, which reads the whole files
+        input_files = []
+        for barcode, reads in zip(sample_sheet.barcode, sample_sheet.reads):
+            input_files.append(os.path.join(self.config['locations']['reads-dir'], barcode))
+            input_files.append(os.path.join(self.config['locations']['reads-dir'], reads))
+
+        # a missing file stops the validation before any file is read
+        for fullpath in input_files:
+            if not os.path.isfile(fullpath):
+                raise Exception('ERROR: missing reads file: {}'.format(fullpath))
+
+        # files which did not change since the last validation are not read again
+        cache = self.read_validation_cache()
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.get_validation_threads()) as executor:
+            results = list(executor.map(lambda fullpath: self.validate_input_file(fullpath, cache = cache), input_files))
+
+        # errors are reported in the order of the sample sheet
+        for fullpath, (exists, file_message, entry) in zip(input_files, results):
+            if not exists:
+                raise Exception('ERROR: missing reads file: {}'.format(fullpath))
+            message = message + file_message
+            cache[fullpath] = entry
+        self.write_validation_cache(cache)
 
         # ----------------------------------------------------------------- #
         # checks whether some of the samples contain errors
@@ -134,6 +128,87 @@ class experiment:
 
 
 
+    # ------------------------------------------------------------------------ #
+    # settings of the validation of the input files (execution: validation)
+    def get_validation_settings(self):
+        return(self.config.get('execution', {}).get('validation') or {})
+
+    # number of threads which check the input files
+    def get_validation_threads(self):
+        threads = self.get_validation_settings().get('threads', 8)
+        return(max(1, int(threads)))
+
+    # ------------------------------------------------------------------------ #
+    # the results of the file checks are cached in the output directory,
+    # keyed by the path and the size, modification time and inode of the file
+    def get_validation_cache_path(self):
+        return(os.path.join(self.config['locations']['output-dir'], '.cache', 'validation.json'))
+
+    # returns the cached results - empty if the cache is missing or unreadable,
+    # or if the validation is forced (execution: validation: force)
+    def read_validation_cache(self):
+        if self.get_validation_settings().get('force', False):
+            return({})
+        try:
+            with open(self.get_validation_cache_path()) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return({})
+        if not isinstance(cache, dict):
+            return({})
+        return(cache)
+
+    # the cache is replaced atomically - it is not written if the output
+    # directory can not be written
+    def write_validation_cache(self, cache):
+        path = self.get_validation_cache_path()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(cache, f)
+            os.replace(path + '.tmp', path)
+        except OSError as error:
+            print('Could not write the validation cache: ' + str(error))
+
+    # ------------------------------------------------------------------------ #
+    # libmagic instance of the current thread - the module level instance of
+    # the magic module serializes all calls with a lock
+    def get_magic(self):
+        if not hasattr(self.magic_instances, 'magic'):
+            self.magic_instances.magic = mg.Magic(mime=True)
+        return(self.magic_instances.magic)
+
+    # ------------------------------------------------------------------------ #
+    # checks one input file
+    # cache maps the paths to the results of previous checks
+    # returns whether the file exists, the error message for the file and
+    # the cache entry of the file
+    def validate_input_file(self, fullpath, cache = None):
+        message = ''
+
+        # --------------------------------------------------------- #
+        # Check that reads files exist
+        try:
+            file_stat = os.stat(fullpath)
+        except OSError:
+            return(False, message, None)
+        if not stat.S_ISREG(file_stat.st_mode):
+            return(False, message, None)
+
+        # the file is not read if it did not change since the last check
+        key   = {'size' : file_stat.st_size, 'mtime' : file_stat.st_mtime_ns, 'inode' : file_stat.st_ino}
+        entry = (cache or {}).get(fullpath)
+        if isinstance(entry, dict) and entry.get('key') == key:
+            return(True, entry['message'], entry)
+
+        # --------------------------------------------------------- #
+        # Check that the files are gzipped
+        file_type = self.get_magic().from_file(os.path.realpath(fullpath))
+        if not file_type.find('gzip') > 0:
+            message = message + 'Input file should be gzipped: ' + fullpath + '\n'
+
+        return(True, message, {'key' : key, 'message' : message})
+
     # ----------------------------------------------------------------------- #
     # pivots the sample_sheet by sample_name to get unique technical replicates
     def merge_technical_replicates(self):
@@ -159,6 +234,16 @@ class experiment:
         sample_sheet['mapped_reads'] = sample_sheet['sample_name'] + '.bam'
 
         self.merged_replicates = sample_sheet
+        self.index_merged_replicates()
+
+    # ----------------------------------------------------------------------- #
+    # indexes the merged technical replicates by sample name, so that the
+    # accessors do not filter the whole sheet on every call - the snakefile
+    # calls them for every sample, genome and rule
+    def index_merged_replicates(self):
+        sheet = self.merged_replicates
+        self.sample_records = sheet.to_dict('index')
+        self.merged_columns = set(sheet.columns)
 
     # ----------------------------------------------------------------------- #
     def add_reads_path(self):
@@ -185,22 +270,13 @@ class experiment:
         return(list(sheet['sample_name']))
 
     def fetch_field(self, sample_name, column):
-        sheet = self.merged_replicates
-
-        if not column in set(list(sheet.columns)):
+        if not column in self.merged_columns:
             sys.exit('unindentified column selected: ' + str(column) + '\n')
 
-        field = sheet[sheet['sample_name'] == sample_name][column]
-
-        if field.__class__ == set:
-            field = list(field[0])
-
-        elif isinstance(field, pd.Series):
-            field = list(field)[0]
-
-        else:
-            field = str(field[0])
+        if not sample_name in self.sample_records:
+            sys.exit('unindentified sample selected: ' + str(sample_name) + '\n')
 
+        field = self.sample_records[sample_name][column]
         return(field)
 
     def fetch_reads(self, sample_name):
@@ -0,0 +1,200 @@
+import os
+import sys
+import h5py
+import loompy
+import numpy
+import pandas
+
+# loom_IO is in the same directory as this script
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import loom_IO
+
+# ------------------------------------------------------------------ #
+# Random access to the cells of the combined loom files
+#
+# The cell index is a tab separated file which maps every cell_id to the
+# loom file which contains it, its column in that file and its sample:
+#   cell_id  sample  file  column
+# It is written by combine_loom_matrices.py next to the combined loom file,
+# and can be read for several genomes at once.
+#
+# iter_cells and iter_genes stream a layer of a loom file in blocks of
+# cells or genes, restricted to the cells of some samples or to cells
+# whose column attributes (covariates) match the given filters - only one
+# block is in memory at any moment.
+# ------------------------------------------------------------------ #
+INDEX_COLUMNS = ['cell_id', 'sample', 'file', 'column']
+
+# ------------------------------------------------------------------ #
+# {genome}_UMI.loom -> {genome}_UMI.cell_index.tsv
+def get_index_path(loom_file):
+    return(os.path.splitext(loom_file)[0] + '.cell_index.tsv')
+
+# ------------------------------------------------------------------ #
+# returns the cell index of a loom file as a data frame
+def build_cell_index(loom_file, sample_attr = 'sample_name'):
+    with loompy.connect(loom_file, 'r') as ds:
+        cell_ids = ds.ca['cell_id']
+        samples  = ds.ca[sample_attr] if sample_attr in ds.ca else numpy.repeat('', len(cell_ids))
+    index = pandas.DataFrame({
+        'cell_id' : cell_ids,
+        'sample'  : samples,
+        'file'    : os.path.basename(loom_file),
+        'column'  : numpy.arange(len(cell_ids), dtype = numpy.int64)
+    }, columns = INDEX_COLUMNS)
+    return(index)
+
+# ------------------------------------------------------------------ #
+def write_cell_index(loom_file, index_file = None):
+    if index_file is None:
+        index_file = get_index_path(loom_file)
+    index = build_cell_index(loom_file)
+    if index['cell_id'].duplicated().any():
+        print('Warning: duplicated cell ids in', loom_file)
+    index.to_csv(index_file, sep = '\t', index = False)
+    return(index_file)
+
+# ------------------------------------------------------------------ #
+class CellIndex:
+    """
+    Cell index of one or more combined loom files.
+
+    The file column is resolved relative to the directory of the index file.
+
+    Usage:
+        index = CellIndex('Mapped/hg38_UMI.cell_index.tsv')
+        index.lookup(['WT_1_AAACCTGAGAAGGCCT'])
+        for cell_ids, block in index.iter_cells(samples = ['WT_1']):
+            ...
+    """
+    def __init__(self, index_files):
+        if isinstance(index_files, str):
+            index_files = [index_files]
+        tables = []
+        for index_file in index_files:
+            table = pandas.read_csv(index_file, sep = '\t', dtype = {'cell_id' : str, 'sample' : str, 'file' : str})
+            table['sample'] = table['sample'].fillna('')
+            table['file']   = [os.path.join(os.path.dirname(os.path.abspath(index_file)), path) for path in table['file']]
+            tables.append(table)
+        self.table = pandas.concat(tables, ignore_index = True).set_index('cell_id', drop = False)
+
+    def __len__(self):
+        return(self.table.shape[0])
+
+    @property
+    def samples(self):
+        return(list(pandas.unique(self.table['sample'])))
+
+    @property
+    def files(self):
+        return(list(pandas.unique(self.table['file'])))
+
+    def lookup(self, cell_ids):
+        """Returns the index rows of the cells - KeyError for unknown cells"""
+        missing = [cell_id for cell_id in cell_ids if not cell_id in self.table.index]
+        if missing:
+            raise KeyError('Unknown cells: ' + ', '.join(missing[:5]))
+        return(self.table.loc[list(cell_ids)])
+
+    def select(self, samples = None):
+        """Returns the index rows of the cells of the samples"""
+        if samples is None:
+            return(self.table)
+        return(self.table[self.table['sample'].isin(samples)])
+
+    def iter_cells(self, cell_ids = None, samples = None, filters = None, block_size = 512, layer = ''):
+        """
+        Iterates over the given cells (or all cells) of the samples, file by
+        file and in the order of the columns of each file - see the module
+        level function iter_cells for the blocks which are yielded
+        """
+        rows = self.table if cell_ids is None else self.lookup(cell_ids)
+        if samples is not None:
+            rows = rows[rows['sample'].isin(samples)]
+        for loom_file, group in rows.groupby('file', sort = False):
+            yield from iter_cells(loom_file, block_size, layer, filters = filters, columns = group['column'].values)
+
+# ------------------------------------------------------------------ #
+# returns the (sorted) columns of the cells which match the filters
+# samples : list of samples (sample_name column attribute)
+# filters : column attribute -> value, list of values, or a function
+#           which returns a boolean mask for the attribute values
+# columns : optional columns to choose from, e.g. from the cell index
+def select_columns(ds, samples = None, filters = None, columns = None):
+    keep = numpy.ones(ds.shape[1], dtype = bool)
+    if columns is not None:
+        keep[:] = False
+        keep[numpy.asarray(columns, dtype = numpy.int64)] = True
+
+    filters = dict(filters or {})
+    if samples is not None:
+        filters['sample_name'] = samples
+    for name, condition in filters.items():
+        if not name in ds.ca:
+            raise KeyError('Unknown column attribute: ' + name)
+        values = ds.ca[name]
+        if callable(condition):
+            keep = keep & numpy.asarray(condition(values), dtype = bool)
+        elif isinstance(condition, (list, tuple, set, numpy.ndarray)):
+            keep = keep & numpy.isin(values, list(condition))
+        else:
+            keep = keep & (values == condition)
+    return(numpy.flatnonzero(keep))
+
+# ------------------------------------------------------------------ #
+# reads the (sorted) columns of a dataset; dense columns are read as one
+# contiguous range and subset, h5py point selection is slow
+def read_columns(dataset, columns):
+    if len(columns) == 0:
+        return(dataset[:, 0:0])
+    first = columns[0]
+    last  = columns[-1] + 1
+    if last - first <= 4 * len(columns):
+        return(dataset[:, first:last][:, columns - first])
+    return(dataset[:, columns.tolist()])
+
+# ------------------------------------------------------------------ #
+# streams the cells of a loom file in blocks of block_size cells
+# yields the cell ids and the dense genes x cells block of the layer
+def iter_cells(loom_file, block_size = 512, layer = '', samples = None, filters = None, columns = None):
+    with loompy.connect(loom_file, 'r') as ds:
+        columns  = select_columns(ds, samples, filters, columns)
+        cell_ids = ds.ca['cell_id']
+    with h5py.File(loom_file, 'r') as f:
+        dataset = f[loom_IO.get_layer_path(layer)]
+        for start in range(0, len(columns), block_size):
+            block = columns[start:start + block_size]
+            yield(cell_ids[block], read_columns(dataset, block))
+
+# ------------------------------------------------------------------ #
+# streams the genes of a loom file in blocks of block_size genes
+# yields the gene ids and the dense genes x cells block of the layer,
+# restricted to the selected cells
+def iter_genes(loom_file, block_size = 512, layer = '', samples = None, filters = None, columns = None):
+    with loompy.connect(loom_file, 'r') as ds:
+        columns  = select_columns(ds, samples, filters, columns)
+        gene_ids = ds.ra['gene_id']
+        subset   = len(columns) != ds.shape[1]
+    with h5py.File(loom_file, 'r') as f:
+        dataset = f[loom_IO.get_layer_path(layer)]
+        for start in range(0, dataset.shape[0], block_size):
+            rows  = slice(start, min(start + block_size, dataset.shape[0]))
+            block = dataset[rows, :]
+            if subset:
+                block = block[:, columns]
+            yield(gene_ids[rows], block)
+
+# ------------------------------------------------------------------ #
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Write the cell index of a combined loom file')
+    parser.add_argument('--loom_file',   action="store", dest="loom_file")
+    # default: the loom file name, with .cell_index.tsv instead of .loom
+    parser.add_argument('--output_file', action="store", dest="output_file")
+
+    args = parser.parse_args()
+
+    # -------------------------------------------------------------- #
+    print('Cell index:', write_cell_index(args.loom_file, args.output_file))
@@ -1,10 +1,21 @@
 import os
 import loompy
 import sys
+import time
+import json
+import shutil
+import hashlib
 import numpy
 import pandas
 import argparse
 
+# loom_IO is in the same directory as this script
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import loom_IO
+import h5ad_IO
+import cell_index
+import scipy.sparse
+
 # ------------------------------------------------------------------ #
 # get list of files from a txt file that contains space separated list of file paths
 def get_filepaths (file):
@@ -14,6 +25,223 @@ def get_filepaths (file):
             filepaths.extend(line.split())
     return(filepaths)
 
+# ------------------------------------------------------------------ #
+# returns the common gene order of the loom files, or None if the files
+# do not record the same gene order
+def get_gene_order(input_files):
+    gene_orders = set()
+    for input_file in input_files:
+        with loompy.connect(input_file, 'r') as ds:
+            gene_orders.add(ds.attrs['gene_order'] if 'gene_order' in ds.attrs else None)
+    if len(gene_orders) != 1:
+        return(None)
+    return(gene_orders.pop())
+
+# ------------------------------------------------------------------ #
+# returns the smallest min_umi of the loom files - the minimal number of UMIs
+# of the cells in the combined file; 0 if a file was not filtered
+def get_min_umi(input_files):
+    min_umi = []
+    for input_file in input_files:
+        with loompy.connect(input_file, 'r') as ds:
+            min_umi.append(int(ds.attrs['min_umi']) if 'min_umi' in ds.attrs else 0)
+    return(min(min_umi))
+
+# ------------------------------------------------------------------ #
+# returns the row ordering which puts the genes of the loom file in the
+# order of gene_ids; both are compared as compact attributes (byte strings)
+def get_row_ordering(ds, gene_ids, key = 'gene_id'):
+    gene_ids = loom_IO.get_compact_attribute(gene_ids)
+    position = {gene_id : index for index, gene_id in enumerate(loom_IO.get_compact_attribute(ds.ra[key]))}
+    if len(position) != len(gene_ids) or not all([gene_id in position for gene_id in gene_ids]):
+        sys.exit('Input files contain different genes: ' + ds.filename)
+    return(numpy.array([position[gene_id] for gene_id in gene_ids], dtype = numpy.int32))
+
+# ------------------------------------------------------------------ #
+# md5 checksum of a file
+def get_checksum(path, block_size = 16 * 1024 * 1024):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return(md5.hexdigest())
+
+# ------------------------------------------------------------------ #
+# streams the main matrix and all layers of the input files into the
+# LoomWriter out, batch_size columns at a time - the memory usage is bounded
+# by genes x batch_size, independent of the number of samples
+# row_attrs are the row attributes of the output, taken from the first
+# input file if not given
+# dtypes are the dtypes of the output layers - the layers of the input files
+# may use different (compact) dtypes
+# h5ad is an optional H5adWriter, which receives the same cells as sparse
+# blocks; out can be None to write only the h5ad file
+# returns the row attributes and the column attributes of the input files
+def append_loom_files(out, input_files, gene_order, dtypes, batch_size = 512, key = 'gene_id', row_attrs = None, h5ad = None):
+    col_attrs = {}
+    for input_file in input_files:
+        time_start = time.time()
+        nbytes     = 0
+        with loompy.connect(input_file, 'r') as ds:
+            if row_attrs is None:
+                row_attrs = {name : loom_IO.get_compact_attribute(ds.ra[name]) for name in ds.ra.keys()}
+
+            ordering = None
+            if gene_order is None:
+                ordering = get_row_ordering(ds, row_attrs[key], key)
+
+            for start in range(0, ds.shape[1], batch_size):
+                end    = min(start + batch_size, ds.shape[1])
+                layers = {name : ds.layers[name][:, start:end].astype(dtypes[name], copy = False) for name in ds.layers.keys()}
+                if ordering is not None:
+                    layers = {name : layer[ordering, :] for name, layer in layers.items()}
+
+                if out is not None:
+                    out.add_columns(layers)
+                if h5ad is not None:
+                    h5ad.add_cells({name : scipy.sparse.csr_matrix(layer.T) for name, layer in layers.items()})
+                nbytes = nbytes + sum([layer.nbytes for layer in layers.values()])
+
+            for name in ds.ca.keys():
+                col_attrs.setdefault(name, []).append(ds.ca[name])
+            ncells = ds.shape[1]
+
+        time_elapsed = max(time.time() - time_start, 1e-6)
+        print('{}: {} cells, {:.1f} MB in {:.2f} s ({:.1f} MB/s)'.format(
+            input_file, ncells, nbytes / 1e6, time_elapsed, nbytes / 1e6 / time_elapsed))
+
+    # keeps the column attributes which are present in all input files
+    col_attrs = {name : [loom_IO.get_compact_attribute(value) for value in values]
+        for name, values in col_attrs.items() if len(values) == len(input_files)}
+    return(row_attrs, col_attrs)
+
+# ------------------------------------------------------------------ #
+# combines the input files into a new output file
+# sources maps the input files to their checksums, and is stored in the output
+# output_h5ad is an optional sparse h5ad copy of the output file
+def combine_loom_files(input_files, output_file, batch_size = 512, key = 'gene_id', sources = None, storage = None, output_h5ad = None):
+
+    # files with the canonical gene order are appended column-wise,
+    # otherwise the rows are matched by gene_id
+    gene_order = get_gene_order(input_files)
+    file_attrs = {'min_umi' : get_min_umi(input_files)}
+    if gene_order is None:
+        print('Input files differ in gene order: matching rows by', key)
+    else:
+        file_attrs['gene_order'] = gene_order
+
+    if sources is not None:
+        file_attrs['sources'] = json.dumps(sources, sort_keys = True)
+
+    h5ad = None
+    if output_h5ad is not None:
+        h5ad = h5ad_IO.H5adWriter(output_h5ad)
+
+    with loom_IO.LoomWriter(output_file, storage = storage, file_attrs = file_attrs) as out:
+        row_attrs, col_attrs = append_loom_files(out, input_files, gene_order, loom_IO.get_layer_dtypes(input_files), batch_size, key, h5ad = h5ad)
+        out.row_attrs = row_attrs
+        out.col_attrs = {name : numpy.concatenate(values) for name, values in col_attrs.items()}
+
+    if h5ad is not None:
+        h5ad.var = row_attrs
+        h5ad.obs = {name : numpy.concatenate(values) for name, values in col_attrs.items()}
+        h5ad.close()
+
+# ------------------------------------------------------------------ #
+# writes a sparse h5ad copy of a loom file, batch_size cells at a time
+def write_h5ad(loom_file, output_h5ad, batch_size = 512):
+    with h5ad_IO.H5adWriter(output_h5ad) as h5ad:
+        row_attrs, col_attrs = append_loom_files(None, [loom_file], get_gene_order([loom_file]), loom_IO.get_layer_dtypes([loom_file]), batch_size, h5ad = h5ad)
+        h5ad.var = row_attrs
+        h5ad.obs = {name : numpy.concatenate(values) for name, values in col_attrs.items()}
+
+# ------------------------------------------------------------------ #
+# returns the input files which are missing from the combined store file,
+# or None if the store can not be extended (it does not exist, it contains
+# files which changed or were removed, or the gene order differs)
+def get_new_input_files(store_file, sources, gene_order):
+    if not os.path.isfile(store_file) or gene_order is None:
+        return(None)
+
+    with loompy.connect(store_file, 'r') as ds:
+        if not 'sources' in ds.attrs or not 'gene_order' in ds.attrs:
+            return(None)
+        stored_sources    = ds.attrs['sources']
+        stored_gene_order = ds.attrs['gene_order']
+
+    # the sources attribute is empty while the store is being extended
+    if stored_gene_order != gene_order or len(stored_sources) == 0:
+        return(None)
+    stored_sources = json.loads(stored_sources)
+
+    for input_file, checksum in stored_sources.items():
+        if sources.get(input_file) != checksum:
+            print('Input file changed or was removed:', input_file)
+            return(None)
+
+    return([input_file for input_file in sources.keys() if not input_file in stored_sources])
+
+# ------------------------------------------------------------------ #
+# incremental mode: the combined matrix is kept in store_file, which is not
+# removed by snakemake. Input files which are already in the store are
+# skipped, new files are appended. The store is rebuilt when one of the
+# stored files changed. The output file is a hard link to the store, so the
+# store is never changed in place - the new store is written to a temporary
+# file, which replaces it, and the previous output files keep their content
+def combine_loom_files_incremental(input_files, output_file, store_file, batch_size = 512, key = 'gene_id', storage = None, output_h5ad = None):
+    sources    = {input_file : get_checksum(input_file) for input_file in input_files}
+    gene_order = get_gene_order(input_files)
+    new_files  = get_new_input_files(store_file, sources, gene_order)
+
+    # the layers of the store can not be widened in place
+    if new_files is not None:
+        dtypes = loom_IO.get_layer_dtypes([store_file])
+        for name, dtype in loom_IO.get_layer_dtypes(new_files).items():
+            if not name in dtypes or not numpy.can_cast(dtype, dtypes[name]):
+                print('New input files need a wider dtype for layer', repr(name))
+                new_files = None
+                break
+
+    store_temp = store_file + '.tmp'
+    if new_files is None:
+        print('Rebuilding the combined file:', store_file)
+        combine_loom_files(input_files, store_temp, batch_size, key, sources = sources, storage = storage, output_h5ad = output_h5ad)
+        os.replace(store_temp, store_file)
+
+    else:
+        print('Appending', len(new_files), 'new files to:', store_file)
+        shutil.copyfile(store_file, store_temp)
+        with loompy.connect(store_temp, 'r+') as ds:
+            row_attrs      = {name : loom_IO.get_compact_attribute(ds.ra[name]) for name in ds.ra.keys()}
+            existing_attrs = {name : loom_IO.get_compact_attribute(ds.ca[name]) for name in ds.ca.keys()}
+            # marks the store as incomplete until all files are appended
+            ds.attrs['sources'] = ''
+
+        # the appended columns keep the storage options of the store;
+        # column attributes which are missing from the new files are removed
+        with loom_IO.LoomWriter(store_temp, append = True) as out:
+            row_attrs, col_attrs = append_loom_files(out, new_files, gene_order, dtypes, batch_size, key, row_attrs)
+            out.col_attrs = {name : numpy.concatenate([existing_attrs[name]] + values)
+                for name, values in col_attrs.items() if name in existing_attrs}
+
+        with loompy.connect(store_temp, 'r+') as ds:
+            ds.attrs['min_umi'] = get_min_umi(input_files)
+            ds.attrs['sources'] = json.dumps(sources, sort_keys = True)
+        os.replace(store_temp, store_file)
+
+        # the h5ad file is not kept in the store - it is rewritten from the store
+        if output_h5ad is not None:
+            write_h5ad(store_file, output_h5ad, batch_size)
+
+    output_temp = output_file + '.tmp'
+    if os.path.lexists(output_temp):
+        os.remove(output_temp)
+    try:
+        os.link(store_file, output_temp)
+    except OSError:
+        shutil.copyfile(store_file, output_temp)
+    os.replace(output_temp, output_file)
+
 # ------------------------------------------------------------------ #
 # ------------------------------------------------------------------ #
 if __name__ == '__main__':
@@ -21,6 +249,17 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Convert STAR mtx to loom')
     parser.add_argument('--input_files',  action="store", dest="input_files", nargs='+')
     parser.add_argument('--output_file', action="store", dest="output_file")
+    # optional sparse h5ad copy (AnnData) of the combined file
+    parser.add_argument('--output_h5ad', action="store", dest="output_h5ad")
+    # cell index of the combined file: cell_id -> file, column, sample
+    parser.add_argument('--output_cell_index', action="store", dest="output_cell_index")
+    # number of cells which are read and written at once
+    parser.add_argument('--batch_size',  action="store", dest="batch_size", type=int, default=512)
+    # appends new input files to the combined file kept in incremental_store
+    parser.add_argument('--incremental', action="store_true", dest="incremental")
+    parser.add_argument('--incremental_store', action="store", dest="incremental_store")
+    # HDF5 chunking and compression of the count matrices
+    loom_IO.add_storage_arguments(parser)
 
     args = parser.parse_args()
 
@@ -28,5 +267,14 @@ if __name__ == '__main__':
     input_files     = args.input_files
     output_filepath = args.output_file
 
-
-    loompy.combine(input_files, output_filepath, key = 'gene_id')
+    time_start = time.time()
+    if args.incremental:
+        store_file = args.incremental_store
+        if store_file is None:
+            store_file = os.path.join(os.path.dirname(output_filepath), '.' + os.path.basename(output_filepath) + '.store')
+        combine_loom_files_incremental(input_files, output_filepath, store_file, batch_size = args.batch_size, storage = loom_IO.get_storage(args), output_h5ad = args.output_h5ad)
+    else:
+        combine_loom_files(input_files, output_filepath, batch_size = args.batch_size, storage = loom_IO.get_storage(args), output_h5ad = args.output_h5ad)
+    if args.output_cell_index is not None:
+        cell_index.write_cell_index(output_filepath, args.output_cell_index)
+    print('Combined {} files in {:.2f} s'.format(len(input_files), time.time() - time_start))
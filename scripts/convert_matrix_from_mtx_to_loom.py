@@ -1,137 +1,177 @@
 import sys
-import loompy
 import pandas as pd
-import re
 import numpy
 import os
-from scipy.io import mmread
+import scipy.sparse
 import argparse
+import time
+import concurrent.futures
+import multiprocessing
+
+# the helper modules are in the same directory as this script
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import loom_IO
+import h5ad_IO
+import zarr_IO
+import gene_index
+# implements custom mmread function - enables multi column mm files
+import matrix_market_IO
+
+# ------------------------------------------------------------------ #
+# returns the canonical gene order of the genome: the order of the gene index,
+# followed by the (sorted) genes which are in the matrix but not in the index
+def get_canonical_gene_ids(gene_ids, row_names):
+    extra = sorted(set(row_names) - set(gene_ids))
+    return(list(gene_ids) + extra)
 
 # ------------------------------------------------------------------ #
-#find the complete list of gene ids from the gtf file
-def get_gtf_gene_ids (gtf_file):
-    gene_ids = []
-    with open(gtf_file) as f:
-        i = 0
-        for line in f:
-            m = re.search('gene_id "(.+?)"', line)
-            if m != None:
-                gene_ids.append(m.group(1))
-    return(set(gene_ids))
+# int32 indices, unless the dimension does not fit
+def get_index_dtype(size):
+    return(numpy.int32 if size < numpy.iinfo(numpy.int32).max else numpy.int64)
 
 # ------------------------------------------------------------------ #
-#given a matrix, row_names, and col_names, find which row names don't exist in gene_ids
-#and fill the matrix with rows of zeros for each missing gene
+#given a sparse matrix, row_names, and col_names, places the rows of the matrix
+#in the canonical gene order; genes which don't exist in row_names become empty rows
+#the matrix is returned in the CSC format - the loom file is written in column blocks
 def fill_missing_genes_into_matrix(gene_ids, matrix, row_names, col_names):
-    missing = list(set(gene_ids) - set(row_names))
-    # append the matrix with rows of zeros
-    if(len(missing) > 0):
-        new_rows  = numpy.zeros((len(missing), len(col_names)), dtype = int)
-        matrix    = numpy.vstack((matrix, new_rows))
-        row_names = row_names.append(pd.Series(missing))
+    gene_ids = get_canonical_gene_ids(gene_ids, row_names)
+    position = {gene_id : index for index, gene_id in enumerate(gene_ids)}
+    row_map  = numpy.array([position[gene_id] for gene_id in row_names], dtype = get_index_dtype(len(gene_ids)))
+
+    matrix = scipy.sparse.coo_matrix(matrix)
+    matrix = scipy.sparse.coo_matrix((matrix.data, (row_map[matrix.row], matrix.col)),
+        shape = (len(gene_ids), len(col_names)), dtype = matrix.dtype)
+
+    row_names = pd.DataFrame({'gene_id' : gene_ids})
+    return(matrix.tocsc(), row_names)
+
+# ------------------------------------------------------------------ #
+# columns of the STARsolo matrix.mtx which contain the counts of each output value
+# Velocyto matrix.mtx contains spliced, unspliced and ambiguous counts in columns 2 - 4
+# all other output types contain only one value column
+STAR_OUTPUT_COLUMNS = {'Spliced' : 2, 'Unspliced' : 3, 'Ambiguous' : 4}
+
+def get_column_to_read(star_output_value):
+    return(STAR_OUTPUT_COLUMNS.get(star_output_value, 2))
+
+# ------------------------------------------------------------------ #
+# reads the sample annotation of the sample sheet - one row per sample
+def read_sample_sheet(sample_sheet_file):
+    sample_sheet = pd.read_csv(sample_sheet_file)
+    sample_sheet = sample_sheet.drop(columns=['reads','barcode'])
+    sample_sheet = sample_sheet.drop_duplicates()
+    return(sample_sheet)
+
+# ------------------------------------------------------------------ #
+# reads the barcodes of the sample and adds the sample sheet annotation
+def read_barcode_table(path_input, sample_id, sample_sheet):
+    path_barcode       = os.path.join(path_input,'barcodes.tsv')
+    barcode            = pd.read_csv(path_barcode, sep='\t', header=None)
+    barcode.columns    = ['cell_id']
+    barcode['sample_name'] = sample_id
+    barcode['index']   = range(barcode.shape[0])
+    barcode['cell_id'] = barcode['sample_name'] + '_' + barcode['cell_id']
+
+    barcode      = barcode.merge(sample_sheet, on='sample_name')
+    barcode      = barcode.sort_values(by='index')
+    barcode      = barcode.drop(columns=['index'])
+    return(barcode)
+
+# ------------------------------------------------------------------ #
+# reads the features and the matrix.mtx of one STARsolo output type, and
+# fills the matrices with zeros for missing genes
+# returns {star_output_value : (matrix, row_names)} and the elapsed time
+def read_star_output_type(path_input, star_output_values, gene_ids, cell_ids):
+    time_start = time.time()
+
+    path_genes    = os.path.join(path_input,'features.tsv')
+    genes         = pd.read_csv(path_genes, sep='\t', header=None)
+    genes.columns = ['gene_id','gene_id2']
+    genes         = genes.drop(columns = ['gene_id2'])
+
+    columns_to_read = [get_column_to_read(value) for value in star_output_values]
+    matrices = matrix_market_IO.mmread_pigx_multi(os.path.join(path_input, 'matrix.mtx'), columns = columns_to_read, downcast = True)
 
-    row_names = pd.DataFrame({'gene_id' : row_names})
-    return(matrix, row_names)
+    result = {}
+    for star_output_value, matrix in zip(star_output_values, matrices):
+        if matrix.shape[1] != len(cell_ids):
+            sys.exit('Matrix ' + path_input + ' has ' + str(matrix.shape[1]) + ' columns, expected ' + str(len(cell_ids)) + ' barcodes')
+        result[star_output_value] = fill_missing_genes_into_matrix(gene_ids, matrix, genes['gene_id'], cell_ids)
+    return(result, time.time() - time_start)
 
 # ------------------------------------------------------------------ #
+# returns the columns (cells) of the matrix with at least min_umi counts
+def get_cells_to_keep(matrix, min_umi):
+    umi = numpy.asarray(matrix.sum(axis = 0)).ravel()
+    return(numpy.flatnonzero(umi >= min_umi))
+
+# ------------------------------------------------------------------ #
+# strings are kept as fixed-width byte arrays
 def dict_to_array(d):
     for i in d.keys():
-        d[i] = numpy.asarray(d[i])
+        d[i] = loom_IO.get_compact_attribute(d[i])
     return(d)
+
 # ------------------------------------------------------------------ #
-# ------------------------------------------------------------------ #
-if __name__ == '__main__':
+# writes sparse CSC layers into a loom file, batch_size columns at a time
+# only one block of each layer is dense in memory at any moment
+# zarr_writer is an optional zarr_IO.ZarrSampleWriter which receives the same blocks
+def write_loom_in_column_blocks(output_file, matrix_list, row_attrs, col_attrs, file_attrs = None, batch_size = 512, storage = None, zarr_writer = None):
+    ncol    = matrix_list[''].shape[1]
+    writers = [loom_IO.LoomWriter(output_file, storage = storage, file_attrs = file_attrs)]
+    if zarr_writer is not None:
+        writers.append(zarr_writer)
 
-    parser = argparse.ArgumentParser(description='Convert STAR mtx to loom')
-    # sample name
-    parser.add_argument('--sample_id',         action="store", dest='sample_id')
-    # location of the star solo output
-    parser.add_argument('--input_dir',         action="store", dest="input_dir")
-    # location of the gtf file
-    parser.add_argument('--gtf_file',          action="store", dest="gtf_file")
-    # names of star solo output directories
-    parser.add_argument('--star_output_types_keys', action="store",
-    dest="star_output_types_keys", nargs='+')
-    # internal names for star solo output - exists because of velocity
-    parser.add_argument('--star_output_types_vals', action="store", dest="star_output_types_vals", nargs='+')
-    parser.add_argument('--output_file',       action="store", dest="output_file")
-    parser.add_argument('--sample_sheet_file', action="store", dest="sample_sheet_file")
-    parser.add_argument('--path_script', action="store", dest="PATH_SCRIPT")
+    for start in range(0, max(ncol, 1), batch_size):
+        end    = min(start + batch_size, ncol)
+        layers = {key : matrix[:, start:end].toarray() for key, matrix in matrix_list.items()}
+        for writer in writers:
+            writer.add_columns(layers)
 
-    args = parser.parse_args()
-    # -------------------------------------------------------------- #
-    sample_id              = args.sample_id
-    basepath               = args.input_dir
-    gtf_file               = args.gtf_file
+    for writer in writers:
+        writer.row_attrs = row_attrs
+        writer.col_attrs = col_attrs
+        writer.close()
+
+# ------------------------------------------------------------------ #
+# converts the STARsolo output of one sample (basepath) into a loom file
+# gene_ids and sample_sheet are shared by all samples of a genome;
+# args holds the options of the command line
+# output_h5ad - optional sparse h5ad copy of the loom file
+# output_zarr - optional zarr store of the genome, which receives a copy of the sample
+def convert_sample(sample_id, basepath, output_file, gene_ids, sample_sheet, args, output_h5ad = None, output_zarr = None):
     star_output_types_keys = args.star_output_types_keys
     star_output_types_vals = args.star_output_types_vals
-    output_file            = args.output_file
-    sample_sheet_file      = args.sample_sheet_file
 
     # -------------------------------------------------------------- #
-    # implements custom mmread function - enables multi column mm files
-    sys.path.append(args.PATH_SCRIPT)
-    import matrix_market_IO
-
-
-    # -------------------------------------------------------------- #
-    print("Parsing gene ids from gtf file",gtf_file)
-    gene_ids = get_gtf_gene_ids(gtf_file)
+    # the barcode table is read once - all STARsolo output types
+    # contain the same barcodes
+    time_start = time.time()
+    print(sample_id, ": Reading barcodes ...")
+    barcode = read_barcode_table(os.path.join(basepath, star_output_types_keys[0], 'raw'), sample_id, sample_sheet)
 
     # -------------------------------------------------------------- #
+    # each STARsolo output type is read once - all values (for example
+    # Spliced and Unspliced for Velocyto) are parsed in the same pass;
+    # the output types are read concurrently
+    print(sample_id, ": Reading input files ...")
     dge_dict = {}
-    print("Reading input files ...")
-    for index in range(len(star_output_types_keys)):
-
-        star_output_type  = star_output_types_keys[index]
-        star_output_value = star_output_types_vals[index]
-
-        # reads in multi column mtx for velocity
-        # column_to_read == 2 corresponds to spliced
-        # column_to_read == 3 corresponds to unspliced
-        column_to_read = 2
-        if(star_output_value == 'Unspliced'):
-            column_to_read = 3
-
-        print(star_output_value)
-        path_input    = os.path.join(basepath, star_output_type, 'raw')
-
-        print('Features ...')
-        path_genes    = os.path.join(path_input,'features.tsv')
-        genes         = pd.read_csv(path_genes, sep='\t', header=None)
-        genes.columns = ['gene_id','gene_id2']
-        genes         = genes.drop(columns = ['gene_id2'])
-
-        print('Barcode ...')
-        path_barcode       = os.path.join(path_input,'barcodes.tsv')
-        barcode            = pd.read_csv(path_barcode, sep='\t', header=None)
-        barcode.columns    = ['cell_id']
-        barcode['sample_name'] = sample_id
-        barcode['index']   = range(barcode.shape[0])
-        barcode['cell_id'] = barcode['sample_name'] + '_' + barcode['cell_id']
-
-        sample_sheet = pd.read_csv(sample_sheet_file)
-        sample_sheet = sample_sheet.drop(columns=['reads','barcode'])
-        sample_sheet = sample_sheet.drop_duplicates()
-        barcode      = barcode.merge(sample_sheet, on='sample_name')
-        barcode      = barcode.sort_values(by='index')
-        barcode      = barcode.drop(columns=['index'])
-
-
-        # -------------------------------------------------------------- #
-        # fills the GENE matrix with zeros for missing genes
-        print('Matrix ...')
-        matrix = matrix_market_IO.mmread_pigx(os.path.join(path_input, 'matrix.mtx'), column_to_read = column_to_read)
-        # row_names_gene needs to be a named pandas object
-        matrix_gene_umi, row_names_gene = fill_missing_genes_into_matrix(gene_ids, matrix.toarray(), genes['gene_id'], barcode['cell_id'])
-
-        dge_dict[star_output_value] = {'matrix' : matrix_gene_umi, 'barcode' : barcode, 'genes' : row_names_gene}
-
-    # ADD: test to check that the rownames and the column names correspond
-    # between diferent matrices
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, args.threads)) as executor:
+        futures = {}
+        for star_output_type in list(dict.fromkeys(star_output_types_keys)):
+            star_output_values = [star_output_types_vals[index] for index in range(len(star_output_types_keys)) if star_output_types_keys[index] == star_output_type]
+            path_input = os.path.join(basepath, star_output_type, 'raw')
+            futures[star_output_type] = executor.submit(read_star_output_type, path_input, star_output_values, gene_ids, barcode['cell_id'])
+
+        for star_output_type, future in futures.items():
+            matrices, time_elapsed = future.result()
+            print('{} : {} : {} read in {:.2f} s'.format(sample_id, star_output_type, " ".join(matrices.keys()), time_elapsed))
+            for star_output_value, (matrix_gene_umi, row_names_gene) in matrices.items():
+                dge_dict[star_output_value] = {'matrix' : matrix_gene_umi, 'barcode' : barcode, 'genes' : row_names_gene}
+    print('{} : Read all input files in {:.2f} s'.format(sample_id, time.time() - time_start))
 
     # -------------------------------------------------------------- #
-    print('Creating loompy file')
+    print(sample_id, ': Creating loompy file', output_file)
     # extracts the exon count matrix
     matrix_list = {'' : dge_dict[star_output_types_vals[0]]['matrix']}
 
@@ -143,7 +183,112 @@ if __name__ == '__main__':
     col_attrs = dge_dict[star_output_types_vals[0]]['barcode'].to_dict("list")
     col_attrs = dict_to_array(col_attrs)
 
+    # the cells are selected once on the Gene matrix, and removed from all layers
+    if args.min_umi > 0:
+        keep = get_cells_to_keep(matrix_list[''], args.min_umi)
+        print(sample_id, ': Keeping', len(keep), 'of', matrix_list[''].shape[1], 'cells with at least', args.min_umi, 'UMIs')
+        matrix_list = {key : matrix[:, keep] for key, matrix in matrix_list.items()}
+        col_attrs   = {key : value[keep] for key, value in col_attrs.items()}
+
     row_attrs = dge_dict[star_output_types_vals[0]]['genes'].to_dict("list")
     row_attrs = dict_to_array(row_attrs)
 
-    loompy.create(output_file, matrix_list, row_attrs, col_attrs)
+    # records the gene order - combine_loom_files appends files with
+    # the same gene order without reordering the rows
+    # min_umi tells the downstream steps that the empty cells were removed
+    file_attrs = {
+        'gene_order' : gene_index.get_gene_order_checksum(row_attrs['gene_id']),
+        'min_umi'    : args.min_umi
+    }
+
+    zarr_writer = None
+    if output_zarr is not None:
+        print(sample_id, ': Writing into zarr store', output_zarr)
+        zarr_writer = zarr_IO.ZarrSampleWriter(output_zarr, sample_id, storage = loom_IO.get_storage(args), file_attrs = file_attrs)
+
+    write_loom_in_column_blocks(output_file, matrix_list, row_attrs, col_attrs, file_attrs = file_attrs, batch_size = args.batch_size, storage = loom_IO.get_storage(args), zarr_writer = zarr_writer)
+
+    # the transposed CSC matrices are the CSR cells x genes matrices of h5ad
+    if output_h5ad is not None:
+        print(sample_id, ': Creating h5ad file', output_h5ad)
+        with h5ad_IO.H5adWriter(output_h5ad) as writer:
+            writer.add_cells({key : matrix.T for key, matrix in matrix_list.items()})
+            writer.obs = col_attrs
+            writer.var = row_attrs
+    return(time.time() - time_start)
+
+# ------------------------------------------------------------------ #
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Convert STAR mtx to loom')
+    # sample names - several samples of one genome are converted by one
+    # process, with a pool of workers
+    parser.add_argument('--sample_id',         action="store", dest='sample_id', nargs='+')
+    # locations of the star solo output, one per sample
+    parser.add_argument('--input_dir',         action="store", dest="input_dir", nargs='+')
+    # location of the gene index - ordered gene ids from the gtf file
+    parser.add_argument('--gene_index',        action="store", dest="gene_index")
+    # location of the gtf file - used to check whether the gene index is up to date
+    parser.add_argument('--gtf_file',          action="store", dest="gtf_file")
+    # names of star solo output directories
+    parser.add_argument('--star_output_types_keys', action="store",
+    dest="star_output_types_keys", nargs='+')
+    # internal names for star solo output - exists because of velocity
+    parser.add_argument('--star_output_types_vals', action="store", dest="star_output_types_vals", nargs='+')
+    # output loom files, one per sample
+    parser.add_argument('--output_file',       action="store", dest="output_file", nargs='+')
+    # optional sparse h5ad files (AnnData), one per sample
+    parser.add_argument('--output_h5ad',       action="store", dest="output_h5ad", nargs='+')
+    # optional zarr store of the genome - each sample is written into its own group
+    parser.add_argument('--output_zarr',       action="store", dest="output_zarr")
+    parser.add_argument('--sample_sheet_file', action="store", dest="sample_sheet_file")
+    # number of STARsolo output types which are read concurrently
+    parser.add_argument('--threads', action="store", dest="threads", type=int, default=1)
+    # number of samples which are converted concurrently
+    parser.add_argument('--workers', action="store", dest="workers", type=int, default=1)
+    # number of cells which are written to the loom file at once
+    parser.add_argument('--batch_size', action="store", dest="batch_size", type=int, default=512)
+    # cells with fewer UMIs in the Gene matrix are removed from all layers;
+    # 1 removes the empty barcodes, 0 keeps all barcodes
+    parser.add_argument('--min_umi', action="store", dest="min_umi", type=int, default=0)
+    # HDF5 chunking and compression of the count matrices
+    loom_IO.add_storage_arguments(parser)
+
+    args = parser.parse_args()
+    # -------------------------------------------------------------- #
+    sample_ids   = args.sample_id
+    input_dirs   = args.input_dir
+    output_files = args.output_file
+
+    output_h5ad  = args.output_h5ad
+    if output_h5ad is None:
+        output_h5ad = [None] * len(sample_ids)
+
+    if not len(sample_ids) == len(input_dirs) == len(output_files) == len(output_h5ad):
+        sys.exit('--sample_id, --input_dir, --output_file and --output_h5ad need the same number of values')
+
+    # -------------------------------------------------------------- #
+    time_start = time.time()
+    print("Loading gene ids from gene index", args.gene_index)
+    gene_ids = gene_index.load_gene_ids(args.gene_index, args.gtf_file)
+
+    print("Reading sample sheet", args.sample_sheet_file)
+    sample_sheet = read_sample_sheet(args.sample_sheet_file)
+
+    # -------------------------------------------------------------- #
+    if len(sample_ids) == 1:
+        convert_sample(sample_ids[0], input_dirs[0], output_files[0], gene_ids, sample_sheet, args, output_h5ad[0], args.output_zarr)
+
+    else:
+        # the workers are started with spawn - forked copies of a process
+        # which imported loompy (and its HDF5 and numba state) can deadlock
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers = max(1, args.workers), mp_context = context) as executor:
+            futures = {}
+            for sample_id, input_dir, output_file, h5ad_file in zip(sample_ids, input_dirs, output_files, output_h5ad):
+                futures[sample_id] = executor.submit(convert_sample, sample_id, input_dir, output_file, gene_ids, sample_sheet, args, h5ad_file, args.output_zarr)
+            for sample_id, future in futures.items():
+                print('{} : converted in {:.2f} s'.format(sample_id, future.result()))
+
+    print('Converted {} samples in {:.2f} s'.format(len(sample_ids), time.time() - time_start))
@@ -0,0 +1,111 @@
+import sys
+import time
+import numpy
+import argparse
+
+import count_cell_barcodes
+import find_absolute_read_cutoff
+
+# ------------------------------------------------------------------ #
+# Corrects the cell barcode histogram of a sample for sequencing errors:
+# the barcodes with the most reads (the possible cells) are the parents,
+# all barcodes which differ from a parent by one base are looked up at once
+# in the 2 bit encoded histogram, and a barcode is folded into the
+# neighbouring parent with the most reads if that parent has at least
+# ratio times more reads. The reads of the folded barcodes are added to
+# their parents, and the corrected histogram has the same format as the
+# input (barcode, number of reads; by decreasing number of reads).
+# ------------------------------------------------------------------ #
+
+# ------------------------------------------------------------------ #
+# returns the 2 bit encoded barcodes and their length
+def encode_barcode_strings(barcodes):
+    length = len(barcodes[0])
+    if length > 32:
+        sys.exit('The cell barcode is longer than 32 bases')
+    # one byte more than the barcode length: longer barcodes fill it, shorter
+    # ones are padded with zeros, which are invalid bases
+    data = numpy.asarray(barcodes, dtype = 'S' + str(length + 1)).view(numpy.uint8).reshape(len(barcodes), length + 1)
+    if data[:, length].any():
+        sys.exit('The cell barcodes have different lengths')
+
+    codes = count_cell_barcodes.ENCODING[data[:, :length]]
+    if (codes == count_cell_barcodes.INVALID).any():
+        sys.exit('The cell barcodes contain bases other than ACGT or have different lengths')
+    shifts = numpy.arange(2 * (length - 1), -1, -2, dtype = numpy.uint64)
+    return((codes.astype(numpy.uint64) << shifts).sum(axis = 1, dtype = numpy.uint64), length)
+
+# ------------------------------------------------------------------ #
+# returns all barcodes which differ by one base from the given barcodes -
+# one row of 3 * length neighbours per barcode
+def get_neighbours(codes, length):
+    shifts = numpy.arange(2 * (length - 1), -1, -2, dtype = numpy.uint64)
+    deltas = (numpy.arange(1, 4, dtype = numpy.uint64)[:, None] << shifts).ravel()
+    return(codes[:, None] ^ deltas)
+
+# ------------------------------------------------------------------ #
+# returns for every barcode the index of the barcode it is folded into
+# (itself, if it is not folded)
+def find_parents(codes, counts, length, max_parents, ratio):
+    parents      = find_absolute_read_cutoff.select_top_barcodes(counts, max_parents)
+    neighbours   = get_neighbours(codes[parents], length)
+
+    order        = numpy.argsort(codes)
+    sorted_codes = codes[order]
+    position     = numpy.minimum(numpy.searchsorted(sorted_codes, neighbours.ravel()), len(codes) - 1)
+    found        = sorted_codes[position] == neighbours.ravel()
+    child        = order[position[found]]
+    parent       = numpy.repeat(parents, neighbours.shape[1])[found]
+
+    # a barcode is folded only into a parent with ratio times more reads;
+    # barcodes with the same number of reads are never folded into each other
+    folded     = (counts[parent] >= ratio * counts[child]) & (counts[parent] > counts[child])
+    child      = child[folded]
+    parent     = parent[folded]
+
+    # a barcode with several parents is folded into the one with the most reads
+    first      = numpy.lexsort((parent, -counts[parent], child))
+    child      = child[first]
+    parent     = parent[first]
+    child, index = numpy.unique(child, return_index = True)
+
+    target        = numpy.arange(len(codes))
+    target[child] = parent[index]
+    # a parent which is folded passes its barcodes on
+    while True:
+        folded_target = target[target]
+        if numpy.array_equal(folded_target, target):
+            break
+        target = folded_target
+    return(target)
+
+# ------------------------------------------------------------------ #
+# returns the corrected barcodes and counts, by decreasing number of reads
+def correct_cell_barcodes(codes, counts, length, max_parents, ratio = 10):
+    target    = find_parents(codes, counts, length, max_parents, ratio)
+    corrected = numpy.bincount(target, weights = counts, minlength = len(codes)).astype(numpy.int64)
+    kept      = numpy.flatnonzero(target == numpy.arange(len(codes)))
+    kept      = kept[numpy.argsort(-corrected[kept], kind = 'stable')]
+    return(codes[kept], corrected[kept])
+
+# ------------------------------------------------------------------ #
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Correct the cell barcode histogram for sequencing errors')
+    parser.add_argument('--input_file',  action="store", dest="input_file")
+    parser.add_argument('--output_file', action="store", dest="output_file")
+    # number of barcodes with the most reads into which other barcodes are folded
+    parser.add_argument('--max_parents', action="store", dest="max_parents", type=int, default=50000)
+    # minimal ratio between the number of reads of a parent and a folded barcode
+    parser.add_argument('--ratio',       action="store", dest="ratio", type=float, default=10)
+
+    args = parser.parse_args()
+
+    # -------------------------------------------------------------- #
+    time_start       = time.time()
+    barcodes, counts = find_absolute_read_cutoff.read_histogram(args.input_file)
+    codes, length    = encode_barcode_strings(barcodes)
+    corrected_codes, corrected_counts = correct_cell_barcodes(codes, counts, length, args.max_parents, args.ratio)
+    count_cell_barcodes.write_histogram(args.output_file, corrected_codes, corrected_counts, length)
+    print('{} cell barcodes, {} after correction, {:.2f} s'.format(len(codes), len(corrected_codes), time.time() - time_start))
@@ -0,0 +1,172 @@
+import sys
+import gzip
+import time
+import numpy
+import pandas
+import argparse
+import multiprocessing
+import concurrent.futures
+
+# ------------------------------------------------------------------ #
+# Counts the reads per cell barcode in the barcode reads (R1) of a sample:
+# the fastq files are read in large blocks which end at a record boundary,
+# the cell barcode window is cut out of all sequence lines of a block at
+# once and 2 bit encoded into one integer per read, and the integers are
+# counted with numpy. The blocks are counted by worker processes and the
+# counts are merged in the main process.
+# Barcodes which contain a base other than ACGT are not counted - as with
+# the k-mer counting of jellyfish, which was used before.
+# The output is a two column (barcode, number of reads) tab separated
+# histogram, sorted by the decreasing number of reads.
+# ------------------------------------------------------------------ #
+BLOCK_SIZE = 64 * 1024 * 1024
+
+# the encoding of the bases: A, C, G, T - all other characters are invalid
+BASES      = numpy.frombuffer(b'ACGT', dtype = numpy.uint8)
+INVALID    = 4
+ENCODING   = numpy.full(256, INVALID, dtype = numpy.uint8)
+for code, base in enumerate(b'ACGT'):
+    ENCODING[base] = code
+    ENCODING[ord(chr(base).lower())] = code
+
+# the counts of the blocks are merged when they hold this many barcodes
+MERGE_SIZE = 10 ** 7
+
+# ------------------------------------------------------------------ #
+# opens a fastq file - gzip compressed if the name ends with .gz, a plain
+# file or named pipe otherwise
+def open_fastq(path):
+    if path.endswith('.gz'):
+        return(gzip.open(path, 'rb'))
+    return(open(path, 'rb'))
+
+# ------------------------------------------------------------------ #
+# yields blocks of complete fastq records
+def iter_record_blocks(handle, block_size = BLOCK_SIZE):
+    rest = b''
+    while True:
+        block = handle.read(block_size)
+        if not block:
+            break
+        block    = rest + block
+        newlines = numpy.flatnonzero(numpy.frombuffer(block, dtype = numpy.uint8) == 10)
+        nrecords = len(newlines) // 4
+        if nrecords == 0:
+            rest = block
+            continue
+        end  = int(newlines[nrecords * 4 - 1]) + 1
+        rest = block[end:]
+        yield(block[:end])
+
+    # the last line of a file does not need to end with a newline
+    if len(rest.strip()) > 0:
+        yield(rest if rest.endswith(b'\n') else rest + b'\n')
+
+# ------------------------------------------------------------------ #
+# returns the 2 bit encoded cell barcodes of a block of fastq records;
+# start is the 0 based position of the barcode in the read
+def encode_barcodes(block, start, length):
+    data     = numpy.frombuffer(block, dtype = numpy.uint8)
+    newlines = numpy.flatnonzero(data == 10)
+    # the sequence is the second line of a record
+    seq_start = newlines[0::4] + 1
+    seq_end   = newlines[1::4]
+    seq_start = seq_start[(seq_end - seq_start) >= start + length]
+
+    positions = seq_start[:, None] + start + numpy.arange(length)
+    codes     = ENCODING[data[positions]]
+    codes     = codes[(codes != INVALID).all(axis = 1)]
+
+    shifts = numpy.arange(2 * (length - 1), -1, -2, dtype = numpy.uint64)
+    return((codes.astype(numpy.uint64) << shifts).sum(axis = 1, dtype = numpy.uint64))
+
+# ------------------------------------------------------------------ #
+# counts the cell barcodes of a block
+def count_block(block, start, length):
+    return(numpy.unique(encode_barcodes(block, start, length), return_counts = True))
+
+# ------------------------------------------------------------------ #
+# merges lists of barcodes and counts into unique barcodes with summed counts
+def merge_counts(barcodes, counts):
+    barcodes = numpy.concatenate(barcodes)
+    counts   = numpy.concatenate(counts)
+    barcodes, inverse = numpy.unique(barcodes, return_inverse = True)
+    counts = numpy.bincount(inverse, weights = counts, minlength = len(barcodes)).astype(numpy.int64)
+    return(barcodes, counts)
+
+# ------------------------------------------------------------------ #
+# returns the cell barcodes as strings
+def decode_barcodes(barcodes, length):
+    shifts = numpy.arange(2 * (length - 1), -1, -2, dtype = numpy.uint64)
+    bases  = BASES[((barcodes[:, None] >> shifts) & numpy.uint64(3)).astype(numpy.uint8)]
+    return(numpy.ascontiguousarray(bases).view('S' + str(length)).ravel().astype(str))
+
+# ------------------------------------------------------------------ #
+# counts the reads per cell barcode in the fastq files; start is the 1 based
+# position of the barcode in the read, as in the adapter parameters
+def count_cell_barcodes(input_files, start, length, threads = 1, block_size = BLOCK_SIZE):
+    if length > 32:
+        sys.exit('The cell barcode is longer than 32 bases')
+
+    barcodes = [numpy.zeros(0, dtype = numpy.uint64)]
+    counts   = [numpy.zeros(0, dtype = numpy.int64)]
+
+    def add_counts(result):
+        barcodes.append(result[0])
+        counts.append(result[1])
+        if sum([len(x) for x in barcodes]) > MERGE_SIZE:
+            merged = merge_counts(barcodes, counts)
+            barcodes[:] = [merged[0]]
+            counts[:]   = [merged[1]]
+
+    def iter_blocks():
+        for path in input_files:
+            with open_fastq(path) as handle:
+                for block in iter_record_blocks(handle, block_size):
+                    yield(block)
+
+    if threads <= 1:
+        for block in iter_blocks():
+            add_counts(count_block(block, start - 1, length))
+    else:
+        # the number of blocks in flight is limited, to bound the memory; the
+        # workers are spawned, forking a process with running threads can deadlock
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers = threads, mp_context = context) as executor:
+            futures = []
+            for block in iter_blocks():
+                futures.append(executor.submit(count_block, block, start - 1, length))
+                if len(futures) >= 2 * threads:
+                    add_counts(futures.pop(0).result())
+            for future in futures:
+                add_counts(future.result())
+
+    barcodes, counts = merge_counts(barcodes, counts)
+    order = numpy.lexsort((barcodes, -counts))
+    return(barcodes[order], counts[order])
+
+# ------------------------------------------------------------------ #
+def write_histogram(path, barcodes, counts, length):
+    histogram = pandas.DataFrame({'barcode' : decode_barcodes(barcodes, length), 'count' : counts})
+    histogram.to_csv(path, sep = '\t', header = False, index = False)
+
+# ------------------------------------------------------------------ #
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Count the reads per cell barcode')
+    parser.add_argument('--input_files', action="store", dest="input_files", nargs='+')
+    parser.add_argument('--output_file', action="store", dest="output_file")
+    # 1 based position and length of the cell barcode in the barcode read
+    parser.add_argument('--start',       action="store", dest="start",  type=int)
+    parser.add_argument('--length',      action="store", dest="length", type=int)
+    # number of worker processes which count the blocks
+    parser.add_argument('--threads',     action="store", dest="threads", type=int, default=1)
+
+    args = parser.parse_args()
+
+    # -------------------------------------------------------------- #
+    time_start       = time.time()
+    barcodes, counts = count_cell_barcodes(args.input_files, args.start, args.length, args.threads)
+    write_histogram(args.output_file, barcodes, counts, args.length)
+    print('{} reads, {} cell barcodes, {:.2f} s'.format(int(counts.sum()), len(barcodes), time.time() - time_start))
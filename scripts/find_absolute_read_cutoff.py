@@ -0,0 +1,109 @@
+import sys
+import time
+import yaml
+import numpy
+import pandas
+import argparse
+
+# ------------------------------------------------------------------ #
+# Finds the number of cells of a sample from its cell barcode histogram:
+# the cell_maximal_number barcodes with the most reads are selected without
+# sorting the whole histogram, and the knee is the barcode at which the
+# cumulative fraction of their reads is furthest above the diagonal.
+# Writes the number of reads of the knee barcode (ReadCutoff.yaml) and the
+# barcodes up to the knee (ReadCutoff.txt), which are the STAR whitelist.
+# The plot of the cumulative curve is optional and made by a separate job,
+# which does not delay the mapping; it requires matplotlib.
+# ------------------------------------------------------------------ #
+
+# ------------------------------------------------------------------ #
+def read_histogram(path):
+    histogram = pandas.read_csv(path, sep = '\t', header = None, names = ['barcode', 'count'],
+        dtype = {'barcode' : str, 'count' : numpy.int64}, keep_default_na = False)
+    if len(histogram) == 0:
+        sys.exit('The cell barcode histogram is empty: ' + path)
+    return(histogram['barcode'].values, histogram['count'].values)
+
+# ------------------------------------------------------------------ #
+# returns the indices of the top barcodes, by decreasing number of reads;
+# barcodes with the same number of reads are kept in the histogram order
+def select_top_barcodes(counts, top):
+    top = min(top, len(counts))
+    if top < len(counts):
+        threshold = numpy.partition(counts, len(counts) - top)[len(counts) - top]
+        above     = numpy.flatnonzero(counts > threshold)
+        equal     = numpy.flatnonzero(counts == threshold)[:top - len(above)]
+        selected  = numpy.concatenate([above, equal])
+    else:
+        selected  = numpy.arange(len(counts))
+    return(selected[numpy.lexsort((selected, -counts[selected]))])
+
+# ------------------------------------------------------------------ #
+# returns the knee (the number of cells) of the sorted read counts, and the
+# cumulative fraction of the reads
+def find_knee(counts):
+    cumulative = numpy.cumsum(counts) / counts.sum()
+    fraction   = numpy.arange(1, len(counts) + 1) / len(counts)
+    knee       = int(numpy.argmax(cumulative - fraction)) + 1
+    return(knee, cumulative)
+
+# ------------------------------------------------------------------ #
+def plot_knee(path, cumulative, knee):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize = (4, 3), dpi = 100)
+    ax.plot(numpy.arange(1, len(cumulative) + 1), cumulative, color = 'steelblue', linewidth = 1.25)
+    ax.axvline(knee, color = 'red')
+    ax.set_title('Number of STAMPS: ' + str(knee), fontsize = 8)
+    ax.set_xlabel('Cell barcodes (descending number of reads)', fontsize = 7)
+    ax.set_ylabel('Cumulative fraction of reads', fontsize = 7)
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+
+# ------------------------------------------------------------------ #
+def find_absolute_read_cutoff(infile, outfile_yaml, outfile_tab, cutoff = 5000):
+    barcodes, counts = read_histogram(infile)
+    selected         = select_top_barcodes(counts, cutoff)
+    knee, cumulative = find_knee(counts[selected])
+    if knee == len(selected):
+        print('knee cell selection did not succeed: including all cells')
+
+    with open(outfile_yaml, 'w') as f:
+        yaml.dump({'reads_cutoff' : int(counts[selected[knee - 1]])}, f, default_flow_style = False)
+
+    with open(outfile_tab, 'w') as f:
+        f.write(''.join([barcode + '\n' for barcode in barcodes[selected[:knee]]]))
+    return(knee)
+
+# ------------------------------------------------------------------ #
+def plot_read_cutoff(infile, outfile_plot, cutoff = 5000):
+    barcodes, counts = read_histogram(infile)
+    knee, cumulative = find_knee(counts[select_top_barcodes(counts, cutoff)])
+    plot_knee(outfile_plot, cumulative, knee)
+    return(knee)
+
+# ------------------------------------------------------------------ #
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Find the number of cells of a sample from the cell barcode histogram')
+    parser.add_argument('--input_file',   action="store", dest="input_file")
+    parser.add_argument('--outfile_yaml', action="store", dest="outfile_yaml")
+    parser.add_argument('--outfile_tab',  action="store", dest="outfile_tab")
+    # maximal number of cells which are considered
+    parser.add_argument('--cutoff',       action="store", dest="cutoff", type=int, default=5000)
+    # plots the cumulative curve instead of writing the cutoff
+    parser.add_argument('--outfile_plot', action="store", dest="outfile_plot", default=None)
+
+    args = parser.parse_args()
+
+    # -------------------------------------------------------------- #
+    time_start = time.time()
+    if args.outfile_plot is not None:
+        knee = plot_read_cutoff(args.input_file, args.outfile_plot, args.cutoff)
+    else:
+        knee = find_absolute_read_cutoff(args.input_file, args.outfile_yaml, args.outfile_tab, args.cutoff)
+    print('{} cells, {:.2f} s'.format(knee, time.time() - time_start))
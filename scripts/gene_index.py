@@ -0,0 +1,116 @@
+import os
+import re
+import sys
+import hashlib
+import argparse
+
+# ------------------------------------------------------------------ #
+# The gene index is a small tsv file with the ordered, unique list of
+# gene ids from a gtf file. It is built once per genome, so that the
+# per sample conversion jobs do not have to parse the gtf file.
+#
+# The header lines record the source gtf file:
+#   #gtf_file   path to the gtf file
+#   #gtf_md5    md5 checksum of the gtf file
+#   #gtf_size   size of the gtf file in bytes
+#   #gtf_mtime  modification time of the gtf file
+# ------------------------------------------------------------------ #
+GENE_ID_REGEX = re.compile(b'gene_id "(.+?)"')
+
+# ------------------------------------------------------------------ #
+# find the complete, ordered list of gene ids from the gtf file
+# returns the gene ids and the md5 checksum of the file
+def get_gtf_gene_ids(gtf_file):
+    gene_ids = {}
+    md5      = hashlib.md5()
+    with open(gtf_file, 'rb') as f:
+        for line in f:
+            md5.update(line)
+            if line.startswith(b'#'):
+                continue
+            m = GENE_ID_REGEX.search(line)
+            if m != None:
+                gene_ids[m.group(1).decode()] = None
+    return(list(gene_ids.keys()), md5.hexdigest())
+
+# ------------------------------------------------------------------ #
+def get_file_md5(path, block_size = 16 * 1024 * 1024):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return(md5.hexdigest())
+
+# ------------------------------------------------------------------ #
+def get_gtf_stat(gtf_file):
+    stat = os.stat(gtf_file)
+    return({'gtf_size' : str(stat.st_size), 'gtf_mtime' : str(int(stat.st_mtime))})
+
+# ------------------------------------------------------------------ #
+def write_gene_index(gtf_file, outfile):
+    gene_ids, checksum = get_gtf_gene_ids(gtf_file)
+
+    header = {'gtf_file' : os.path.abspath(gtf_file), 'gtf_md5' : checksum}
+    header.update(get_gtf_stat(gtf_file))
+
+    with open(outfile, 'w') as f:
+        for key, value in header.items():
+            f.write('#' + key + '\t' + value + '\n')
+        for gene_id in gene_ids:
+            f.write(gene_id + '\n')
+    return(gene_ids)
+
+# ------------------------------------------------------------------ #
+# returns the gene ids and the header of the index file
+def read_gene_index(infile):
+    header   = {}
+    gene_ids = []
+    with open(infile) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('#'):
+                key, value  = line[1:].split('\t', 1)
+                header[key] = value
+            elif line:
+                gene_ids.append(line)
+    return(gene_ids, header)
+
+# ------------------------------------------------------------------ #
+# loads the gene ids from the index; if the gtf file is given and its size
+# or modification time changed since the index was built (e.g. it was
+# copied), the checksum of the gtf file is compared - a gtf file with a
+# different content stops the conversion, the index has to be rebuilt
+def load_gene_ids(index_file, gtf_file = None):
+    gene_ids, header = read_gene_index(index_file)
+    if gtf_file is not None:
+        stat = get_gtf_stat(gtf_file)
+        if any([header.get(key) != value for key, value in stat.items()]):
+            if get_file_md5(gtf_file) != header.get('gtf_md5'):
+                sys.exit('Gene index ' + index_file + ' is out of date: ' + gtf_file +
+                    ' changed since the index was built - rerun make_gene_index')
+    return(gene_ids)
+
+# ------------------------------------------------------------------ #
+# checksum of an ordered list of gene ids - stored in the loom files as
+# the gene_order attribute, files with the same gene_order have identical rows;
+# the gene ids can be strings or (compact) byte strings
+def get_gene_order_checksum(gene_ids):
+    md5 = hashlib.md5()
+    for gene_id in gene_ids:
+        md5.update((gene_id if isinstance(gene_id, bytes) else str(gene_id).encode()) + b'\n')
+    return(md5.hexdigest())
+
+# ------------------------------------------------------------------ #
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Build the gene id index of a gtf file')
+    parser.add_argument('--gtf_file',    action="store", dest="gtf_file")
+    parser.add_argument('--output_file', action="store", dest="output_file")
+
+    args = parser.parse_args()
+
+    # -------------------------------------------------------------- #
+    print("Parsing gene ids from gtf file", args.gtf_file)
+    gene_ids = write_gene_index(args.gtf_file, args.output_file)
+    print("Number of genes:", len(gene_ids))
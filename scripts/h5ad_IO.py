@@ -0,0 +1,109 @@
+import h5py
+import numpy
+import scipy.sparse
+
+import loom_IO
+
+# ------------------------------------------------------------------ #
+# AnnData h5ad files: a sparse cells x genes matrix X, sparse layers,
+# and the cell (obs) and gene (var) annotation as data frames
+# see https://anndata.readthedocs.io/en/latest/fileformat-prose.html
+# ------------------------------------------------------------------ #
+def set_encoding(node, encoding_type, encoding_version):
+    node.attrs['encoding-type']    = encoding_type
+    node.attrs['encoding-version'] = encoding_version
+
+# ------------------------------------------------------------------ #
+# writes an array column of a data frame - strings as variable-length strings
+def write_array(group, name, values):
+    values = loom_IO.get_compact_attribute(values)
+    if values.dtype.kind == 'S':
+        values = numpy.array([value.decode() for value in values], dtype = object)
+        group.create_dataset(name, data = values, dtype = h5py.string_dtype())
+        set_encoding(group[name], 'string-array', '0.2.0')
+    else:
+        if values.dtype.kind == 'b':
+            values = values.astype('uint8')
+        group.create_dataset(name, data = values)
+        set_encoding(group[name], 'array', '0.2.0')
+
+# ------------------------------------------------------------------ #
+# writes a data frame; index is the name of the column with the row names
+def write_dataframe(parent, name, columns, index):
+    group = parent.create_group(name)
+    set_encoding(group, 'dataframe', '0.2.0')
+    group.attrs['_index']       = index
+    group.attrs['column-order'] = numpy.array([key for key in columns.keys() if key != index], dtype = h5py.string_dtype())
+    for key, values in columns.items():
+        write_array(group, key, values)
+
+# ------------------------------------------------------------------ #
+class H5adWriter:
+    """
+    Writes a sparse h5ad file in blocks of cells.
+
+    The matrices are stored as CSR (cells x genes) and are never dense in
+    memory: each block is appended to the data, indices and indptr arrays.
+    The main matrix ('' in the layers) is stored as X, the other layers
+    under /layers.
+
+    Usage:
+        with H5adWriter(filename) as writer:
+            writer.add_cells({'' : csr_block, 'Spliced' : csr_block})
+            writer.obs = {'cell_id' : cell_ids}
+            writer.var = {'gene_id' : gene_ids}
+    """
+    def __init__(self, filename, compression = 'gzip'):
+        self.filename    = filename
+        self.compression = None if compression == 'none' else compression
+        self.obs         = {}
+        self.var         = {}
+        self.obs_index   = 'cell_id'
+        self.var_index   = 'gene_id'
+        self.file        = h5py.File(filename, 'w')
+        set_encoding(self.file, 'anndata', '0.1.0')
+        for name in ['layers', 'obsm', 'varm', 'obsp', 'varp', 'uns']:
+            set_encoding(self.file.create_group(name), 'dict', '0.1.0')
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def get_matrix_group(self, name, matrix):
+        path = 'X' if name == '' else 'layers/' + name
+        if not path in self.file:
+            group = self.file.create_group(path)
+            set_encoding(group, 'csr_matrix', '0.1.0')
+            group.attrs['shape'] = (0, matrix.shape[1])
+            for key, dtype in [('data', matrix.data.dtype), ('indices', matrix.indices.dtype)]:
+                group.create_dataset(key, shape = (0,), maxshape = (None,), dtype = dtype,
+                    chunks = (2**16,), compression = self.compression)
+            group.create_dataset('indptr', data = numpy.zeros(1, dtype = numpy.int64), maxshape = (None,), chunks = (2**14,))
+        return(self.file[path])
+
+    def add_cells(self, layers):
+        """Appends the sparse blocks (cells x genes) to the named layers"""
+        for name, matrix in layers.items():
+            matrix = scipy.sparse.csr_matrix(matrix)
+            group  = self.get_matrix_group(name, matrix)
+            nnz    = group['data'].shape[0]
+            ncells = group.attrs['shape'][0]
+            for key, values in [('data', matrix.data), ('indices', matrix.indices)]:
+                group[key].resize((nnz + matrix.nnz,))
+                group[key][nnz:] = values
+            group['indptr'].resize((ncells + matrix.shape[0] + 1,))
+            group['indptr'][ncells + 1:] = matrix.indptr[1:].astype(numpy.int64) + nnz
+            group.attrs['shape'] = (ncells + matrix.shape[0], matrix.shape[1])
+
+    def close(self):
+        """Writes the cell and gene annotation and closes the file"""
+        if self.file is None:
+            return
+        if not 'X' in self.file:
+            self.add_cells({'' : scipy.sparse.csr_matrix((0, len(self.var[self.var_index])))})
+        write_dataframe(self.file, 'obs', self.obs, self.obs_index)
+        write_dataframe(self.file, 'var', self.var, self.var_index)
+        self.file.close()
+        self.file = None
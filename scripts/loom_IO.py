@@ -0,0 +1,162 @@
+import h5py
+import loompy
+import numpy
+
+# ------------------------------------------------------------------ #
+# HDF5 storage of the main matrix and the layers of the loom files
+#   chunks            : chunk shape (genes, cells)
+#   compression       : gzip, lzf or none
+#   compression_level : gzip level, 0 - 9
+#   shuffle           : byte shuffle filter before compression
+# the defaults correspond to the storage used by loompy
+STORAGE_DEFAULTS = {
+    'chunks'            : [64, 64],
+    'compression'       : 'gzip',
+    'compression_level' : 2,
+    'shuffle'           : False
+}
+
+COMPRESSION_VALUES = ['gzip', 'lzf', 'none']
+
+# ------------------------------------------------------------------ #
+# adds the storage options to an argparse parser
+def add_storage_arguments(parser):
+    parser.add_argument('--chunks',            action="store", dest="chunks", type=int, nargs=2, default=STORAGE_DEFAULTS['chunks'])
+    parser.add_argument('--compression',       action="store", dest="compression", choices=COMPRESSION_VALUES, default=STORAGE_DEFAULTS['compression'])
+    parser.add_argument('--compression_level', action="store", dest="compression_level", type=int, default=STORAGE_DEFAULTS['compression_level'])
+    parser.add_argument('--shuffle',           action="store_true", dest="shuffle")
+
+def get_storage(args):
+    return({key : getattr(args, key) for key in STORAGE_DEFAULTS.keys()})
+
+# ------------------------------------------------------------------ #
+# translates the storage options into h5py create_dataset arguments
+def get_dataset_options(storage, nrows):
+    storage = dict(STORAGE_DEFAULTS, **storage)
+    if not storage['compression'] in COMPRESSION_VALUES:
+        raise ValueError('unknown compression ' + str(storage['compression']) + ', must be one of ' + ", ".join(COMPRESSION_VALUES))
+
+    # the chunks can not be larger than the number of genes
+    options = {
+        'chunks'  : (max(1, min(storage['chunks'][0], nrows)), max(1, storage['chunks'][1])),
+        'shuffle' : bool(storage['shuffle'])
+    }
+    if storage['compression'] == 'gzip':
+        options['compression']      = 'gzip'
+        options['compression_opts'] = int(storage['compression_level'])
+    elif storage['compression'] == 'lzf':
+        options['compression']      = 'lzf'
+    return(options)
+
+# ------------------------------------------------------------------ #
+# keeps string attributes in memory as fixed-width byte arrays instead of
+# unicode or object arrays - strings are ascii, with xml character
+# references for other characters (which loompy unescapes when reading)
+def get_compact_attribute(values):
+    values = numpy.asarray(values)
+    if values.dtype.kind == 'O' and all([isinstance(value, str) for value in values]):
+        values = values.astype('U')
+    if values.dtype.kind == 'U':
+        values = numpy.char.encode(values, 'ascii', 'xmlcharrefreplace')
+    return(values)
+
+# ------------------------------------------------------------------ #
+# writes an attribute into the row_attrs or col_attrs group, as loompy does:
+# the loom 3.0 specification requires variable-length strings on disk
+def write_attribute(group, name, values):
+    values = get_compact_attribute(values)
+    dtype  = values.dtype
+    if values.dtype.kind == 'S':
+        values = numpy.array([value.decode() for value in values], dtype = object)
+        dtype  = h5py.string_dtype()
+    elif values.dtype.kind == 'b':
+        values = values.astype('uint8')
+        dtype  = values.dtype
+    if name in group:
+        del group[name]
+    group.create_dataset(name, data = values, dtype = dtype, compression = 'gzip', compression_opts = 2)
+
+# ------------------------------------------------------------------ #
+# returns the dtype of each layer which holds the values of all input files
+def get_layer_dtypes(input_files):
+    dtypes = {}
+    for input_file in input_files:
+        with h5py.File(input_file, 'r') as f:
+            names = [''] + (list(f['/layers'].keys()) if '/layers' in f else [])
+            for name in names:
+                dtype = f[get_layer_path(name)].dtype
+                dtypes[name] = numpy.promote_types(dtypes.get(name, dtype), dtype)
+    return(dtypes)
+
+# ------------------------------------------------------------------ #
+def get_layer_path(name):
+    return('/matrix' if name == '' else '/layers/' + name)
+
+# ------------------------------------------------------------------ #
+class LoomWriter:
+    """
+    Writes the main matrix and the layers of a loom file in column blocks,
+    with configurable HDF5 chunking and compression.
+
+    The file skeleton is written by loompy, the count matrices and the
+    attributes are written directly with h5py - loompy always uses 64x64
+    chunks with gzip compression. With append = True, columns are added to the
+    matrices of an existing loom file, which keep their storage options.
+
+    Usage:
+        with LoomWriter(filename, storage) as writer:
+            writer.add_columns({'' : block, 'Spliced' : block})
+            writer.row_attrs = {'gene_id' : gene_ids}
+            writer.col_attrs = {'cell_id' : cell_ids}
+    """
+    def __init__(self, filename, storage = None, file_attrs = None, append = False):
+        self.filename  = filename
+        self.storage   = dict(STORAGE_DEFAULTS, **(storage or {}))
+        self.row_attrs = {}
+        self.col_attrs = {}
+        if not append:
+            loompy.new(filename, file_attrs = file_attrs).close()
+        self.file = h5py.File(filename, 'r+')
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    # number of columns in the main matrix
+    @property
+    def ncols(self):
+        if not '/matrix' in self.file:
+            return(0)
+        return(self.file['/matrix'].shape[1])
+
+    def add_columns(self, layers):
+        """Appends the dense blocks (genes x cells) to the named layers"""
+        for name, block in layers.items():
+            path = get_layer_path(name)
+            if not path in self.file:
+                self.file.create_dataset(path,
+                    shape    = (block.shape[0], 0),
+                    maxshape = (block.shape[0], None),
+                    dtype    = block.dtype,
+                    **get_dataset_options(self.storage, block.shape[0]))
+            dataset = self.file[path]
+            ncols   = dataset.shape[1]
+            dataset.resize(ncols + block.shape[1], axis = 1)
+            dataset[:, ncols:] = block
+
+    def close(self):
+        """Writes the row and column attributes and closes the file"""
+        if self.file is None:
+            return
+        for key, value in self.row_attrs.items():
+            write_attribute(self.file['/row_attrs'], key, value)
+        for key, value in self.col_attrs.items():
+            write_attribute(self.file['/col_attrs'], key, value)
+        # removes column attributes which do not cover the appended columns
+        for key in list(self.file['/col_attrs'].keys()):
+            if self.file['/col_attrs'][key].shape[0] != self.ncols:
+                del self.file['/col_attrs'][key]
+        self.file.close()
+        self.file = None
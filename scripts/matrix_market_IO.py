@@ -15,12 +15,12 @@ import os
 import sys
 
 from numpy import (asarray, real, imag, conj, zeros, ndarray, concatenate,
-                   ones, can_cast)
+                   ones, can_cast, fromstring, min_scalar_type)
 from numpy.compat import asbytes, asstr
 
 from scipy.sparse import coo_matrix, isspmatrix
 
-__all__ = ['mminfo', 'mmread', 'mmwrite', 'MMFile']
+__all__ = ['mminfo', 'mmread_pigx', 'mmread_pigx_multi', 'mmwrite', 'MMFile']
 
 
 # -----------------------------------------------------------------------------
@@ -54,7 +54,7 @@ def mminfo(source):
 # -----------------------------------------------------------------------------
 
 
-def mmread_pigx(source, column_to_read = 2):
+def mmread_pigx(source, column_to_read = 2, engine = 'numpy', downcast = False):
     """
     Reads the contents of a Matrix Market file-like 'source' into a matrix.
 
@@ -63,6 +63,14 @@ def mmread_pigx(source, column_to_read = 2):
     source : str or file-like
         Matrix Market filename (extensions .mtx, .mtz.gz)
         or open file-like object.
+    column_to_read : int, optional
+        Column of the coordinate file which contains the values.
+    engine : str, optional
+        Either 'numpy' (parses the body in large blocks with the numpy
+        tokenizer) or 'python' (parses the body line by line).
+    downcast : bool, optional
+        Stores non-negative integer values of a coordinate file with the
+        smallest unsigned integer type which holds the largest value.
 
     Returns
     -------
@@ -70,7 +78,37 @@ def mmread_pigx(source, column_to_read = 2):
         Dense or sparse matrix depending on the matrix format in the
         Matrix Market file.
     """
-    return MMFile().read(source, column_to_read = column_to_read)
+    return MMFile().read(source, column_to_read = column_to_read, engine = engine,
+                         downcast = downcast)
+
+# -----------------------------------------------------------------------------
+
+
+def mmread_pigx_multi(source, columns = [2], engine = 'numpy', downcast = False):
+    """
+    Reads several value columns of a coordinate Matrix Market file-like
+    'source' in one pass over the file.
+
+    Parameters
+    ----------
+    source : str or file-like
+        Matrix Market filename (extensions .mtx, .mtz.gz)
+        or open file-like object.
+    columns : list of int, optional
+        Columns of the coordinate file which contain the values.
+    engine : str, optional
+        Either 'numpy' or 'python', see mmread_pigx.
+    downcast : bool, optional
+        Downcasts the integer values of each column, see mmread_pigx.
+
+    Returns
+    -------
+    a : list of coo_matrix
+        One sparse matrix per column; all matrices share the row and
+        column index arrays.
+    """
+    return MMFile().read(source, column_to_read = list(columns), engine = engine,
+                         downcast = downcast)
 
 # -----------------------------------------------------------------------------
 
@@ -177,6 +215,28 @@ class MMFile:
             raise ValueError('unknown symmetry type %s, must be one of %s' %
                              (symmetry, self.SYMMETRY_VALUES))
 
+    # parsing engines for the coordinate format
+    ENGINE_NUMPY = 'numpy'
+    ENGINE_PYTHON = 'python'
+    ENGINE_VALUES = (ENGINE_NUMPY, ENGINE_PYTHON)
+
+    @staticmethod
+    def _downcast_values(V):
+        # smallest unsigned integer type which holds the largest value;
+        # negative values keep the original type
+        if len(V) == 0 or V.min() < 0:
+            return V
+        return V.astype(min_scalar_type(V.max()), copy=False)
+
+    @classmethod
+    def _validate_engine(self, engine):
+        if engine not in self.ENGINE_VALUES:
+            raise ValueError('unknown engine type %s, must be one of %s' %
+                             (engine, self.ENGINE_VALUES))
+
+    # number of bytes which the numpy engine reads from the stream at once
+    BLOCK_SIZE = 16 * 1024 * 1024
+
     DTYPES_BY_FIELD = {FIELD_INTEGER: 'intp',
                        FIELD_UNSIGNED: 'uint64',
                        FIELD_REAL: 'd',
@@ -402,7 +462,7 @@ class MMFile:
         self._init_attrs(**kwargs)
 
     # -------------------------------------------------------------------------
-    def read(self, source, column_to_read):
+    def read(self, source, column_to_read, engine='numpy', downcast=False):
         """
         Reads the contents of a Matrix Market file-like 'source' into a matrix.
 
@@ -417,13 +477,19 @@ class MMFile:
         a : ndarray or coo_matrix
             Dense or sparse matrix depending on the matrix format in the
             Matrix Market file.
-        column_to_read : column to read from the mtx format
+        column_to_read : column to read from the mtx format; if a list of
+            columns is given, a list with one matrix per column is returned
+        engine : 'numpy' or 'python' - parser used for the coordinate format
+        downcast : stores non-negative integer values with the smallest
+            unsigned integer type
         """
+        self.__class__._validate_engine(engine)
         stream, close_it = self._open(source)
 
         try:
             self._parse_header(stream)
-            return self._parse_body(stream, column_to_read = column_to_read)
+            return self._parse_body(stream, column_to_read = column_to_read,
+                                    engine = engine, downcast = downcast)
 
         finally:
             if close_it:
@@ -491,7 +557,8 @@ class MMFile:
                          field=field, symmetry=symmetry)
 
     # -------------------------------------------------------------------------
-    def _parse_body(self, stream, column_to_read):
+    def _parse_body(self, stream, column_to_read, engine='numpy',
+                    downcast=False):
         rows, cols, entries, format, field, symm = (self.rows, self.cols,
                                                     self.entries, self.format,
                                                     self.field, self.symmetry)
@@ -595,46 +662,61 @@ class MMFile:
 
         elif format == self.FORMAT_COORDINATE:
             # Read sparse COOrdinate format
+            # one value array is filled per requested column
+            is_multi = isinstance(column_to_read, list)
+            columns = column_to_read if is_multi else [column_to_read]
+
             if entries == 0:
                 # empty matrix
-                return coo_matrix((rows, cols), dtype=dtype)
+                a = [coo_matrix((rows, cols), dtype=dtype) for column in columns]
+                return a if is_multi else a[0]
 
             I = zeros(entries, dtype='intc')
             J = zeros(entries, dtype='intc')
-            if is_pattern:
-                V = ones(entries, dtype='int8')
-            elif is_integer:
-                V = zeros(entries, dtype='intp')
-            elif is_unsigned_integer:
-                V = zeros(entries, dtype='uint64')
-            elif is_complex:
-                V = zeros(entries, dtype='complex')
+            Vs = []
+            for column in columns:
+                if is_pattern:
+                    V = ones(entries, dtype='int8')
+                elif is_integer:
+                    V = zeros(entries, dtype='intp')
+                elif is_unsigned_integer:
+                    V = zeros(entries, dtype='uint64')
+                elif is_complex:
+                    V = zeros(entries, dtype='complex')
+                else:
+                    V = zeros(entries, dtype='float')
+                Vs.append(V)
+
+            # complex values span two columns - only the line parser
+            # knows how to read them
+            if engine == self.ENGINE_NUMPY and not is_complex:
+                entry_number = self._parse_coordinate_blocks(
+                    stream, I, J, Vs, columns, is_pattern)
             else:
-                V = zeros(entries, dtype='float')
-
-            entry_number = 0
-            for line in stream:
-                # line.startswith('%')
-                if not line or line[0] in ['%', 37] or not line.strip():
-                    continue
-
-                if entry_number+1 > entries:
-                    raise ValueError("'entries' in header is smaller than "
-                                     "number of entries")
-                l = line.split()
-                I[entry_number], J[entry_number] = map(int, l[:2])
-
-                if not is_pattern:
-                    if is_integer:
-                        V[entry_number] = int(l[column_to_read])
-                    elif is_unsigned_integer:
-                        V[entry_number] = int(l[column_to_read])
-                    elif is_complex:
-                        V[entry_number] = complex(*map(float, l[column_to_read:]))
-                    else:
-                        V[entry_number] = float(l[column_to_read])
-
-                entry_number += 1
+                entry_number = 0
+                for line in stream:
+                    # line.startswith('%')
+                    if not line or line[0] in ['%', 37] or not line.strip():
+                        continue
+
+                    if entry_number+1 > entries:
+                        raise ValueError("'entries' in header is smaller than "
+                                         "number of entries")
+                    l = line.split()
+                    I[entry_number], J[entry_number] = map(int, l[:2])
+
+                    if not is_pattern:
+                        for V, column in zip(Vs, columns):
+                            if is_integer:
+                                V[entry_number] = int(l[column])
+                            elif is_unsigned_integer:
+                                V[entry_number] = int(l[column])
+                            elif is_complex:
+                                V[entry_number] = complex(*map(float, l[column:]))
+                            else:
+                                V[entry_number] = float(l[column])
+
+                    entry_number += 1
             if entry_number < entries:
                 raise ValueError("'entries' in header is larger than "
                                  "number of entries")
@@ -646,24 +728,89 @@ class MMFile:
                 mask = (I != J)       # off diagonal mask
                 od_I = I[mask]
                 od_J = J[mask]
-                od_V = V[mask]
+
+                for index in range(len(Vs)):
+                    od_V = Vs[index][mask]
+                    if is_skew:
+                        od_V *= -1
+                    elif is_herm:
+                        od_V = od_V.conjugate()
+
+                    Vs[index] = concatenate((Vs[index], od_V))
 
                 I = concatenate((I, od_J))
                 J = concatenate((J, od_I))
 
-                if is_skew:
-                    od_V *= -1
-                elif is_herm:
-                    od_V = od_V.conjugate()
-
-                V = concatenate((V, od_V))
+            if downcast and (is_integer or is_unsigned_integer):
+                Vs = [self._downcast_values(V) for V in Vs]
 
-            a = coo_matrix((V, (I, J)), shape=(rows, cols), dtype=dtype)
+            # the index arrays are shared between the matrices
+            a = [coo_matrix((V, (I, J)), shape=(rows, cols),
+                            dtype=V.dtype if downcast else dtype)
+                 for V in Vs]
+            if not is_multi:
+                a = a[0]
         else:
             raise NotImplementedError(format)
 
         return a
 
+    # -------------------------------------------------------------------------
+    def _parse_coordinate_blocks(self, stream, I, J, Vs, columns,
+                                 is_pattern):
+        """
+        Parses the body of a coordinate file into the preallocated I, J and
+        value arrays Vs - one array for each of the given columns.
+
+        The stream is read in blocks of BLOCK_SIZE bytes, which are cut at
+        the last complete line and tokenized with numpy. Returns the number
+        of parsed entries.
+        """
+        entries = len(I)
+        # reads the whole table with one dtype - indices are cast on store
+        dtype = 'float' if Vs[0].dtype.kind in 'fc' else 'int64'
+        ncol = None
+        entry_number = 0
+        tail = b''
+        eof = False
+        while not eof:
+            chunk = asbytes(stream.read(self.BLOCK_SIZE))
+            eof = not chunk
+            block = tail + chunk
+            if not eof:
+                cut = block.rfind(b'\n') + 1
+                block, tail = block[:cut], block[cut:]
+
+            # comment lines are not expected in the body, but are allowed
+            if b'%' in block:
+                block = b'\n'.join([line for line in block.split(b'\n')
+                                    if not line.lstrip().startswith(b'%')])
+            if not block.strip():
+                continue
+
+            if ncol is None:
+                ncol = len(block.strip().split(b'\n', 1)[0].split())
+
+            values = fromstring(block, dtype=dtype, sep=' ')
+            if values.size % ncol != 0:
+                raise ValueError("Parse error, lines have differing "
+                                 "number of columns")
+            table = values.reshape(-1, ncol)
+
+            nrows = table.shape[0]
+            if entry_number + nrows > entries:
+                raise ValueError("'entries' in header is smaller than "
+                                 "number of entries")
+            block_slice = slice(entry_number, entry_number + nrows)
+            I[block_slice] = table[:, 0]
+            J[block_slice] = table[:, 1]
+            if not is_pattern:
+                for V, column in zip(Vs, columns):
+                    V[block_slice] = table[:, column]
+            entry_number += nrows
+
+        return entry_number
+
     #  ------------------------------------------------------------------------
     def _write(self, stream, a, comment='', field=None, precision=None,
                symmetry=None):
@@ -0,0 +1,152 @@
+import sys
+import gzip
+import zlib
+import time
+import yaml
+import numpy
+import argparse
+import concurrent.futures
+
+# ------------------------------------------------------------------ #
+# Validates the barcode reads (R1) of a sample: every file is streamed
+# completely, in large blocks, and the lengths of all sequence and quality
+# lines are counted with numpy - reads whose sequence or quality does not
+# have the length of the barcode adapter are reported, as well as gzip
+# files which end before the end of the last gzip member (truncated) or
+# which end in the middle of a fastq record (incomplete).
+# ------------------------------------------------------------------ #
+BLOCK_SIZE = 64 * 1024 * 1024
+
+# ------------------------------------------------------------------ #
+# adds the counts of values to the histogram hist
+def add_counts(hist, values):
+    counts = numpy.bincount(values)
+    if len(counts) > len(hist):
+        hist = numpy.concatenate([hist, numpy.zeros(len(counts) - len(hist), dtype = hist.dtype)])
+    hist[:len(counts)] += counts
+    return(hist)
+
+# ------------------------------------------------------------------ #
+# yields the lengths of the lines of a binary file handle, without the
+# newlines; the last line of a file does not need to end with a newline
+def iter_line_lengths(handle, block_size = BLOCK_SIZE):
+    partial = 0
+    while True:
+        block = handle.read(block_size)
+        if not block:
+            break
+        newlines = numpy.flatnonzero(numpy.frombuffer(block, dtype = numpy.uint8) == 10)
+        if len(newlines) == 0:
+            partial = partial + len(block)
+            continue
+        lengths    = numpy.diff(newlines, prepend = -1) - 1
+        lengths[0] = lengths[0] + partial
+        partial    = int(len(block) - newlines[-1] - 1)
+        yield(lengths)
+    if partial > 0:
+        yield(numpy.array([partial], dtype = numpy.int64))
+
+# ------------------------------------------------------------------ #
+# returns the length profile of one fastq.gz file
+def profile_fastq(path, read_length, block_size = BLOCK_SIZE):
+    time_start      = time.time()
+    sequence_hist   = numpy.zeros(0, dtype = numpy.int64)
+    quality_hist    = numpy.zeros(0, dtype = numpy.int64)
+    leftover        = numpy.zeros(0, dtype = numpy.int64)
+    nreads          = 0
+    wrong           = 0
+    error           = ''
+
+    try:
+        with gzip.open(path, 'rb') as handle:
+            for lengths in iter_line_lengths(handle, block_size):
+                # the lines of incomplete records are kept for the next block
+                lengths  = numpy.concatenate([leftover, lengths])
+                nrecords = len(lengths) // 4
+                records  = lengths[:nrecords * 4].reshape(nrecords, 4)
+                leftover = lengths[nrecords * 4:]
+
+                sequence_hist = add_counts(sequence_hist, records[:, 1])
+                quality_hist  = add_counts(quality_hist,  records[:, 3])
+                nreads = nreads + nrecords
+                wrong  = wrong  + int(numpy.count_nonzero((records[:, 1] != read_length) | (records[:, 3] != read_length)))
+
+    # gzip raises EOFError for a member which ends before its end marker
+    except EOFError as e:
+        error = 'truncated gzip member: ' + str(e)
+    except (OSError, zlib.error) as e:
+        error = 'corrupted gzip file: ' + str(e)
+
+    profile = {
+        'file'              : path,
+        'reads'             : int(nreads),
+        'wrong_length'      : int(wrong),
+        'wrong_fraction'    : float(wrong / nreads) if nreads > 0 else 0.0,
+        'sequence_lengths'  : {int(length) : int(count) for length, count in enumerate(sequence_hist) if count > 0},
+        'quality_lengths'   : {int(length) : int(count) for length, count in enumerate(quality_hist) if count > 0},
+        'truncated'         : error.startswith('truncated'),
+        'incomplete_record' : bool(len(leftover) > 0),
+        'error'             : error,
+        'time'              : round(time.time() - time_start, 2)
+    }
+    return(profile)
+
+# ------------------------------------------------------------------ #
+# profiles the files of a sample and decides whether it passes
+def validate_barcode_reads(input_files, read_length, max_wrong_fraction = 0, threads = 1, block_size = BLOCK_SIZE):
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, threads)) as executor:
+        profiles = list(executor.map(lambda path: profile_fastq(path, read_length, block_size), input_files))
+
+    nreads = sum([profile['reads'] for profile in profiles])
+    wrong  = sum([profile['wrong_length'] for profile in profiles])
+    report = {
+        'read_length'        : int(read_length),
+        'max_wrong_fraction' : float(max_wrong_fraction),
+        'reads'              : nreads,
+        'wrong_length'       : wrong,
+        'wrong_fraction'     : float(wrong / nreads) if nreads > 0 else 0.0,
+        'files'              : profiles
+    }
+
+    messages = []
+    for profile in profiles:
+        if profile['error'] != '':
+            messages.append(profile['file'] + ': ' + profile['error'])
+        elif profile['incomplete_record']:
+            messages.append(profile['file'] + ': the file ends in the middle of a fastq record')
+        if profile['reads'] == 0 and profile['error'] == '':
+            messages.append(profile['file'] + ': the file contains no reads')
+    if report['wrong_fraction'] > max_wrong_fraction:
+        messages.append('{:.4%} of the reads do not have the barcode adapter length {} (allowed: {:.4%})'.format(
+            report['wrong_fraction'], read_length, max_wrong_fraction))
+
+    report['passed'] = len(messages) == 0
+    report['errors'] = messages
+    return(report)
+
+# ------------------------------------------------------------------ #
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Validate the lengths of the barcode reads of a sample')
+    parser.add_argument('--input_files',        action="store", dest="input_files", nargs='+')
+    parser.add_argument('--read_length',        action="store", dest="read_length", type=int)
+    parser.add_argument('--output_file',        action="store", dest="output_file")
+    # fraction of the reads which may have a different length
+    parser.add_argument('--max_wrong_fraction', action="store", dest="max_wrong_fraction", type=float, default=0)
+    # number of files which are read at once
+    parser.add_argument('--threads',            action="store", dest="threads", type=int, default=1)
+
+    args = parser.parse_args()
+
+    # -------------------------------------------------------------- #
+    report = validate_barcode_reads(args.input_files, args.read_length, args.max_wrong_fraction, args.threads)
+    for profile in report['files']:
+        print('{}: {} reads, {} with wrong length, {:.2f} s'.format(
+            profile['file'], profile['reads'], profile['wrong_length'], profile['time']))
+
+    with open(args.output_file, 'w') as f:
+        yaml.dump(report, f, default_flow_style = False, sort_keys = False)
+
+    if not report['passed']:
+        sys.exit('Barcode read validation failed:\n' + '\n'.join(report['errors']))
@@ -0,0 +1,222 @@
+import os
+import json
+import numpy
+
+import loom_IO
+
+# zarr is optional - it is only needed for the zarr output
+try:
+    import zarr
+    import numcodecs
+except ImportError:
+    zarr = None
+
+# ------------------------------------------------------------------ #
+# Zarr store with the count matrices of all samples of a genome
+#
+# Every sample is written by its own conversion job into its own group,
+# so that the samples can be written concurrently without locking:
+#   samples/<sample>/matrix          genes x cells, main matrix
+#   samples/<sample>/layers/<name>   genes x cells, other layers
+#   samples/<sample>/row_attrs/<name>
+#   samples/<sample>/col_attrs/<name>
+# The attributes of a sample group contain the gene order and the number
+# of cells; complete is set when the sample is fully written.
+#
+# Once all samples are written, write_manifest records the cell offset of
+# each sample in manifest.json - ZarrMatrix reads the samples as one
+# combined genes x cells matrix, without copying the data.
+# ------------------------------------------------------------------ #
+MANIFEST = 'manifest.json'
+
+def check_zarr():
+    if zarr is None:
+        raise ImportError('The zarr output requires the zarr python module')
+
+# ------------------------------------------------------------------ #
+# translates the loom storage options into zarr compressor and filters
+def get_array_options(storage, nrows, dtype):
+    storage = dict(loom_IO.STORAGE_DEFAULTS, **storage)
+    options = {
+        'chunks'     : (max(1, min(storage['chunks'][0], nrows)), max(1, storage['chunks'][1])),
+        'compressor' : None,
+        'filters'    : None
+    }
+    if storage['compression'] == 'gzip':
+        options['compressor'] = numcodecs.GZip(level = int(storage['compression_level']))
+    elif storage['compression'] == 'lzf':
+        # lzf is not available in numcodecs - lz4 is the closest fast codec
+        options['compressor'] = numcodecs.LZ4()
+    if storage['shuffle']:
+        options['filters'] = [numcodecs.Shuffle(elementsize = numpy.dtype(dtype).itemsize)]
+    return(options)
+
+# ------------------------------------------------------------------ #
+# opens the root and samples groups of the store, creating them if needed;
+# zarr checks whether a group exists and then creates it, so a concurrent
+# job can create the group in between - the existing group is opened then
+def open_samples_group(store):
+    try:
+        root = zarr.open_group(store, mode = 'a')
+    except zarr.errors.ContainsGroupError:
+        root = zarr.open_group(store, mode = 'r+')
+    try:
+        return(root.require_group('samples'))
+    except zarr.errors.ContainsGroupError:
+        return(root['samples'])
+
+# ------------------------------------------------------------------ #
+def get_layer_path(name):
+    return('matrix' if name == '' else 'layers/' + name)
+
+# ------------------------------------------------------------------ #
+def write_attributes(group, attrs):
+    for key, values in attrs.items():
+        values = loom_IO.get_compact_attribute(values)
+        if values.dtype.kind == 'S':
+            values = numpy.array([value.decode() for value in values], dtype = object)
+            group.array(key, values, dtype = str, overwrite = True)
+        else:
+            group.array(key, values, overwrite = True)
+
+# ------------------------------------------------------------------ #
+class ZarrSampleWriter:
+    """
+    Writes the matrices of one sample into its group of the zarr store,
+    in column blocks - the same interface as loom_IO.LoomWriter.
+
+    Usage:
+        with ZarrSampleWriter(store, sample_name, storage, file_attrs) as writer:
+            writer.add_columns({'' : block, 'Spliced' : block})
+            writer.row_attrs = {'gene_id' : gene_ids}
+            writer.col_attrs = {'cell_id' : cell_ids}
+    """
+    def __init__(self, store, sample_name, storage = None, file_attrs = None):
+        check_zarr()
+        self.storage   = dict(loom_IO.STORAGE_DEFAULTS, **(storage or {}))
+        self.row_attrs = {}
+        self.col_attrs = {}
+        # the root and samples groups are created by the first writer
+        samples    = open_samples_group(store)
+        if sample_name in samples:
+            del samples[sample_name]
+        self.group = samples.create_group(sample_name)
+        self.group.attrs.update(dict(file_attrs or {}, complete = False, ncells = 0))
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+
+    @property
+    def ncols(self):
+        if not 'matrix' in self.group:
+            return(0)
+        return(self.group['matrix'].shape[1])
+
+    def add_columns(self, layers):
+        """Appends the dense blocks (genes x cells) to the named layers"""
+        for name, block in layers.items():
+            path = get_layer_path(name)
+            if not path in self.group:
+                self.group.create(path, shape = (block.shape[0], 0), dtype = block.dtype,
+                    **get_array_options(self.storage, block.shape[0], block.dtype))
+            self.group[path].append(block, axis = 1)
+
+    def close(self):
+        """Writes the row and column attributes and marks the sample as complete"""
+        write_attributes(self.group.require_group('row_attrs'), self.row_attrs)
+        write_attributes(self.group.require_group('col_attrs'), self.col_attrs)
+        self.group.attrs.update({'complete' : True, 'ncells' : self.ncols})
+
+# ------------------------------------------------------------------ #
+# writes the cell offsets of the samples into the manifest of the store;
+# the samples are ordered as in sample_names (all samples in the store if None)
+def write_manifest(store, sample_names = None):
+    check_zarr()
+    samples = zarr.open_group(store, mode = 'r')['samples']
+    if sample_names is None:
+        sample_names = sorted(samples.group_keys())
+
+    manifest = {'samples' : [], 'ncells' : 0, 'gene_order' : None}
+    for sample_name in sample_names:
+        if not sample_name in samples or not samples[sample_name].attrs.get('complete', False):
+            raise ValueError('Sample ' + sample_name + ' is missing or incomplete in ' + store)
+        attrs = samples[sample_name].attrs.asdict()
+        if manifest['gene_order'] is None:
+            manifest['gene_order'] = attrs.get('gene_order')
+        elif manifest['gene_order'] != attrs.get('gene_order'):
+            raise ValueError('Sample ' + sample_name + ' has a different gene order in ' + store)
+        manifest['samples'].append({'sample' : sample_name, 'offset' : manifest['ncells'], 'ncells' : attrs['ncells']})
+        manifest['ncells'] = manifest['ncells'] + attrs['ncells']
+
+    with open(os.path.join(store, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent = 1)
+    return(manifest)
+
+# ------------------------------------------------------------------ #
+class ZarrMatrix:
+    """
+    Combined genes x cells view of the samples of a zarr store, in the
+    order of the manifest.
+
+    Usage:
+        matrix = ZarrMatrix(store)
+        block  = matrix.get_columns(0, 512, layer = 'Spliced')
+        cells  = matrix.get_col_attr('cell_id')
+    """
+    def __init__(self, store):
+        check_zarr()
+        with open(os.path.join(store, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.samples = zarr.open_group(store, mode = 'r')['samples']
+        self.offsets = numpy.array([sample['offset'] for sample in self.manifest['samples']] + [self.manifest['ncells']])
+        self.groups  = [self.samples[sample['sample']] for sample in self.manifest['samples']]
+
+    @property
+    def shape(self):
+        return((self.groups[0]['matrix'].shape[0] if self.groups else 0, self.manifest['ncells']))
+
+    @property
+    def layers(self):
+        if not self.groups:
+            return([])
+        return([''] + list(self.groups[0]['layers'].array_keys() if 'layers' in self.groups[0] else []))
+
+    def get_columns(self, start, end, layer = ''):
+        """Returns the columns start:end of the combined matrix"""
+        end    = min(end, self.manifest['ncells'])
+        blocks = []
+        for index, group in enumerate(self.groups):
+            first = max(start, self.offsets[index])
+            last  = min(end,   self.offsets[index + 1])
+            if first < last:
+                offset = self.offsets[index]
+                blocks.append(group[get_layer_path(layer)][:, first - offset:last - offset])
+        if not blocks:
+            return(numpy.zeros((self.shape[0], 0)))
+        return(numpy.concatenate(blocks, axis = 1))
+
+    def get_row_attr(self, name):
+        return(self.groups[0]['row_attrs'][name][:])
+
+    def get_col_attr(self, name):
+        return(numpy.concatenate([group['col_attrs'][name][:] for group in self.groups]))
+
+# ------------------------------------------------------------------ #
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Write the cell offset manifest of a zarr store')
+    parser.add_argument('--store',        action="store", dest="store")
+    # order of the samples in the combined matrix
+    parser.add_argument('--sample_names', action="store", dest="sample_names", nargs='+')
+
+    args = parser.parse_args()
+
+    # -------------------------------------------------------------- #
+    manifest = write_manifest(args.store, args.sample_names)
+    print('Samples:', len(manifest['samples']), 'cells:', manifest['ncells'])
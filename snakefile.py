@@ -64,8 +64,18 @@ PATH_RSCRIPT         = SOFTWARE['Rscript']['executable']
 
 # used in automatic recognition of parameters from the settings files
 PARAMS               = config['general']['params']
+LOOM_PARAMS          = config['general']['loom']
+PREPROCESSING_PARAMS = config['general']['preprocessing']
 SOFTWARE             = config['tools']
 
+# HDF5 chunking and compression of the loom count matrices
+LOOM_STORAGE_ARGS    = ' '.join([
+    '--chunks',            ' '.join([str(chunk) for chunk in LOOM_PARAMS['chunks']]),
+    '--compression',       str(LOOM_PARAMS['compression']),
+    '--compression_level', str(LOOM_PARAMS['compression_level']),
+    '--shuffle' if LOOM_PARAMS['shuffle'] else ''
+])
+
 PATH_ANNOTATION_PRIMARY = os.path.join(PATH_ANNOTATION, GENOME_NAME_PRIMARY)
 PATH_REFERENCE_PRIMARY  = config['annotation']['primary']['genome']['fasta']
 PATH_GTF_PRIMARY        = config['annotation']['primary']['gtf']
@@ -136,22 +146,23 @@ MAKE_STAR_INDEX = expand(os.path.join(PATH_ANNOTATION, '{genome}','STAR_INDEX','
 # merge reads
 # use for loop - expand gives wrong results
 MERGE_TECHNICAL_REPLICATES = []
-for sample_name in SAMPLE_NAMES:
+# the streaming preprocessing does not write the merged files
+for sample_name in ([] if PREPROCESSING_PARAMS['streaming'] else SAMPLE_NAMES):
     MERGE_TECHNICAL_REPLICATES.append(os.path.join(PATH_MAPPED, sample_name, SAMPLE_SHEET.fetch_field(sample_name,'reads_merged')))
     MERGE_TECHNICAL_REPLICATES.append(os.path.join(PATH_MAPPED, sample_name, SAMPLE_SHEET.fetch_field(sample_name,'barcode_merged')))
 
 # -----------------------------------------------------------------------------
 #
-# filters reads using flexbar
+# filters reads using flexbar - once per sample, the filtered reads are mapped
+# to every genome
 FILTER_READS = []
 for sample_name in SAMPLE_NAMES:
-    for genome in REFERENCE_NAMES:
 
-        barcode_file = os.path.join(PATH_MAPPED, sample_name, genome, sample_name + '_1.fastq.gz')
-        FILTER_READS.append(barcode_file)
+    barcode_file = os.path.join(PATH_MAPPED, sample_name, sample_name + '_1.fastq.gz')
+    FILTER_READS.append(barcode_file)
 
-        read_file    = os.path.join(PATH_MAPPED, sample_name, genome, sample_name + '_2.fastq.gz')
-        FILTER_READS.append(read_file)
+    read_file    = os.path.join(PATH_MAPPED, sample_name, sample_name + '_2.fastq.gz')
+    FILTER_READS.append(read_file)
 
 # ----------------------------------------------------------------------------- #
 # MAPPING
@@ -164,13 +175,18 @@ SORT_BAM = expand(os.path.join(PATH_MAPPED, "{name}", "{genome}","{name}.sorted.
 INDEX_BAM = expand(os.path.join(PATH_MAPPED, "{name}", "{genome}","{name}.sorted.bam.bai"), genome = REFERENCE_NAMES, name = SAMPLE_NAMES)
 
 # ----------------------------------------------------------------------------- #
-# Number of reads per cell calculation
-BAM_HISTOGRAM = expand(os.path.join(PATH_MAPPED, "{name}", "{genome}",'{name}_{genome}_cell_barcode_histogram.txt'), genome = REFERENCE_NAMES, name = SAMPLE_NAMES)
+# Number of reads per cell calculation - once per sample, does not depend on the genome
+BAM_HISTOGRAM = expand(os.path.join(PATH_MAPPED, "{name}", '{name}_cell_barcode_histogram.txt'), name = SAMPLE_NAMES)
 
 # ----------------------------------------------------------------------------- #
 # Number of reads per cell calculation
 FIND_CELL_NUMBER_CUTOFF = expand(os.path.join(PATH_MAPPED, "{name}", "{genome}",'{name}_{genome}_ReadCutoff.yaml'), genome = REFERENCE_NAMES, name = SAMPLE_NAMES)
 
+# optional plots of the cell number cutoff
+READ_CUTOFF_PLOTS = []
+if config['general']['read_cutoff_plot']:
+    READ_CUTOFF_PLOTS = expand(os.path.join(PATH_MAPPED, "{name}", "{genome}",'{name}_{genome}_ReadCutoff.png'), genome = REFERENCE_NAMES, name = SAMPLE_NAMES)
+
 # ----------------------------------------------------------------------------- #
 # UMI matrix in loom format
 UMI_LOOM =  expand(os.path.join(PATH_MAPPED, "{name}", "{genome}",'{name}_{genome}_UMI.matrix.loom'), genome = REFERENCE_NAMES, name = SAMPLE_NAMES)
@@ -178,6 +194,18 @@ UMI_LOOM =  expand(os.path.join(PATH_MAPPED, "{name}", "{genome}",'{name}_{genom
 # Combined UMI matrices in loom format
 COMBINED_LOOM_MATRICES = expand(os.path.join(PATH_MAPPED, "{genome}_UMI.loom"), genome = REFERENCE_NAMES)
 
+# optional sparse copies of the loom files in h5ad (AnnData) format
+COMBINED_H5AD_MATRICES = []
+if LOOM_PARAMS['h5ad']:
+    COMBINED_H5AD_MATRICES = expand(os.path.join(PATH_MAPPED, "{genome}_UMI.h5ad"), genome = REFERENCE_NAMES)
+
+# optional zarr store per genome, written by the conversion jobs of all samples;
+# it is written next to the combined loom files, which are still made - the
+# SingleCellExperiment, Seurat and report steps read the combined loom file
+ZARR_MANIFESTS = []
+if LOOM_PARAMS['zarr']:
+    ZARR_MANIFESTS = expand(os.path.join(PATH_MAPPED, "{genome}_UMI.zarr", "manifest.json"), genome = REFERENCE_NAMES)
+
 
 # ----------------------------------------------------------------------------- #
 # Import and preprocess the combined loom files and save as SingleCellExperiment.RDS objects.
@@ -211,7 +239,7 @@ if len(COMBINE_REFERENCE) > 0:
     RULE_ALL = RULE_ALL + COMBINE_REFERENCE
 
 
-RULE_ALL = RULE_ALL + MAKE_STAR_INDEX + MERGE_TECHNICAL_REPLICATES + FILTER_READS + BAM_HISTOGRAM + FIND_CELL_NUMBER_CUTOFF + MAP_scRNA + SORT_BAM + INDEX_BAM + UMI_LOOM + COMBINED_LOOM_MATRICES + SCE_RDS_FILES + SEURAT_RDS_FILES + BIGWIG + READ_STATISTICS + REPORT_FILES
+RULE_ALL = RULE_ALL + MAKE_STAR_INDEX + MERGE_TECHNICAL_REPLICATES + FILTER_READS + BAM_HISTOGRAM + FIND_CELL_NUMBER_CUTOFF + READ_CUTOFF_PLOTS + MAP_scRNA + SORT_BAM + INDEX_BAM + UMI_LOOM + COMBINED_LOOM_MATRICES + COMBINED_H5AD_MATRICES + ZARR_MANIFESTS + SCE_RDS_FILES + SEURAT_RDS_FILES + BIGWIG + READ_STATISTICS + REPORT_FILES
 
 # ----------------------------------------------------------------------------- #
 rule all:
@@ -266,7 +294,7 @@ if GENOME_SECONDARY_IND:
             genome_name_primary   = GENOME_NAME_PRIMARY,
             genome_name_secondary = GENOME_NAME_SECONDARY,
             perl = SOFTWARE['perl']['executable'],
-            perl_args = SOFTWARE['perl']['executable']['args']
+            perl_args = SOFTWARE['perl']['args']
         message:
             """
                 Combining fasta files:
@@ -309,6 +337,37 @@ rule change_gtf_id:
         shell(command)
 
 
+# ----------------------------------------------------------------------------- #
+# writes the ordered list of gene ids from the GTF file
+# the index is used by every convert_matrix_from_mtx_to_loom job of the genome
+rule make_gene_index:
+    input:
+        infile = os.path.join(PATH_ANNOTATION, '{genome}', '{genome}.gtf')
+    output:
+        outfile = os.path.join(PATH_ANNOTATION, '{genome}', '{genome}.gene_index.tsv')
+    params:
+        threads = config['execution']['rules']['make_gene_index']['threads'],
+        mem     = config['execution']['rules']['make_gene_index']['memory'],
+        python  = SOFTWARE['python']['executable'],
+        script  = PATH_SCRIPT
+    log:
+        logfile = os.path.join(PATH_LOG, '{genome}.make_gene_index.log')
+    message:
+        """
+            Making gene index:
+                input  : {input}
+                output : {output}
+        """
+    run:
+        command = ' '.join([
+            params.python, os.path.join(params.script, 'gene_index.py'),
+            '--gtf_file',    str(input.infile),
+            '--output_file', str(output.outfile),
+            '&>', str(log.logfile)
+        ])
+        print_shell(command)
+
+
 # ----------------------------------------------------------------------------- #
 # STAR INDEX
 ###
@@ -373,7 +432,7 @@ if GENOME_SECONDARY_IND:
             genome_name_primary   = GENOME_NAME_PRIMARY,
             genome_name_secondary = GENOME_NAME_SECONDARY,
             perl = SOFTWARE['perl']['executable'],
-            perl_args = SOFTWARE['perl']['executable']['args']
+            perl_args = SOFTWARE['perl']['args']
         message:
             """
                 Combining gtf files:
@@ -443,6 +502,44 @@ rule merge_technical_replicates:
         print_shell(command)
 
 
+# ----------------------------------------------------------------------------- #
+# reads the complete barcode files (R1) of a sample and checks the lengths of
+# all reads, and that the gzip files are complete - runs in parallel with the
+# preprocessing, and mapping is not started for samples which fail
+rule validate_barcode_reads:
+    # scheduled before the other jobs, so that broken samples are found early
+    priority: 50
+    input:
+        infiles = lambda wc: SAMPLE_SHEET.fetch_barcode_path(wc.name)
+    output:
+        outfile = os.path.join(PATH_MAPPED, "{name}", "{name}_barcode_validation.yaml")
+    params:
+        name               = '{name}',
+        python             = SOFTWARE['python']['executable'],
+        threads            = config['execution']['rules']['validate_barcode_reads']['threads'],
+        mem                = config['execution']['rules']['validate_barcode_reads']['memory'],
+        script             = PATH_SCRIPT,
+        max_wrong_fraction = config['general']['barcode_validation']['max_wrong_fraction']
+    log:
+        logfile = os.path.join(PATH_LOG, "{name}.validate_barcode_reads.log")
+    message:"""
+        validate_barcode_reads:
+            input:  {input.infiles}
+            output: {output.outfile}
+        """
+    run:
+        command = ' '.join([
+            params.python, os.path.join(params.script, 'validate_barcode_reads.py'),
+            '--input_files',        " ".join(input.infiles),
+            '--read_length',        str(get_barcode_read_length(params.name)),
+            '--output_file',        str(output.outfile),
+            '--max_wrong_fraction', str(params.max_wrong_fraction),
+            '--threads',            str(params.threads),
+            '&>', str(log.logfile)
+        ])
+        print_shell(command)
+
+
 # ----------------------------------------------------------------------------- # filters reads based on quality, length and polyA
 # uses flexbar to filter reads
 def fetch_reads(wc):
@@ -456,10 +553,10 @@ rule filter_reads:
     input:
         unpack(fetch_reads)
     output:
-        barcode = os.path.join(PATH_MAPPED, "{name}", "{genome}","{name}_1.fastq.gz"),
-        reads   = os.path.join(PATH_MAPPED, "{name}", "{genome}","{name}_2.fastq.gz")
+        barcode = os.path.join(PATH_MAPPED, "{name}", "{name}_1.fastq.gz"),
+        reads   = os.path.join(PATH_MAPPED, "{name}", "{name}_2.fastq.gz")
     params:
-        outpath       = os.path.join(PATH_MAPPED, "{name}", "{genome}"),
+        outpath       = os.path.join(PATH_MAPPED, "{name}"),
         name          = '{name}',
         threads       = config['execution']['rules']['filter_reads']['threads'],
         mem           = config['execution']['rules']['filter_reads']['memory'],
@@ -472,7 +569,7 @@ rule filter_reads:
         # minimal length of the polyA homopolimer
         polya_length  = 10
     log:
-        log = os.path.join(PATH_LOG, "{name}.{genome}.filter_reads.log")
+        log = os.path.join(PATH_LOG, "{name}.filter_reads.log")
     message:"""
         filter reads
                 input:   {input}
@@ -508,84 +605,184 @@ rule cell_barcode_histogram:
     input:
         infile = rules.filter_reads.output.barcode
     output:
-        outfile = os.path.join(PATH_MAPPED, "{name}", "{genome}",'{name}_{genome}_cell_barcode_histogram.txt')
+        outfile = os.path.join(PATH_MAPPED, "{name}", '{name}_cell_barcode_histogram.txt')
     params:
-        outdir    = os.path.join(PATH_MAPPED, "{name}", "{genome}"),
-        outname   = "{name}_{genome}",
         name      = "{name}",
         threads   = config['execution']['rules']['cell_barcode_histogram']['threads'],
         mem       = config['execution']['rules']['cell_barcode_histogram']['memory'],
-        jellyfish = SOFTWARE['jellyfish']['executable'],
-        perl      = SOFTWARE['perl']['executable'],
-        zcat      = SOFTWARE['zcat']['executable'],
-        tempdir   = TEMPDIR,
-        hash_size = 10000000
+        python    = SOFTWARE['python']['executable'],
+        script    = PATH_SCRIPT
     message: """
             cell_barcode_histogram:
                 input:  {input.infile}
                 output: {output.outfile}
         """
     log:
-        logfile = os.path.join(PATH_LOG, '{name}_{genome}_cell_barcode_histogram.log')
+        logfile = os.path.join(PATH_LOG, '{name}_cell_barcode_histogram.log')
     run:
-        cb_adapter   = adapter_params(params.name, 'cell_barcode')
-        count_file   = os.path.join(params.outdir, params.outname + '.jf')
-        tmp_file     = os.path.join(params.outdir, params.outname + '.tmp.fastq')
-        # parses the barcodes from the fastq file
-        # counts the kmers
-        # extracts the cell barcode kmers using a perl oneliner - not optimal but works
-        # ------------------------------------------------ #
-        perl_extract_cb = ' '.join([
-            params.perl,
-            '\'-ne if( $. % 4 == 0 | $. % 4 ==2 ){{print substr($_,',
-             str(cb_adapter['start'] - 1),
-             ',',
-             str(cb_adapter['length']),
-             ')."\\n";}}else{{print}}\''
-        ])
-        command_parse = ' '.join([
-            params.zcat, input.infile, '|',
-            perl_extract_cb, '>',
-            tmp_file,
-            '2>>', str(log.logfile)
+        command = ' '.join([
+            count_cell_barcodes_command(params.python, params.script, params.name, params.threads),
+            '--input_files', str(input.infile),
+            '--output_file', str(output.outfile),
+            '&>', str(log.logfile)
         ])
+        print_shell(command)
 
-        # ------------------------------------------------ #
-        command_count = ' '.join([
-            params.jellyfish, 'count',
-            '-t',    str(params.threads),
-            '-o',    str(count_file),
-            '-m',    str(cb_adapter['length']),
-            '-s',    str(params.hash_size),
-            tmp_file,
-            '2>>', str(log.logfile)
-        ])
+# ----------------------------------------------------------------------------- #
+# streaming preprocessing: the technical replicates are decompressed directly
+# into flexbar, flexbar writes into named pipes which are compressed into the
+# filtered fastq files, and the filtered barcode reads are teed into the
+# cell barcode counter - replaces merge_technical_replicates, filter_reads
+# and cell_barcode_histogram without writing the intermediate fastq files
+if PREPROCESSING_PARAMS['streaming']:
 
-        # ------------------------------------------------ #
-        # outputs the kmer table
-        command_dump = ' '.join([
-            params.jellyfish, 'dump',
-            '--column',
-            '--tab',
-            '-o',    str(output.outfile),
-            count_file,
-            '2>>', str(log.logfile)
-        ])
+    ruleorder: filter_reads_streaming > filter_reads
+    ruleorder: filter_reads_streaming > cell_barcode_histogram
 
-        # ------------------------------------------------ #
-        # removes the jellyfish database
-        command_remove = ' '.join([
-            'rm', count_file, tmp_file
-        ])
+    rule filter_reads_streaming:
+        input:
+            barcode = lambda wc: SAMPLE_SHEET.fetch_barcode_path(wc.name),
+            reads   = lambda wc: SAMPLE_SHEET.fetch_reads_path(wc.name)
+        output:
+            barcode   = rules.filter_reads.output.barcode,
+            reads     = rules.filter_reads.output.reads,
+            histogram = rules.cell_barcode_histogram.output.outfile
+        params:
+            outpath       = os.path.join(PATH_MAPPED, "{name}"),
+            outname       = "{name}",
+            name          = '{name}',
+            threads       = config['execution']['rules']['filter_reads']['threads'],
+            mem           = config['execution']['rules']['filter_reads']['memory'],
+            count_threads = config['execution']['rules']['cell_barcode_histogram']['threads'],
+            flexbar       = SOFTWARE['flexbar']['executable'],
+            python        = SOFTWARE['python']['executable'],
+            zcat          = SOFTWARE['zcat']['executable'],
+            gzip          = SOFTWARE['gzip']['executable'],
+            script        = PATH_SCRIPT,
+
+            # minimal base quality
+            base_quality  = 20,
+
+            # minimal length of the polyA homopolimer
+            polya_length  = 10
+        log:
+            log = os.path.join(PATH_LOG, "{name}.filter_reads_streaming.log")
+        message:"""
+            filter reads (streaming)
+                    input:   {input}
+                    output reads   : {output.reads}
+                    output barcode : {output.barcode}
+                    output cell barcode histogram : {output.histogram}
+            """
+        run:
+            adapter_size = get_adapter_size(params.name)
+            target       = os.path.join(params.outpath, params.name)
+
+            # flexbar writes uncompressed fastq files named after the target,
+            # which are named pipes here; the cell barcode counter reads a copy
+            # of the barcode reads from a third pipe
+            fifo_barcode = target + '_1.fastq'
+            fifo_reads   = target + '_2.fastq'
+            fifo_counter = os.path.join(params.outpath, params.outname + '.cell_barcodes.fastq')
+            fifos        = ' '.join([fifo_barcode, fifo_reads, fifo_counter])
+
+            command_flexbar = ' '.join([
+                params.flexbar,
+                '--reads',   '<(' + params.zcat + ' ' + ' '.join(input.barcode) + ')',
+                '--reads2',  '<(' + params.zcat + ' ' + ' '.join(input.reads) + ')',
+                '--target',  target,
+                '--threads', str(params.threads),
+                '--min-read-length', str(adapter_size),
+                # quality trimming
+                '--qtrim', 'TAIL',
+                '--qtrim-format', 'i1.8',
+                '--qtrim-threshold',  str(params.base_quality),
+                # homopolyer trimming
+                '--htrim-right', 'A',
+                '--htrim-min-length', str(params.polya_length),
+                '>>', str(log.log), '2>&1'
+            ])
 
-        command_final = ";".join([command_parse, command_count,command_dump,command_remove])
-        print_shell(command_final)
+            command_count = ' '.join([
+                count_cell_barcodes_command(params.python, params.script, params.name, params.count_threads),
+                '--input_files', fifo_counter,
+                '--output_file', str(output.histogram),
+                '>>', str(log.log), '2>&1'
+            ])
+
+            command = '\n'.join([
+                # the readers are stopped and the pipes removed when the job ends
+                "trap 'kill $(jobs -p) 2> /dev/null || true; rm -f " + fifos + "' EXIT",
+                'rm -f ' + fifos,
+                'mkfifo ' + fifos,
+                command_count + ' &',
+                'pid_count=$!',
+                params.gzip + ' -c < ' + fifo_reads + ' > ' + str(output.reads) + ' &',
+                'pid_reads=$!',
+                'tee ' + fifo_counter + ' < ' + fifo_barcode + ' | ' + params.gzip + ' -c > ' + str(output.barcode) + ' &',
+                'pid_barcode=$!',
+                command_flexbar,
+                'wait $pid_barcode',
+                'wait $pid_reads',
+                'wait $pid_count'
+            ])
+            print_shell(command)
+
+# the filtered reads and the cell barcode histogram of a sample, shared by all
+# genomes - an input given as rules.<rule>.output is always produced by that
+# rule (the ruleorder does not apply), so the active preprocessing rule is used
+if PREPROCESSING_PARAMS['streaming']:
+    PREPROCESSED_READS = rules.filter_reads_streaming.output
+    PREPROCESSED_CELL_BARCODE_HISTOGRAM = rules.filter_reads_streaming.output.histogram
+else:
+    PREPROCESSED_READS = rules.filter_reads.output
+    PREPROCESSED_CELL_BARCODE_HISTOGRAM = rules.cell_barcode_histogram.output.outfile
+
+# ----------------------------------------------------------------------------- #
+# corrects the cell barcode histogram for sequencing errors: barcodes which
+# differ by one base from a barcode with many more reads are folded into it
+# before the cell number cutoff
+BARCODE_CORRECTION_PARAMS = config['general']['barcode_correction']
+if BARCODE_CORRECTION_PARAMS['enabled']:
+    rule correct_cell_barcodes:
+        input:
+            infile = PREPROCESSED_CELL_BARCODE_HISTOGRAM
+        output:
+            outfile = os.path.join(PATH_MAPPED, "{name}", '{name}_cell_barcode_histogram.corrected.txt')
+        params:
+            threads     = config['execution']['rules']['correct_cell_barcodes']['threads'],
+            mem         = config['execution']['rules']['correct_cell_barcodes']['memory'],
+            max_parents = config['general']['cell_maximal_number'],
+            ratio       = BARCODE_CORRECTION_PARAMS['ratio'],
+            script      = PATH_SCRIPT,
+            python      = SOFTWARE['python']['executable']
+        message: """
+                correct_cell_barcodes:
+                    input:  {input.infile}
+                    output: {output.outfile}
+            """
+        log:
+            logfile = os.path.join(PATH_LOG, "{name}.correct_cell_barcodes.log")
+        run:
+            command = ' '.join([
+                params.python, os.path.join(params.script, 'correct_cell_barcodes.py'),
+                '--input_file',  str(input.infile),
+                '--output_file', str(output.outfile),
+                '--max_parents', str(params.max_parents),
+                '--ratio',       str(params.ratio),
+                '&>', str(log.logfile)
+            ])
+            print_shell(command)
+
+    CELL_BARCODE_HISTOGRAM = rules.correct_cell_barcodes.output.outfile
+else:
+    CELL_BARCODE_HISTOGRAM = PREPROCESSED_CELL_BARCODE_HISTOGRAM
 
 # ----------------------------------------------------------------------------- #
 # finds the barcode cutoff using inflection method
 rule find_absolute_read_cutoff:
     input:
-        infile = rules.cell_barcode_histogram.output.outfile
+        infile = CELL_BARCODE_HISTOGRAM
     output:
         outfile_yaml = os.path.join(PATH_MAPPED, "{name}", "{genome}",'{name}_{genome}_ReadCutoff.yaml'),
         outfile_tab  = os.path.join(PATH_MAPPED, "{name}", "{genome}",'{name}_{genome}_ReadCutoff.txt')
@@ -596,24 +793,66 @@ rule find_absolute_read_cutoff:
         mem      = config['execution']['rules']['find_absolute_read_cutoff']['memory'],
         cutoff   = config['general']['cell_maximal_number'],
         script   = PATH_SCRIPT,
-        Rscript  = PATH_RSCRIPT
+        python   = SOFTWARE['python']['executable']
     message: """
             find_absolute_read_cutoff:
                 input:  {input.infile}
                 output: {output.outfile_yaml}
         """
+    log:
+        logfile = os.path.join(PATH_LOG, "{name}.{genome}.find_absolute_read_cutoff.log")
+    run:
+        command = ' '.join([
+            params.python, os.path.join(params.script, 'find_absolute_read_cutoff.py'),
+            '--input_file',   str(input.infile),
+            '--outfile_yaml', str(output.outfile_yaml),
+            '--outfile_tab',  str(output.outfile_tab),
+            '--cutoff',       str(params.cutoff),
+            '&>', str(log.logfile)
+        ])
+        print_shell(command)
+
+# ----------------------------------------------------------------------------- #
+# plots the cumulative read curve and the cell number cutoff - a separate job,
+# so that the mapping does not wait for it
+rule plot_read_cutoff:
+    input:
+        infile = CELL_BARCODE_HISTOGRAM
+    output:
+        outfile = os.path.join(PATH_MAPPED, "{name}", "{genome}",'{name}_{genome}_ReadCutoff.png')
+    params:
+        threads  = config['execution']['rules']['plot_read_cutoff']['threads'],
+        mem      = config['execution']['rules']['plot_read_cutoff']['memory'],
+        cutoff   = config['general']['cell_maximal_number'],
+        script   = PATH_SCRIPT,
+        python   = SOFTWARE['python']['executable']
+    message: """
+            plot_read_cutoff:
+                input:  {input.infile}
+                output: {output.outfile}
+        """
+    log:
+        logfile = os.path.join(PATH_LOG, "{name}.{genome}.plot_read_cutoff.log")
     run:
-        RunRscript(input, output, params, params.script, 'Find_Absolute_Read_Cutoff.R')
+        command = ' '.join([
+            params.python, os.path.join(params.script, 'find_absolute_read_cutoff.py'),
+            '--input_file',   str(input.infile),
+            '--outfile_plot', str(output.outfile),
+            '--cutoff',       str(params.cutoff),
+            '&>', str(log.logfile)
+        ])
+        print_shell(command)
 
 
 # ----------------------------------------------------------------------------- #
 # Maps single cell data using star and constructs the DGE matrix
 rule map_star:
     input:
-        barcode   = rules.filter_reads.output.barcode,
-        reads     = rules.filter_reads.output.reads,
+        barcode   = PREPROCESSED_READS.barcode,
+        reads     = PREPROCESSED_READS.reads,
         genome    = rules.make_star_reference.output,
-        whitelist = rules.find_absolute_read_cutoff.output.outfile_tab
+        whitelist = rules.find_absolute_read_cutoff.output.outfile_tab,
+        validated = rules.validate_barcode_reads.output.outfile
     output:
         outfile   = os.path.join(PATH_MAPPED, "{name}", "{genome}","{name}_Aligned.out.bam")
     params:
@@ -731,8 +970,11 @@ rule index_bam:
 rule convert_matrix_from_mtx_to_loom:
     input:
         bamfile       = rules.sort_bam.output.outfile,
+        gene_index    = rules.make_gene_index.output.outfile
     output:
-        outfile       = os.path.join(PATH_MAPPED, "{name}", "{genome}",'{name}_{genome}_UMI.matrix.loom')
+        outfile       = os.path.join(PATH_MAPPED, "{name}", "{genome}",'{name}_{genome}_UMI.matrix.loom'),
+        h5ad          = [os.path.join(PATH_MAPPED, "{name}", "{genome}",'{name}_{genome}_UMI.matrix.h5ad')] if LOOM_PARAMS['h5ad'] else [],
+        zarr          = [directory(os.path.join(PATH_MAPPED, "{genome}_UMI.zarr", "samples", "{name}"))] if LOOM_PARAMS['zarr'] else []
     params:
         name    = '{name}',
         python  = SOFTWARE['python']['executable'],
@@ -749,7 +991,10 @@ rule convert_matrix_from_mtx_to_loom:
         # input gtf
         gtf               = lambda wildcards: os.path.join(PATH_ANNOTATION, wildcards.genome, '.'.join([wildcards.genome, 'gtf'])),
         script            = PATH_SCRIPT,
-        sample_sheet_file = PATH_SAMPLE_SHEET
+        sample_sheet_file = PATH_SAMPLE_SHEET,
+        batch_size        = LOOM_PARAMS['batch_size'],
+        min_umi           = LOOM_PARAMS['min_umi'],
+        storage           = LOOM_STORAGE_ARGS
     log:
         logfile = os.path.join(PATH_LOG, "{name}.{genome}.convert_matrix_from_mtx_to_loom.log")
     message: """
@@ -762,12 +1007,117 @@ rule convert_matrix_from_mtx_to_loom:
             params.python, os.path.join(params.script, 'convert_matrix_from_mtx_to_loom.py'),
             '--sample_id',              params.name,
             '--input_dir',              params.indir,
+            '--gene_index',             input.gene_index,
             '--gtf_file',               params.gtf,
             '--star_output_types_keys', params.star_output_types_keys,
             '--star_output_types_vals', params.star_output_types_vals,
             '--output_file',            output.outfile,
+            ' '.join(['--output_h5ad'] + list(output.h5ad)) if output.h5ad else '',
+            '--output_zarr ' + os.path.join(PATH_MAPPED, wildcards.genome + '_UMI.zarr') if output.zarr else '',
             '--sample_sheet_file',      params.sample_sheet_file,
-            '--path_script',            params.script,
+            '--threads',                str(params.threads),
+            '--batch_size',             str(params.batch_size),
+            '--min_umi',                str(params.min_umi),
+            params.storage,
+            '&>', str(log.logfile)
+        ])
+        print_shell(command)
+
+
+# ----------------------------------------------------------------------------- #
+# batch mode: converts the UMI matrices of all samples of a genome in one job,
+# with a pool of worker processes - avoids starting one python process
+# (and reading the gene index and the sample sheet) per sample
+if LOOM_PARAMS['batch_conversion']:
+
+    ruleorder: convert_matrices_from_mtx_to_loom_batch > convert_matrix_from_mtx_to_loom
+
+    rule convert_matrices_from_mtx_to_loom_batch:
+        input:
+            bamfile       = expand(os.path.join(PATH_MAPPED, "{name}", "{{genome}}", "{name}.sorted.bam"), name = SAMPLE_NAMES),
+            gene_index    = rules.make_gene_index.output.outfile
+        output:
+            outfile       = expand(os.path.join(PATH_MAPPED, "{name}", "{{genome}}", '{name}_{{genome}}_UMI.matrix.loom'), name = SAMPLE_NAMES),
+            h5ad          = expand(os.path.join(PATH_MAPPED, "{name}", "{{genome}}", '{name}_{{genome}}_UMI.matrix.h5ad'), name = SAMPLE_NAMES) if LOOM_PARAMS['h5ad'] else [],
+            zarr          = [directory(path) for path in expand(os.path.join(PATH_MAPPED, "{{genome}}_UMI.zarr", "samples", "{name}"), name = SAMPLE_NAMES)] if LOOM_PARAMS['zarr'] else []
+        params:
+            names   = SAMPLE_NAMES,
+            python  = SOFTWARE['python']['executable'],
+            threads = config['execution']['rules']['convert_matrices_from_mtx_to_loom_batch']['threads'],
+            mem     = config['execution']['rules']['convert_matrices_from_mtx_to_loom_batch']['memory'],
+
+            # input files
+            indir   = lambda wildcards: [os.path.join(PATH_MAPPED, name, wildcards.genome, name + '_Solo.out') for name in SAMPLE_NAMES],
+
+            # STARsolo output types
+            star_output_types_keys = " ".join(STAR_OUTPUT_TYPES_KEYS),
+            star_output_types_vals = " ".join(STAR_OUTPUT_TYPES_VALS),
+
+            # input gtf
+            gtf               = lambda wildcards: os.path.join(PATH_ANNOTATION, wildcards.genome, '.'.join([wildcards.genome, 'gtf'])),
+            script            = PATH_SCRIPT,
+            sample_sheet_file = PATH_SAMPLE_SHEET,
+            batch_size        = LOOM_PARAMS['batch_size'],
+            min_umi           = LOOM_PARAMS['min_umi'],
+            storage           = LOOM_STORAGE_ARGS
+        log:
+            logfile = os.path.join(PATH_LOG, "{genome}.convert_matrices_from_mtx_to_loom_batch.log")
+        message: """
+                convert_matrices_from_mtx_to_loom_batch:
+                    genome: {wildcards.genome}
+                    output: {output.outfile}
+            """
+        run:
+            # one sample per worker process
+            command = ' '.join([
+                params.python, os.path.join(params.script, 'convert_matrix_from_mtx_to_loom.py'),
+                '--sample_id',              " ".join(params.names),
+                '--input_dir',              " ".join(params.indir),
+                '--gene_index',             input.gene_index,
+                '--gtf_file',               params.gtf,
+                '--star_output_types_keys', params.star_output_types_keys,
+                '--star_output_types_vals', params.star_output_types_vals,
+                '--output_file',            " ".join(output.outfile),
+                ' '.join(['--output_h5ad'] + list(output.h5ad)) if output.h5ad else '',
+                '--output_zarr ' + os.path.join(PATH_MAPPED, wildcards.genome + '_UMI.zarr') if output.zarr else '',
+                '--sample_sheet_file',      params.sample_sheet_file,
+                '--workers',                str(params.threads),
+                '--threads',                '1',
+                '--batch_size',             str(params.batch_size),
+                '--min_umi',                str(params.min_umi),
+                params.storage,
+                '&>', str(log.logfile)
+            ])
+            print_shell(command)
+
+
+# ----------------------------------------------------------------------------- #
+## records the cell offsets of the samples in the zarr store of a genome -
+#  the samples are written concurrently by the conversion jobs, the manifest
+#  turns them into one combined matrix without copying the counts
+rule make_zarr_manifest:
+    input:
+        samples = expand(os.path.join(PATH_MAPPED, "{{genome}}_UMI.zarr", "samples", "{name}"), name = SAMPLE_NAMES)
+    output:
+        outfile = os.path.join(PATH_MAPPED, "{genome}_UMI.zarr", "manifest.json")
+    params:
+        python  = SOFTWARE['python']['executable'],
+        threads = config['execution']['rules']['make_zarr_manifest']['threads'],
+        mem     = config['execution']['rules']['make_zarr_manifest']['memory'],
+        script  = PATH_SCRIPT,
+        store   = os.path.join(PATH_MAPPED, "{genome}_UMI.zarr"),
+        names   = " ".join(SAMPLE_NAMES)
+    log:
+        logfile = os.path.join(PATH_LOG, "{genome}.make_zarr_manifest.log")
+    message: """
+            make_zarr_manifest:
+                output: {output.outfile}
+        """
+    run:
+        command = ' '.join([
+            params.python, os.path.join(params.script, 'zarr_IO.py'),
+            '--store',        params.store,
+            '--sample_names', params.names,
             '&>', str(log.logfile)
         ])
         print_shell(command)
@@ -783,12 +1133,17 @@ rule combine_loom_files:
     input:
         infile   = fetch_loom_files
     output:
-        outfile  = os.path.join(PATH_MAPPED, "{genome}_UMI.loom")
+        outfile  = os.path.join(PATH_MAPPED, "{genome}_UMI.loom"),
+        index    = os.path.join(PATH_MAPPED, "{genome}_UMI.cell_index.tsv"),
+        h5ad     = [os.path.join(PATH_MAPPED, "{genome}_UMI.h5ad")] if LOOM_PARAMS['h5ad'] else []
     params:
          python = SOFTWARE['python']['executable'],
          threads    = config['execution']['rules']['combine_loom_files']['threads'],
          mem        = config['execution']['rules']['combine_loom_files']['memory'],
-         script = PATH_SCRIPT
+         script = PATH_SCRIPT,
+         batch_size = LOOM_PARAMS['batch_size'],
+         incremental = '--incremental' if LOOM_PARAMS['incremental'] else '',
+         storage    = LOOM_STORAGE_ARGS
     log:
         logfile = os.path.join(PATH_LOG, "{genome}.combine_loom_files.log")
     message: """
@@ -802,6 +1157,11 @@ rule combine_loom_files:
             params.python, os.path.join(params.script, 'combine_loom_matrices.py'),
             '--input_files', " ".join(input.infile),
             '--output_file', output.outfile,
+            '--output_cell_index', output.index,
+            ' '.join(['--output_h5ad'] + list(output.h5ad)) if output.h5ad else '',
+            '--batch_size',  str(params.batch_size),
+            params.incremental,
+            params.storage,
             '&>', str(log.logfile)
         ])
         print_shell(command)
@@ -0,0 +1,106 @@
+"""
+Benchmark of the HDF5 storage options of the loom files - scripts/loom_IO.py
+
+Writes a synthetic sparse count matrix with different chunk shapes and
+compression settings, and reports for each setting:
+    write time, file size, the time to read a block of cells (columns)
+    and the time to read a block of genes (rows)
+
+Usage:
+    python tests/benchmark_loom_storage.py --genes 20000 --cells 10000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import h5py
+import numpy
+import scipy.sparse
+
+PATH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.append(PATH_SCRIPT)
+import loom_IO
+
+# ------------------------------------------------------------------ #
+# chunk shape (genes, cells), compression, compression level, shuffle
+SETTINGS = [
+    {'chunks' : [64,   64],  'compression' : 'gzip', 'compression_level' : 2, 'shuffle' : False},
+    {'chunks' : [64,   64],  'compression' : 'gzip', 'compression_level' : 2, 'shuffle' : True},
+    {'chunks' : [64,   64],  'compression' : 'lzf',  'compression_level' : 0, 'shuffle' : False},
+    {'chunks' : [64,   64],  'compression' : 'none', 'compression_level' : 0, 'shuffle' : False},
+    {'chunks' : [4096, 16],  'compression' : 'gzip', 'compression_level' : 2, 'shuffle' : False},
+    {'chunks' : [16,   4096],'compression' : 'gzip', 'compression_level' : 2, 'shuffle' : False},
+    {'chunks' : [256,  256], 'compression' : 'gzip', 'compression_level' : 4, 'shuffle' : True},
+    {'chunks' : [256,  256], 'compression' : 'lzf',  'compression_level' : 0, 'shuffle' : True},
+]
+
+# ------------------------------------------------------------------ #
+# sparse UMI counts with the density of a typical single cell experiment
+def get_count_matrix(genes, cells, density, seed = 1):
+    rng    = numpy.random.RandomState(seed)
+    matrix = scipy.sparse.random(genes, cells, density = density, format = 'csc', random_state = rng,
+        data_rvs = lambda size: rng.geometric(0.5, size = size))
+    return(matrix.astype(numpy.int64))
+
+# ------------------------------------------------------------------ #
+def write_matrix(filename, matrix, storage, batch_size):
+    time_start = time.time()
+    with loom_IO.LoomWriter(filename, storage = storage) as writer:
+        for start in range(0, matrix.shape[1], batch_size):
+            writer.add_columns({'' : matrix[:, start:start + batch_size].toarray()})
+        writer.row_attrs = {'gene_id' : numpy.array(['gene' + str(i) for i in range(matrix.shape[0])])}
+        writer.col_attrs = {'cell_id' : numpy.array(['cell' + str(i) for i in range(matrix.shape[1])])}
+    return(time.time() - time_start)
+
+# ------------------------------------------------------------------ #
+# reads the matrix in blocks along the given axis - 1 for cells, 0 for genes
+def read_blocks(filename, axis, block_size, nblocks):
+    time_start = time.time()
+    with h5py.File(filename, 'r') as f:
+        dataset = f['/matrix']
+        size    = dataset.shape[axis]
+        for start in numpy.linspace(0, max(size - block_size, 0), nblocks).astype(int):
+            if axis == 1:
+                dataset[:, start:start + block_size]
+            else:
+                dataset[start:start + block_size, :]
+    return((time.time() - time_start) / nblocks)
+
+# ------------------------------------------------------------------ #
+def format_setting(storage):
+    return('{:>11} {:>5} {:>2} {:>7}'.format(
+        'x'.join(map(str, storage['chunks'])), storage['compression'],
+        storage['compression_level'], 'shuffle' if storage['shuffle'] else ''))
+
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the HDF5 storage options of the loom files')
+    parser.add_argument('--genes',      action="store", dest="genes",      type=int,   default=20000)
+    parser.add_argument('--cells',      action="store", dest="cells",      type=int,   default=5000)
+    parser.add_argument('--density',    action="store", dest="density",    type=float, default=0.05)
+    parser.add_argument('--batch_size', action="store", dest="batch_size", type=int,   default=512)
+    # number of cells / genes read at once, and number of blocks read
+    parser.add_argument('--block_size', action="store", dest="block_size", type=int,   default=256)
+    parser.add_argument('--nblocks',    action="store", dest="nblocks",    type=int,   default=5)
+    parser.add_argument('--tempdir',    action="store", dest="tempdir")
+
+    args = parser.parse_args()
+
+    # -------------------------------------------------------------- #
+    print('Matrix: {} genes x {} cells, density {}'.format(args.genes, args.cells, args.density))
+    matrix = get_count_matrix(args.genes, args.cells, args.density)
+
+    print('{:>30} {:>10} {:>10} {:>12} {:>12}'.format('setting', 'write s', 'size MB', 'cells s/blk', 'genes s/blk'))
+    with tempfile.TemporaryDirectory(dir = args.tempdir) as tmpdir:
+        for index, storage in enumerate(SETTINGS):
+            filename   = os.path.join(tmpdir, 'benchmark_' + str(index) + '.loom')
+            time_write = write_matrix(filename, matrix, storage, args.batch_size)
+            size       = os.path.getsize(filename) / 1e6
+            time_cells = read_blocks(filename, 1, args.block_size, args.nblocks)
+            time_genes = read_blocks(filename, 0, args.block_size, args.nblocks)
+            print('{:>30} {:>10.2f} {:>10.1f} {:>12.3f} {:>12.3f}'.format(
+                format_setting(storage), time_write, size, time_cells, time_genes))
+            os.remove(filename)
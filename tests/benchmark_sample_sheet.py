@@ -0,0 +1,131 @@
+"""
+Startup benchmark of the sample sheet class - scripts/Sample_Sheet_Class.py
+
+Writes a synthetic sample sheet with many samples (and small gzipped fastq
+files), loads it as the snakefile does and reports the time of:
+    init_SAMPLE_SHEET (validation of the input files with --threads threads,
+                       merging the technical replicates)
+    init_SAMPLE_SHEET again, with the cached validation results
+    the accessor calls the snakefile makes while building the DAG,
+    for every sample, genome and rule
+The accessor calls are also timed with the previous lookup, which filtered
+the merged sheet with a boolean mask on every call.
+
+Usage:
+    python tests/benchmark_sample_sheet.py --samples 10000 --genomes 2
+"""
+import argparse
+import gzip
+import os
+import sys
+import tempfile
+import time
+
+PATH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.append(PATH_SCRIPT)
+from Sample_Sheet_Class import experiment
+
+CONFIG = {
+    'adapter_parameters' : {
+        'dropseq' : {'cell_barcode' : {'base_min' : 1, 'base_max' : 12}, 'umi_barcode' : {'base_min' : 13, 'base_max' : 20}}
+    },
+    'locations' : {}
+}
+
+# ------------------------------------------------------------------ #
+# writes the sample sheet and one barcode and one reads file per row;
+# every replicates-th sample has two technical replicates
+def write_sample_sheet(path, samples, replicates):
+    reads_dir = os.path.join(path, 'reads')
+    os.makedirs(reads_dir)
+    barcode = gzip.compress(b'@read\nACGTACGTACGTACGTACGT\n+\nIIIIIIIIIIIIIIIIIIII\n')
+    reads   = gzip.compress(b'@read\nACGTACGTACGTACGTACGTACGTACGT\n+\nIIIIIIIIIIIIIIIIIIIIIIIIIIII\n')
+
+    lines = ['sample_name,barcode,reads,method,replicate,condition']
+    for index in range(samples):
+        name = 'S' + str(index)
+        for replicate in range(2 if index % replicates == 0 else 1):
+            prefix = name + '_' + str(replicate)
+            for suffix, content in [('_B.fastq.gz', barcode), ('_F.fastq.gz', reads)]:
+                with open(os.path.join(reads_dir, prefix + suffix), 'wb') as f:
+                    f.write(content)
+            lines.append(','.join([name, prefix + '_B.fastq.gz', prefix + '_F.fastq.gz', 'dropseq', 'br' + str(index % 3), 'c' + str(index % 2)]))
+
+    sample_sheet = os.path.join(path, 'sample_sheet.csv')
+    with open(sample_sheet, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return(sample_sheet, reads_dir)
+
+# ------------------------------------------------------------------ #
+# the previous lookup: filters the merged sheet on every call
+def fetch_field_masked(sheet, sample_name, column):
+    field = sheet[sheet['sample_name'] == sample_name][column]
+    return(list(field)[0])
+
+# ------------------------------------------------------------------ #
+# the accessor calls of the snakefile: target lists and input functions
+# of the rules, for every sample and genome
+def build_targets(sample_names, genomes, fetch_field):
+    targets = []
+    for sample_name in sample_names:
+        targets.append(fetch_field(sample_name, 'reads_merged'))
+        targets.append(fetch_field(sample_name, 'barcode_merged'))
+        targets.append(fetch_field(sample_name, 'barcode_path'))
+        targets.append(fetch_field(sample_name, 'reads_path'))
+        for genome in genomes:
+            targets.append(fetch_field(sample_name, 'method')[0])
+            targets.append(fetch_field(sample_name, 'barcode_merged'))
+            targets.append(fetch_field(sample_name, 'reads_merged'))
+    return(targets)
+
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the startup of the sample sheet class')
+    parser.add_argument('--samples',    action="store", dest="samples",    type=int, default=10000)
+    parser.add_argument('--genomes',    action="store", dest="genomes",    type=int, default=2)
+    # every replicates-th sample has two technical replicates
+    parser.add_argument('--replicates', action="store", dest="replicates", type=int, default=10)
+    # number of samples for which the previous (masked) lookup is timed
+    parser.add_argument('--masked',     action="store", dest="masked",     type=int, default=500)
+    # number of threads which validate the input files
+    parser.add_argument('--threads',    action="store", dest="threads",    type=int, default=8)
+    parser.add_argument('--tempdir',    action="store", dest="tempdir")
+
+    args = parser.parse_args()
+
+    # -------------------------------------------------------------- #
+    genomes = ['genome' + str(index) for index in range(args.genomes)]
+    with tempfile.TemporaryDirectory(dir = args.tempdir) as tmpdir:
+        sample_sheet, reads_dir = write_sample_sheet(tmpdir, args.samples, args.replicates)
+        locations = {'reads-dir' : reads_dir, 'output-dir' : os.path.join(tmpdir, 'out')}
+        config    = dict(CONFIG, locations = locations, execution = {'validation' : {'threads' : args.threads}})
+
+        time_start = time.time()
+        SAMPLE_SHEET = experiment(config = config)
+        SAMPLE_SHEET.init_SAMPLE_SHEET(sample_sheet)
+        sample_names = SAMPLE_SHEET.fetch_sample_names()
+        time_init = time.time() - time_start
+
+        time_start   = time.time()
+        SAMPLE_SHEET = experiment(config = config)
+        SAMPLE_SHEET.init_SAMPLE_SHEET(sample_sheet)
+        time_cached  = time.time() - time_start
+
+        time_start = time.time()
+        targets    = build_targets(sample_names, genomes, SAMPLE_SHEET.fetch_field)
+        time_index = time.time() - time_start
+
+        # the masked lookup is timed on a subset and extrapolated
+        subset     = sample_names[:args.masked]
+        sheet      = SAMPLE_SHEET.merged_replicates
+        time_start = time.time()
+        masked     = build_targets(subset, genomes, lambda sample_name, column: fetch_field_masked(sheet, sample_name, column))
+        time_mask  = (time.time() - time_start) * len(sample_names) / max(len(subset), 1)
+        assert masked == targets[:len(masked)]
+
+    print('Samples: {}, genomes: {}, accessor calls: {}'.format(len(sample_names), len(genomes), len(targets)))
+    print('{:>32} {:>10.2f} s'.format('init_SAMPLE_SHEET', time_init))
+    print('{:>32} {:>10.2f} s'.format('init_SAMPLE_SHEET, cached', time_cached))
+    print('{:>32} {:>10.2f} s'.format('accessors, indexed', time_index))
+    print('{:>32} {:>10.2f} s'.format('accessors, masked (estimated)', time_mask))
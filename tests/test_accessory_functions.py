@@ -0,0 +1,88 @@
+"""
+Tests for the tool parameter discovery of join_params - scripts/Accessory_Functions.py
+
+The functions are included into the snakefile and use its globals
+(config, SOFTWARE), which are set on the module here.
+
+Can be run either with pytest or as a plain script (make check)
+"""
+import json
+import os
+import stat
+import sys
+import tempfile
+
+PATH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.append(PATH_SCRIPT)
+import Accessory_Functions
+
+
+# ------------------------------------------------------------------ #
+# a fake STAR which prints its help and counts how often it was called
+def write_tool(path, counter):
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\n')
+        f.write('echo x >> ' + counter + '\n')
+        f.write('printf "usage\\nrunThreadN N\\nsoloType type\\noutSAMtype type\\n"\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+def count_calls(counter):
+    if not os.path.isfile(counter):
+        return(0)
+    with open(counter) as f:
+        return(len(f.readlines()))
+
+def setup_module_globals(tmpdir, tool):
+    Accessory_Functions.config   = {'locations' : {'output-dir' : os.path.join(tmpdir, 'out')}}
+    Accessory_Functions.SOFTWARE = {'STAR' : {'executable' : tool, 'help' : '-h'}}
+    Accessory_Functions.TOOL_PARAMS_MEMO.clear()
+
+
+# ------------------------------------------------------------------ #
+def test_tool_help_is_parsed_once_per_version():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tool    = os.path.join(tmpdir, 'tool')
+        counter = os.path.join(tmpdir, 'calls')
+        write_tool(tool, counter)
+        setup_module_globals(tmpdir, tool)
+
+        params = Accessory_Functions.join_params('STAR', None, {'runThreadN' : 4, 'soloType' : 'Droplet'})
+        assert sorted(params.split(' ')) == sorted(['--runThreadN', '4', '--soloType', 'Droplet'])
+        assert count_calls(counter) == 1
+
+        # memoized in the process
+        Accessory_Functions.join_params('STAR', None, {'outSAMtype' : 'BAM'})
+        assert count_calls(counter) == 1
+
+        # cached on disk for a new process
+        Accessory_Functions.TOOL_PARAMS_MEMO.clear()
+        assert Accessory_Functions.join_params('STAR', None, {'outSAMtype' : 'BAM'}) == '--outSAMtype BAM'
+        assert count_calls(counter) == 1
+        with open(Accessory_Functions.get_tool_params_cache_path()) as f:
+            cache = json.load(f)
+        assert len(cache) == 1 and os.path.realpath(tool) in list(cache.keys())[0]
+
+        # a new version of the tool is parsed again
+        Accessory_Functions.TOOL_PARAMS_MEMO.clear()
+        stat_tool = os.stat(tool)
+        os.utime(tool, ns = (stat_tool.st_atime_ns, stat_tool.st_mtime_ns + 10 ** 9))
+        Accessory_Functions.join_params('STAR', None, {'outSAMtype' : 'BAM'})
+        assert count_calls(counter) == 2
+
+# ------------------------------------------------------------------ #
+def test_no_parameters_do_not_call_the_tool():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tool    = os.path.join(tmpdir, 'tool')
+        counter = os.path.join(tmpdir, 'calls')
+        write_tool(tool, counter)
+        setup_module_globals(tmpdir, tool)
+
+        assert Accessory_Functions.join_params('STAR', None, None) == ''
+        assert count_calls(counter) == 0
+
+
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+    test_tool_help_is_parsed_once_per_version()
+    test_no_parameters_do_not_call_the_tool()
+    print('OK')
@@ -0,0 +1,119 @@
+"""
+Tests for the cell index and the block iterators - scripts/cell_index.py
+
+Can be run either with pytest or as a plain script (make check)
+"""
+import os
+import sys
+import tempfile
+
+import numpy
+
+PATH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.append(PATH_SCRIPT)
+import cell_index
+import combine_loom_matrices
+import loom_IO
+
+GENES   = 30
+SAMPLES = {'WT_1' : (23, 'WT'), 'KO_1' : (41, 'KO'), 'WT_2' : (12, 'WT')}
+
+
+# ------------------------------------------------------------------ #
+# writes one loom file per sample and combines them, as the pipeline does
+def write_combined_loom(tmpdir):
+    input_files = []
+    for index, (sample, (ncells, condition)) in enumerate(SAMPLES.items()):
+        rng      = numpy.random.RandomState(index)
+        filename = os.path.join(tmpdir, sample + '.loom')
+        with loom_IO.LoomWriter(filename, file_attrs = {'gene_order' : 'order', 'min_umi' : 0}) as writer:
+            writer.add_columns({name : rng.randint(0, 50, size = (GENES, ncells)).astype(numpy.uint16) for name in ['', 'Spliced']})
+            writer.row_attrs = {'gene_id' : numpy.array(['gene' + str(i) for i in range(GENES)])}
+            writer.col_attrs = {
+                'cell_id'     : numpy.array([sample + '_cell' + str(i) for i in range(ncells)]),
+                'sample_name' : numpy.repeat(sample, ncells),
+                'condition'   : numpy.repeat(condition, ncells)
+            }
+        input_files.append(filename)
+
+    loom_file = os.path.join(tmpdir, 'genome_UMI.loom')
+    combine_loom_matrices.combine_loom_files(input_files, loom_file, batch_size = 16)
+    return(loom_file)
+
+# ------------------------------------------------------------------ #
+def read_all(loom_file, layer = ''):
+    blocks = list(cell_index.iter_cells(loom_file, block_size = 10 ** 6, layer = layer))
+    return(blocks[0])
+
+
+# ------------------------------------------------------------------ #
+def test_index_maps_cells_to_columns():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        loom_file  = write_combined_loom(tmpdir)
+        index_file = cell_index.write_cell_index(loom_file)
+        assert index_file == os.path.join(tmpdir, 'genome_UMI.cell_index.tsv')
+
+        index = cell_index.CellIndex(index_file)
+        assert len(index) == sum([ncells for ncells, condition in SAMPLES.values()])
+        assert index.samples == list(SAMPLES.keys())
+        assert index.files == [loom_file]
+
+        rows = index.lookup(['KO_1_cell3', 'WT_1_cell0'])
+        assert list(rows['column']) == [23 + 3, 0]
+        assert list(rows['sample']) == ['KO_1', 'WT_1']
+        try:
+            index.lookup(['unknown'])
+            assert False, 'unknown cell was found'
+        except KeyError:
+            pass
+
+# ------------------------------------------------------------------ #
+def test_iter_cells_blocks_and_filters():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        loom_file         = write_combined_loom(tmpdir)
+        cell_ids, matrix  = read_all(loom_file, 'Spliced')
+
+        blocks = list(cell_index.iter_cells(loom_file, block_size = 7, layer = 'Spliced'))
+        assert all([block.shape == (GENES, 7) for ids, block in blocks[:-1]])
+        assert numpy.array_equal(numpy.concatenate([block for ids, block in blocks], axis = 1), matrix)
+        assert list(numpy.concatenate([ids for ids, block in blocks])) == list(cell_ids)
+
+        # sample filter
+        blocks = list(cell_index.iter_cells(loom_file, block_size = 5, samples = ['KO_1']))
+        ids    = numpy.concatenate([ids for ids, block in blocks])
+        assert len(ids) == 41 and all([cell_id.startswith('KO_1') for cell_id in ids])
+
+        # covariate filters: a value, and a function of the attribute values
+        selected = numpy.concatenate([ids for ids, block in cell_index.iter_cells(loom_file, filters = {'condition' : 'WT'})])
+        assert len(selected) == 23 + 12
+        selected = list(cell_index.iter_cells(loom_file, block_size = 4, layer = 'Spliced',
+            filters = {'condition' : lambda values: values == 'WT', 'cell_id' : lambda values: numpy.char.endswith(values.astype(str), '1')}))
+        columns  = [i for i, cell_id in enumerate(cell_ids) if cell_id.startswith('WT') and cell_id.endswith('1')]
+        assert numpy.array_equal(numpy.concatenate([block for ids, block in selected], axis = 1), matrix[:, columns])
+
+# ------------------------------------------------------------------ #
+def test_iter_genes_and_index_iteration():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        loom_file        = write_combined_loom(tmpdir)
+        cell_ids, matrix = read_all(loom_file)
+        columns          = [i for i, cell_id in enumerate(cell_ids) if cell_id.startswith('WT_2')]
+
+        blocks = list(cell_index.iter_genes(loom_file, block_size = 8, samples = ['WT_2']))
+        assert [len(ids) for ids, block in blocks] == [8, 8, 8, 6]
+        assert numpy.array_equal(numpy.concatenate([block for ids, block in blocks], axis = 0), matrix[:, columns])
+
+        # sparse selection of cells through the index
+        index  = cell_index.CellIndex(cell_index.write_cell_index(loom_file))
+        wanted = ['KO_1_cell40', 'WT_1_cell2', 'WT_2_cell11']
+        blocks = list(index.iter_cells(cell_ids = wanted, block_size = 2))
+        assert list(numpy.concatenate([ids for ids, block in blocks])) == ['WT_1_cell2', 'KO_1_cell40', 'WT_2_cell11']
+        columns = list(index.lookup(['WT_1_cell2', 'KO_1_cell40', 'WT_2_cell11'])['column'])
+        assert numpy.array_equal(numpy.concatenate([block for ids, block in blocks], axis = 1), matrix[:, columns])
+
+
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+    test_index_maps_cells_to_columns()
+    test_iter_cells_blocks_and_filters()
+    test_iter_genes_and_index_iteration()
+    print('OK')
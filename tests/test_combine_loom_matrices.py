@@ -0,0 +1,207 @@
+"""
+Tests for the combination of loom files - scripts/combine_loom_matrices.py
+
+Can be run either with pytest or as a plain script (make check)
+"""
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+
+import loompy
+import numpy
+
+PATH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.append(PATH_SCRIPT)
+import combine_loom_matrices
+
+GENE_IDS = numpy.array(['G' + str(i) for i in range(7)])
+
+
+# ------------------------------------------------------------------ #
+# loom file of a sample, as written by the conversion: the rows are the genes
+# in the given order, layers maps the layer names to their dtypes
+def make_loom(path, sample, ncells, order = None, layers = None, gene_order = 'canonical', min_umi = 0, seed = 1):
+    rng    = numpy.random.RandomState(seed)
+    order  = numpy.arange(len(GENE_IDS)) if order is None else numpy.array(order)
+    layers = {'' : 'int32', 'Spliced' : 'uint16', 'Unspliced' : 'uint16'} if layers is None else layers
+    counts = rng.randint(0, 40, size = (len(GENE_IDS), ncells))
+    matrices = {name : (counts[order] // (index + 1)).astype(dtype) for index, (name, dtype) in enumerate(layers.items())}
+
+    row_attrs = {'gene_id' : GENE_IDS[order], 'gene_name' : numpy.char.add('name_', GENE_IDS[order])}
+    col_attrs = {
+        'cell_id'     : numpy.array([sample + '_' + str(i) for i in range(ncells)]),
+        'sample_name' : numpy.array([sample] * ncells),
+        'nUMI'        : counts.sum(axis = 0)
+    }
+    file_attrs = {'min_umi' : min_umi}
+    if gene_order is not None:
+        file_attrs['gene_order'] = gene_order
+    loompy.create(path, matrices, row_attrs, col_attrs, file_attrs = file_attrs)
+    return(path)
+
+# ------------------------------------------------------------------ #
+def read_loom(path):
+    with loompy.connect(path, 'r') as ds:
+        return({
+            'layers'    : {name : ds.layers[name][:, :] for name in ds.layers.keys()},
+            'row_attrs' : {name : ds.ra[name] for name in ds.ra.keys()},
+            'col_attrs' : {name : ds.ca[name] for name in ds.ca.keys()},
+            'attrs'     : {name : ds.attrs[name] for name in ds.attrs.keys()}
+        })
+
+# ------------------------------------------------------------------ #
+# compares every layer, row and column attribute with loompy.combine, which
+# orders the rows as the first file; the layers have the widest input dtype
+def assert_same_as_loompy(output_file, input_files, tmpdir):
+    reference_file = os.path.join(tmpdir, 'reference.loom')
+    if os.path.exists(reference_file):
+        os.remove(reference_file)
+    loompy.combine(input_files, reference_file, key = 'gene_id')
+    combined  = read_loom(output_file)
+    reference = read_loom(reference_file)
+
+    assert sorted(combined['layers'].keys()) == sorted(reference['layers'].keys())
+    for name, layer in reference['layers'].items():
+        assert numpy.array_equal(combined['layers'][name], layer), name
+        dtypes = [numpy.dtype(read_loom(path)['layers'][name].dtype) for path in input_files]
+        assert combined['layers'][name].dtype == numpy.result_type(*dtypes), name
+    for group in ['row_attrs', 'col_attrs']:
+        assert sorted(combined[group].keys()) == sorted(reference[group].keys())
+        for name, values in reference[group].items():
+            assert numpy.array_equal(combined[group][name], values), name
+    return(combined)
+
+# ------------------------------------------------------------------ #
+# runs the incremental combination, returns its output
+def combine_incremental(input_files, output_file, store_file, batch_size = 4):
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+        combine_loom_matrices.combine_loom_files_incremental(input_files, output_file, store_file, batch_size = batch_size)
+    return(stdout.getvalue())
+
+
+# ------------------------------------------------------------------ #
+def test_rows_are_matched_and_layers_widened():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        input_files = [
+            make_loom(os.path.join(tmpdir, 'A.loom'), 'A', 9, seed = 1, gene_order = None, min_umi = 3),
+            # different row order and wider layers
+            make_loom(os.path.join(tmpdir, 'B.loom'), 'B', 5, order = [3, 6, 0, 1, 5, 2, 4], seed = 2, gene_order = None,
+                layers = {'' : 'int64', 'Spliced' : 'uint32', 'Unspliced' : 'uint8'}),
+            make_loom(os.path.join(tmpdir, 'C.loom'), 'C', 1, order = [6, 5, 4, 3, 2, 1, 0], seed = 3, gene_order = 'other',
+                layers = {'' : 'float32', 'Spliced' : 'uint16', 'Unspliced' : 'uint16'}, min_umi = 1)
+        ]
+        output_file = os.path.join(tmpdir, 'combined.loom')
+        for batch_size in [1, 4, 100]:
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            combine_loom_matrices.combine_loom_files(input_files, output_file, batch_size = batch_size)
+            combined = assert_same_as_loompy(output_file, input_files, tmpdir)
+            assert combined['layers'][''].dtype == numpy.float64
+            assert combined['attrs']['min_umi'] == 0
+            assert not 'gene_order' in combined['attrs']
+
+# ------------------------------------------------------------------ #
+def test_files_with_the_same_gene_order_are_appended():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        input_files = [
+            make_loom(os.path.join(tmpdir, 'A.loom'), 'A', 6, seed = 1, min_umi = 2),
+            make_loom(os.path.join(tmpdir, 'B.loom'), 'B', 3, seed = 2, min_umi = 5, layers = {'' : 'uint8', 'Spliced' : 'int64', 'Unspliced' : 'uint16'})
+        ]
+        output_file = os.path.join(tmpdir, 'combined.loom')
+        combine_loom_matrices.combine_loom_files(input_files, output_file, batch_size = 4)
+        combined = assert_same_as_loompy(output_file, input_files, tmpdir)
+        assert combined['attrs']['gene_order'] == 'canonical'
+        assert combined['attrs']['min_umi'] == 2
+
+# ------------------------------------------------------------------ #
+def test_incremental_append_matches_a_full_combination():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        input_files = [make_loom(os.path.join(tmpdir, name + '.loom'), name, 5 + index, seed = index)
+            for index, name in enumerate(['A', 'B', 'C'])]
+        output_file = os.path.join(tmpdir, 'combined.loom')
+        store_file  = os.path.join(tmpdir, '.combined.loom.store')
+
+        assert 'Rebuilding' in combine_incremental(input_files[:2], output_file, store_file)
+        assert_same_as_loompy(output_file, input_files[:2], tmpdir)
+        # the previous output is moved away - the append must not change it
+        previous_file = os.path.join(tmpdir, 'previous.loom')
+        os.rename(output_file, previous_file)
+
+        assert 'Appending 1 new files' in combine_incremental(input_files, output_file, store_file)
+        combined = assert_same_as_loompy(output_file, input_files, tmpdir)
+        assert json.loads(combined['attrs']['sources']) == {path : combine_loom_matrices.get_checksum(path) for path in input_files}
+        assert_same_as_loompy(previous_file, input_files[:2], tmpdir)
+        assert not os.path.exists(store_file + '.tmp') and not os.path.exists(output_file + '.tmp')
+
+        # nothing new to append
+        assert 'Appending 0 new files' in combine_incremental(input_files, output_file, store_file)
+        assert_same_as_loompy(output_file, input_files, tmpdir)
+
+# ------------------------------------------------------------------ #
+def test_incremental_rebuilds_after_a_changed_file():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        input_files = [make_loom(os.path.join(tmpdir, name + '.loom'), name, 4, seed = index)
+            for index, name in enumerate(['A', 'B'])]
+        output_file = os.path.join(tmpdir, 'combined.loom')
+        store_file  = os.path.join(tmpdir, '.combined.loom.store')
+        combine_incremental(input_files, output_file, store_file)
+
+        os.remove(input_files[0])
+        make_loom(input_files[0], 'A', 6, seed = 10)
+        assert 'Rebuilding' in combine_incremental(input_files, output_file, store_file)
+        assert_same_as_loompy(output_file, input_files, tmpdir)
+
+        # a file which was removed from the input files
+        assert 'Rebuilding' in combine_incremental(input_files[1:], output_file, store_file)
+        assert_same_as_loompy(output_file, input_files[1:], tmpdir)
+
+# ------------------------------------------------------------------ #
+def test_incremental_rebuilds_for_a_wider_dtype():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        input_files = [
+            make_loom(os.path.join(tmpdir, 'A.loom'), 'A', 4, seed = 1),
+            make_loom(os.path.join(tmpdir, 'B.loom'), 'B', 3, seed = 2, layers = {'' : 'int32', 'Spliced' : 'uint32', 'Unspliced' : 'uint8'})
+        ]
+        output_file = os.path.join(tmpdir, 'combined.loom')
+        store_file  = os.path.join(tmpdir, '.combined.loom.store')
+        combine_incremental(input_files[:1], output_file, store_file)
+
+        messages = combine_incremental(input_files, output_file, store_file)
+        assert "wider dtype for layer 'Spliced'" in messages and 'Rebuilding' in messages
+        combined = assert_same_as_loompy(output_file, input_files, tmpdir)
+        assert combined['layers']['Spliced'].dtype == numpy.uint32
+        assert combined['layers']['Unspliced'].dtype == numpy.uint16
+
+# ------------------------------------------------------------------ #
+def test_incremental_rebuilds_after_an_interrupted_append():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        input_files = [make_loom(os.path.join(tmpdir, name + '.loom'), name, 4, seed = index)
+            for index, name in enumerate(['A', 'B', 'C'])]
+        output_file = os.path.join(tmpdir, 'combined.loom')
+        store_file  = os.path.join(tmpdir, '.combined.loom.store')
+        combine_incremental(input_files[:2], output_file, store_file)
+
+        # a store which was marked as incomplete, and a left over temporary file
+        with loompy.connect(store_file, 'r+') as ds:
+            ds.attrs['sources'] = ''
+        with open(store_file + '.tmp', 'w') as f:
+            f.write('partial')
+
+        assert 'Rebuilding' in combine_incremental(input_files, output_file, store_file)
+        assert_same_as_loompy(output_file, input_files, tmpdir)
+        assert not os.path.exists(store_file + '.tmp')
+
+
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+    test_rows_are_matched_and_layers_widened()
+    test_files_with_the_same_gene_order_are_appended()
+    test_incremental_append_matches_a_full_combination()
+    test_incremental_rebuilds_after_a_changed_file()
+    test_incremental_rebuilds_for_a_wider_dtype()
+    test_incremental_rebuilds_after_an_interrupted_append()
+    print('OK')
@@ -0,0 +1,119 @@
+"""
+Tests for the conversion of the STARsolo output to loom files -
+scripts/convert_matrix_from_mtx_to_loom.py
+
+Can be run either with pytest or as a plain script (make check)
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+import loompy
+import numpy
+import pandas
+
+PATH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.append(PATH_SCRIPT)
+import convert_matrix_from_mtx_to_loom
+import gene_index
+
+# gene index of the genome; G2 and G4 are missing from the STARsolo output,
+# which contains XA and XB - genes which are not in the index
+GENE_IDS = ['G0', 'G1', 'G2', 'G3', 'G4', 'G5']
+FEATURES = ['G3', 'XB', 'G0', 'G5', 'XA', 'G1']
+BARCODES = ['AAAA', 'CCCC', 'GGGG', 'TTTT', 'ACGT']
+
+STAR_OUTPUT_TYPES_KEYS = ['Gene', 'Velocyto', 'Velocyto', 'Velocyto']
+STAR_OUTPUT_TYPES_VALS = ['Counts', 'Spliced', 'Unspliced', 'Ambiguous']
+
+
+# ------------------------------------------------------------------ #
+# writes a STARsolo output directory: features, barcodes and a matrix.mtx
+# with one value column per matrix; returns the dense matrices
+def write_star_output(path, nvalues, seed):
+    rng      = numpy.random.RandomState(seed)
+    matrices = rng.randint(0, 30, size = (nvalues, len(FEATURES), len(BARCODES))) * (rng.rand(nvalues, len(FEATURES), len(BARCODES)) < 0.5)
+    # an empty cell
+    matrices[:, :, 3] = 0
+    os.makedirs(path)
+    with open(os.path.join(path, 'features.tsv'), 'w') as f:
+        f.write(''.join([gene_id + '\t' + gene_id + '\n' for gene_id in FEATURES]))
+    with open(os.path.join(path, 'barcodes.tsv'), 'w') as f:
+        f.write(''.join([barcode + '\n' for barcode in BARCODES]))
+
+    rows, cols = numpy.nonzero(matrices.any(axis = 0))
+    with open(os.path.join(path, 'matrix.mtx'), 'w') as f:
+        f.write('%%MatrixMarket matrix coordinate integer general\n%\n')
+        f.write('{} {} {}\n'.format(len(FEATURES), len(BARCODES), len(rows)))
+        for row, col in zip(rows, cols):
+            f.write(' '.join([str(row + 1), str(col + 1)] + [str(value) for value in matrices[:, row, col]]) + '\n')
+    return(matrices)
+
+# ------------------------------------------------------------------ #
+def get_args(**kwargs):
+    args = {
+        'star_output_types_keys' : STAR_OUTPUT_TYPES_KEYS,
+        'star_output_types_vals' : STAR_OUTPUT_TYPES_VALS,
+        'threads'                : 2,
+        'batch_size'             : 2,
+        'min_umi'                : 0,
+        'chunks'                 : [4, 4],
+        'compression'            : 'gzip',
+        'compression_level'      : 2,
+        'shuffle'                : False
+    }
+    args.update(kwargs)
+    return(argparse.Namespace(**args))
+
+# ------------------------------------------------------------------ #
+# reference: the dense conversion - the matrix is filled with zero rows for
+# the missing genes; returns the rows of each layer by gene id
+def convert_dense_reference(star_matrices):
+    reference = {}
+    for name, matrix in star_matrices.items():
+        missing = sorted(set(GENE_IDS) - set(FEATURES))
+        matrix  = numpy.vstack((matrix, numpy.zeros((len(missing), len(BARCODES)), dtype = int)))
+        reference[name] = dict(zip(FEATURES + missing, matrix))
+    return(reference)
+
+
+# ------------------------------------------------------------------ #
+def test_conversion_matches_the_dense_reference():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        gene  = write_star_output(os.path.join(tmpdir, 'S1', 'Gene', 'raw'), 1, seed = 1)
+        velo  = write_star_output(os.path.join(tmpdir, 'S1', 'Velocyto', 'raw'), 3, seed = 2)
+        star_matrices = {'' : gene[0], 'Spliced' : velo[0], 'Unspliced' : velo[1], 'Ambiguous' : velo[2]}
+        reference     = convert_dense_reference(star_matrices)
+        sample_sheet  = pandas.DataFrame({'sample_name' : ['S1', 'S2'], 'condition' : ['a', 'b']})
+
+        output_file = os.path.join(tmpdir, 'S1.loom')
+        convert_matrix_from_mtx_to_loom.convert_sample('S1', os.path.join(tmpdir, 'S1'), output_file, GENE_IDS, sample_sheet, get_args())
+
+        with loompy.connect(output_file, 'r') as ds:
+            # canonical gene order: the index, followed by the sorted other genes
+            gene_ids = list(ds.ra['gene_id'])
+            assert gene_ids == GENE_IDS + ['XA', 'XB']
+            assert ds.attrs['gene_order'] == gene_index.get_gene_order_checksum(gene_ids)
+            assert sorted(ds.layers.keys()) == sorted(star_matrices.keys())
+            for name, rows in reference.items():
+                layer = ds.layers[name][:, :]
+                assert numpy.array_equal(layer, numpy.array([rows[gene_id] for gene_id in gene_ids])), name
+
+            assert list(ds.ca['cell_id'])   == ['S1_' + barcode for barcode in BARCODES]
+            assert list(ds.ca['condition']) == ['a'] * len(BARCODES)
+
+        # the empty cell is removed from all layers
+        output_file = os.path.join(tmpdir, 'S1.min_umi.loom')
+        convert_matrix_from_mtx_to_loom.convert_sample('S1', os.path.join(tmpdir, 'S1'), output_file, GENE_IDS, sample_sheet, get_args(min_umi = 1))
+        with loompy.connect(output_file, 'r') as ds:
+            keep = [index for index in range(len(BARCODES)) if gene[0][:, index].sum() > 0]
+            assert list(ds.ca['cell_id']) == ['S1_' + BARCODES[index] for index in keep]
+            for name, rows in reference.items():
+                assert numpy.array_equal(ds.layers[name][:, :], numpy.array([rows[gene_id][keep] for gene_id in ds.ra['gene_id']])), name
+
+
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+    test_conversion_matches_the_dense_reference()
+    print('OK')
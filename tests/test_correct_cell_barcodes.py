@@ -0,0 +1,106 @@
+"""
+Tests for the cell barcode correction - scripts/correct_cell_barcodes.py
+
+Can be run either with pytest or as a plain script (make check)
+"""
+import os
+import sys
+import tempfile
+
+import numpy
+
+PATH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.append(PATH_SCRIPT)
+import correct_cell_barcodes
+import count_cell_barcodes
+
+
+# ------------------------------------------------------------------ #
+def correct(histogram, max_parents = 10, ratio = 10):
+    barcodes      = list(histogram.keys())
+    counts        = numpy.array(list(histogram.values()))
+    codes, length = correct_cell_barcodes.encode_barcode_strings(barcodes)
+    codes, counts = correct_cell_barcodes.correct_cell_barcodes(codes, counts, length, max_parents, ratio)
+    return(dict(zip(count_cell_barcodes.decode_barcodes(codes, length), counts)))
+
+# ------------------------------------------------------------------ #
+# reference: all pairs of barcodes, compared base by base
+def find_parents_reference(barcodes, counts, max_parents, ratio):
+    parents = sorted(range(len(barcodes)), key = lambda i: -counts[i])[:max_parents]
+    target  = list(range(len(barcodes)))
+    for child in range(len(barcodes)):
+        candidates = [parent for parent in parents
+            if sum([a != b for a, b in zip(barcodes[parent], barcodes[child])]) == 1
+            and counts[parent] >= ratio * counts[child] and counts[parent] > counts[child]]
+        if len(candidates) > 0:
+            target[child] = sorted(candidates, key = lambda i: (-counts[i], i))[0]
+    while [target[i] for i in target] != target:
+        target = [target[i] for i in target]
+    return(target)
+
+
+# ------------------------------------------------------------------ #
+def test_neighbours_are_folded_into_parents():
+    histogram = {
+        'AAAACCCC' : 1000,
+        # one mismatch: folded
+        'AAAACCCA' : 20,
+        'TAAACCCC' : 5,
+        # one mismatch, but too many reads: kept
+        'AAAACCGC' : 500,
+        # two mismatches: kept
+        'AAAACCTT' : 3,
+        # one mismatch from two parents: folded into the larger one
+        'GGGGTTTT' : 400,
+        'GGGATTTT' : 200,
+        'GGGCTTTT' : 10,
+    }
+    corrected = correct(histogram)
+    assert corrected == {'AAAACCCC' : 1025, 'AAAACCGC' : 500, 'GGGGTTTT' : 410, 'GGGATTTT' : 200, 'AAAACCTT' : 3}
+    assert list(corrected.values()) == sorted(corrected.values(), reverse = True)
+    # only the top barcode is a parent
+    assert correct(histogram, max_parents = 1)['GGGGTTTT'] == 400
+
+# ------------------------------------------------------------------ #
+def test_correction_matches_the_reference():
+    rng      = numpy.random.RandomState(2)
+    cells    = [''.join(rng.choice(list('ACGT'), size = 10)) for i in range(30)]
+    barcodes = {cell : int(rng.randint(100, 5000)) for cell in cells}
+    for i in range(2000):
+        barcode = list(cells[rng.randint(len(cells))])
+        for position in rng.choice(10, size = rng.randint(1, 3), replace = False):
+            barcode[position] = rng.choice(list('ACGT'))
+        barcode = ''.join(barcode)
+        barcodes[barcode] = barcodes.get(barcode, 0) + int(rng.randint(1, 300))
+
+    names    = list(barcodes.keys())
+    counts   = numpy.array(list(barcodes.values()))
+    codes, length = correct_cell_barcodes.encode_barcode_strings(names)
+    for max_parents, ratio in [(40, 10), (200, 2), (len(names), 1)]:
+        target    = correct_cell_barcodes.find_parents(codes, counts, length, max_parents, ratio)
+        reference = find_parents_reference(names, counts, max_parents, ratio)
+        assert list(target) == reference
+
+        corrected_codes, corrected_counts = correct_cell_barcodes.correct_cell_barcodes(codes, counts, length, max_parents, ratio)
+        assert corrected_counts.sum() == counts.sum()
+
+# ------------------------------------------------------------------ #
+def test_histogram_file_is_corrected():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        infile  = os.path.join(tmpdir, 'histogram.txt')
+        outfile = os.path.join(tmpdir, 'histogram.corrected.txt')
+        with open(infile, 'w') as f:
+            f.write('ACGTACGT\t900\nACGTACGA\t30\nTTTTACGT\t2\n')
+        barcodes, counts = correct_cell_barcodes.find_absolute_read_cutoff.read_histogram(infile)
+        codes, length    = correct_cell_barcodes.encode_barcode_strings(barcodes)
+        count_cell_barcodes.write_histogram(outfile, *correct_cell_barcodes.correct_cell_barcodes(codes, counts, length, 10), length)
+        with open(outfile) as f:
+            assert f.read() == 'ACGTACGT\t930\nTTTTACGT\t2\n'
+
+
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+    test_neighbours_are_folded_into_parents()
+    test_correction_matches_the_reference()
+    test_histogram_file_is_corrected()
+    print('OK')
@@ -0,0 +1,91 @@
+"""
+Tests for the cell barcode counter - scripts/count_cell_barcodes.py
+
+Can be run either with pytest or as a plain script (make check)
+"""
+import collections
+import gzip
+import os
+import sys
+import tempfile
+
+import numpy
+
+PATH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.append(PATH_SCRIPT)
+import count_cell_barcodes
+
+
+# ------------------------------------------------------------------ #
+# fastq text with reads drawn from a few cell barcodes; some reads are
+# short, contain an N in the barcode or have lowercase bases
+def get_fastq(nreads, seed = 1):
+    rng      = numpy.random.RandomState(seed)
+    barcodes = [''.join(rng.choice(list('ACGT'), size = 12)) for i in range(50)]
+    records  = []
+    for index in range(nreads):
+        sequence = 'TT' + barcodes[rng.randint(len(barcodes))] + ''.join(rng.choice(list('ACGT'), size = 8))
+        if index % 97 == 0:
+            sequence = sequence[:10]
+        if index % 101 == 0:
+            sequence = sequence[:5] + 'N' + sequence[6:]
+        if index % 103 == 0:
+            sequence = sequence.lower()
+        records.append('@read{}\n{}\n+\n{}\n'.format(index, sequence, 'I' * len(sequence)))
+    return(''.join(records))
+
+# ------------------------------------------------------------------ #
+# reference: cuts the barcodes out of the sequences and skips barcodes
+# with other bases, as the perl extraction and jellyfish did
+def count_reference(text, start, length):
+    lines  = text.split('\n')[:-1]
+    counts = collections.Counter()
+    for sequence in lines[1::4]:
+        barcode = sequence[start - 1:start - 1 + length].upper()
+        if len(barcode) == length and set(barcode) <= set('ACGT'):
+            counts[barcode] += 1
+    return(counts)
+
+
+# ------------------------------------------------------------------ #
+def test_counts_match_the_reference():
+    text = get_fastq(5000)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'R1.fastq.gz')
+        # two gzip members
+        with open(path, 'wb') as f:
+            f.write(gzip.compress(text[:len(text) // 3].encode()))
+            f.write(gzip.compress(text[len(text) // 3:].encode()))
+
+        reference = count_reference(text, 3, 12)
+        for block_size, threads in [(50, 1), (4096, 2), (10 ** 6, 1)]:
+            barcodes, counts = count_cell_barcodes.count_cell_barcodes([path], 3, 12, threads = threads, block_size = block_size)
+            barcodes = count_cell_barcodes.decode_barcodes(barcodes, 12)
+            assert dict(zip(barcodes, counts)) == dict(reference)
+            # sorted by the decreasing number of reads
+            assert list(counts) == sorted(counts, reverse = True)
+
+# ------------------------------------------------------------------ #
+def test_histogram_of_several_plain_files():
+    text = get_fastq(1000)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # the last record does not end with a newline
+        paths = [os.path.join(tmpdir, 'R1_' + str(i) + '.fastq') for i in range(2)]
+        for path in paths:
+            with open(path, 'w') as f:
+                f.write(text[:-1])
+
+        barcodes, counts = count_cell_barcodes.count_cell_barcodes(paths, 1, 20, block_size = 1000)
+        outfile = os.path.join(tmpdir, 'histogram.txt')
+        count_cell_barcodes.write_histogram(outfile, barcodes, counts, 20)
+        with open(outfile) as f:
+            histogram = dict([line.rstrip('\n').split('\t') for line in f])
+        reference = count_reference(text, 1, 20)
+        assert {barcode : int(count) for barcode, count in histogram.items()} == {barcode : 2 * count for barcode, count in reference.items()}
+
+
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+    test_counts_match_the_reference()
+    test_histogram_of_several_plain_files()
+    print('OK')
@@ -0,0 +1,72 @@
+"""
+Tests for the cell number cutoff - scripts/find_absolute_read_cutoff.py
+
+Can be run either with pytest or as a plain script (make check)
+"""
+import os
+import sys
+import tempfile
+
+import numpy
+import yaml
+
+PATH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.append(PATH_SCRIPT)
+import find_absolute_read_cutoff
+
+
+# ------------------------------------------------------------------ #
+# histogram of cells with many reads and background barcodes with few,
+# with many ties
+def get_histogram(ncells, nbackground, seed = 1):
+    rng      = numpy.random.RandomState(seed)
+    counts   = numpy.concatenate([rng.randint(500, 2000, size = ncells), rng.randint(1, 20, size = nbackground)])
+    order    = rng.permutation(len(counts))
+    barcodes = numpy.array(['BC' + str(i) for i in range(len(counts))])
+    return(barcodes, counts[order])
+
+# ------------------------------------------------------------------ #
+# reference: the R implementation - stable sort of the whole histogram
+def find_cutoff_reference(barcodes, counts, cutoff):
+    order  = numpy.argsort(-counts, kind = 'stable')
+    cutoff = min(cutoff, len(counts))
+    top    = counts[order][:cutoff]
+    cum    = numpy.cumsum(top) / top.sum()
+    dist   = cum - numpy.arange(1, cutoff + 1) / cutoff
+    knee   = int(numpy.argmax(dist)) + 1
+    return(int(top[knee - 1]), list(barcodes[order][:knee]))
+
+
+# ------------------------------------------------------------------ #
+def test_top_selection_keeps_ties_in_histogram_order():
+    counts   = numpy.array([5, 9, 5, 1, 9, 5, 7])
+    selected = find_absolute_read_cutoff.select_top_barcodes(counts, 4)
+    assert list(selected) == [1, 4, 6, 0]
+    assert list(find_absolute_read_cutoff.select_top_barcodes(counts, 100)) == [1, 4, 6, 0, 2, 5, 3]
+
+# ------------------------------------------------------------------ #
+def test_cutoff_matches_the_reference():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for ncells, nbackground, cutoff in [(300, 20000, 5000), (300, 20000, 50000), (40, 100, 60)]:
+            barcodes, counts = get_histogram(ncells, nbackground)
+            infile = os.path.join(tmpdir, 'histogram.txt')
+            with open(infile, 'w') as f:
+                f.write(''.join([barcode + '\t' + str(count) + '\n' for barcode, count in zip(barcodes, counts)]))
+
+            outfile_yaml = os.path.join(tmpdir, 'ReadCutoff.yaml')
+            outfile_tab  = os.path.join(tmpdir, 'ReadCutoff.txt')
+            knee = find_absolute_read_cutoff.find_absolute_read_cutoff(infile, outfile_yaml, outfile_tab, cutoff)
+
+            reads_cutoff, whitelist = find_cutoff_reference(barcodes, counts, cutoff)
+            with open(outfile_yaml) as f:
+                assert yaml.safe_load(f) == {'reads_cutoff' : reads_cutoff}
+            with open(outfile_tab) as f:
+                assert f.read().split('\n')[:-1] == whitelist
+            assert knee == len(whitelist)
+
+
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+    test_top_selection_keeps_ties_in_histogram_order()
+    test_cutoff_matches_the_reference()
+    print('OK')
@@ -0,0 +1,79 @@
+"""
+Tests for the gene id index - scripts/gene_index.py
+
+Can be run either with pytest or as a plain script (make check)
+"""
+import os
+import sys
+import tempfile
+
+import numpy
+
+PATH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.append(PATH_SCRIPT)
+import gene_index
+
+
+GTF = (
+    '#!genome-build test\n'
+    'chr1\ttest\tgene\t1\t100\t.\t+\t.\tgene_id "G2"; gene_name "B";\n'
+    'chr1\ttest\texon\t1\t100\t.\t+\t.\tgene_id "G2"; transcript_id "T1";\n'
+    'chr1\ttest\tgene\t200\t300\t.\t-\t.\tgene_id "G1"; gene_name "A";\n'
+)
+
+# ------------------------------------------------------------------ #
+def write_index(tmpdir, text = GTF):
+    gtf_file   = os.path.join(tmpdir, 'genome.gtf')
+    index_file = os.path.join(tmpdir, 'genome.gene_index.tsv')
+    with open(gtf_file, 'w') as f:
+        f.write(text)
+    gene_index.write_gene_index(gtf_file, index_file)
+    return(gtf_file, index_file)
+
+
+# ------------------------------------------------------------------ #
+def test_index_keeps_the_gtf_order():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        gtf_file, index_file = write_index(tmpdir)
+        gene_ids, header = gene_index.read_gene_index(index_file)
+        assert gene_ids == ['G2', 'G1']
+        assert header['gtf_md5'] == gene_index.get_file_md5(gtf_file)
+        assert gene_index.load_gene_ids(index_file, gtf_file) == ['G2', 'G1']
+
+# ------------------------------------------------------------------ #
+def test_touched_gtf_uses_the_index():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        gtf_file, index_file = write_index(tmpdir)
+        stat = os.stat(gtf_file)
+        os.utime(gtf_file, (stat.st_atime, stat.st_mtime + 100))
+        assert gene_index.load_gene_ids(index_file, gtf_file) == ['G2', 'G1']
+
+# ------------------------------------------------------------------ #
+def test_stale_index_stops():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        gtf_file, index_file = write_index(tmpdir)
+        with open(gtf_file, 'a') as f:
+            f.write('chr1\ttest\tgene\t400\t500\t.\t+\t.\tgene_id "G3";\n')
+        try:
+            gene_index.load_gene_ids(index_file, gtf_file)
+            assert False, 'a stale gene index is used'
+        except SystemExit as e:
+            assert 'out of date' in str(e) and 'make_gene_index' in str(e)
+        # the index is not checked without the gtf file
+        assert gene_index.load_gene_ids(index_file) == ['G2', 'G1']
+
+# ------------------------------------------------------------------ #
+def test_gene_order_checksum_of_strings_and_bytes():
+    checksum = gene_index.get_gene_order_checksum(['G2', 'G1'])
+    assert gene_index.get_gene_order_checksum(numpy.array([b'G2', b'G1'])) == checksum
+    assert gene_index.get_gene_order_checksum(numpy.array(['G2', 'G1'])) == checksum
+    assert gene_index.get_gene_order_checksum(['G1', 'G2']) != checksum
+
+
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+    test_index_keeps_the_gtf_order()
+    test_touched_gtf_uses_the_index()
+    test_stale_index_stops()
+    test_gene_order_checksum_of_strings_and_bytes()
+    print('OK')
@@ -0,0 +1,108 @@
+"""
+Tests for the custom Matrix Market reader - scripts/matrix_market_IO.py
+
+Can be run either with pytest or as a plain script (make check)
+"""
+import gzip
+import os
+import sys
+import tempfile
+
+import numpy
+
+PATH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.append(PATH_SCRIPT)
+import matrix_market_IO
+
+
+# ------------------------------------------------------------------ #
+# writes a Velocyto-like matrix.mtx: row, column, spliced, unspliced, ambiguous
+def write_velocyto_mtx(path, rows = 50, cols = 40, entries = 300, seed = 1):
+    rng   = numpy.random.RandomState(seed)
+    index = rng.choice(rows * cols, size = entries, replace = False)
+    I     = index % rows + 1
+    J     = index // rows + 1
+    V     = rng.randint(0, 1000, size = (entries, 3))
+
+    lines = ['%%MatrixMarket matrix coordinate integer general', '%', ' '.join(map(str, [rows, cols, entries]))]
+    lines = lines + [' '.join(map(str, [i, j] + list(v))) for i, j, v in zip(I, J, V)]
+    text  = '\n'.join(lines) + '\n'
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt') as f:
+        f.write(text)
+
+# ------------------------------------------------------------------ #
+class SmallBlockMMFile(matrix_market_IO.MMFile):
+    # forces block boundaries in the middle of lines
+    BLOCK_SIZE = 37
+
+# ------------------------------------------------------------------ #
+def assert_same_coo(a, b):
+    assert a.shape == b.shape
+    assert a.dtype == b.dtype
+    numpy.testing.assert_array_equal(a.row,  b.row)
+    numpy.testing.assert_array_equal(a.col,  b.col)
+    numpy.testing.assert_array_equal(a.data, b.data)
+
+# ------------------------------------------------------------------ #
+def test_engines_give_identical_coo():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for filename in ['matrix.mtx', 'matrix.mtx.gz']:
+            path = os.path.join(tmpdir, filename)
+            write_velocyto_mtx(path)
+            for column_to_read in [2, 3, 4]:
+                python_coo = matrix_market_IO.mmread_pigx(path, column_to_read = column_to_read, engine = 'python')
+                numpy_coo  = matrix_market_IO.mmread_pigx(path, column_to_read = column_to_read, engine = 'numpy')
+                assert_same_coo(python_coo, numpy_coo)
+
+                small_coo  = SmallBlockMMFile().read(path, column_to_read = column_to_read, engine = 'numpy')
+                assert_same_coo(python_coo, small_coo)
+
+# ------------------------------------------------------------------ #
+def test_multi_column_read_matches_single_column_reads():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'matrix.mtx')
+        write_velocyto_mtx(path)
+        for engine in ['numpy', 'python']:
+            matrices = matrix_market_IO.mmread_pigx_multi(path, columns = [2, 3, 4], engine = engine)
+            assert len(matrices) == 3
+            for column_to_read, matrix in zip([2, 3, 4], matrices):
+                assert_same_coo(matrix_market_IO.mmread_pigx(path, column_to_read = column_to_read), matrix)
+
+# ------------------------------------------------------------------ #
+def test_engine_detects_wrong_number_of_entries():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'matrix.mtx')
+        write_velocyto_mtx(path)
+        with open(path) as f:
+            lines = f.read().splitlines()
+
+        for entries in [299, 301]:
+            lines[2] = '50 40 ' + str(entries)
+            with open(path, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            for engine in ['numpy', 'python']:
+                try:
+                    matrix_market_IO.mmread_pigx(path, engine = engine)
+                except ValueError:
+                    continue
+                raise AssertionError('wrong number of entries not detected')
+
+# ------------------------------------------------------------------ #
+def test_downcast_uses_smallest_unsigned_dtype():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'matrix.mtx')
+        write_velocyto_mtx(path)
+        for engine in ['numpy', 'python']:
+            matrix  = matrix_market_IO.mmread_pigx(path, engine = engine)
+            compact = matrix_market_IO.mmread_pigx(path, engine = engine, downcast = True)
+            assert compact.dtype == numpy.uint16
+            numpy.testing.assert_array_equal(matrix.toarray(), compact.toarray())
+
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+    test_engines_give_identical_coo()
+    test_multi_column_read_matches_single_column_reads()
+    test_engine_detects_wrong_number_of_entries()
+    test_downcast_uses_smallest_unsigned_dtype()
@@ -0,0 +1,120 @@
+"""
+Tests for the barcode read validation - scripts/validate_barcode_reads.py
+
+Can be run either with pytest or as a plain script (make check)
+"""
+import gzip
+import os
+import sys
+import tempfile
+
+import numpy
+
+PATH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.append(PATH_SCRIPT)
+import validate_barcode_reads
+
+
+# ------------------------------------------------------------------ #
+# fastq text with the given read lengths; the quality of a read has the
+# length of its sequence unless given
+def get_fastq(lengths, quality_lengths = None, seed = 1):
+    rng = numpy.random.RandomState(seed)
+    if quality_lengths is None:
+        quality_lengths = lengths
+    records = []
+    for index, (length, quality_length) in enumerate(zip(lengths, quality_lengths)):
+        sequence = ''.join(rng.choice(list('ACGTN'), size = length))
+        records.append('@read{}\n{}\n+\n{}\n'.format(index, sequence, 'I' * quality_length))
+    return(''.join(records).encode())
+
+# ------------------------------------------------------------------ #
+def write_gzip(path, *members):
+    # every argument is written as a separate gzip member
+    with open(path, 'wb') as f:
+        for member in members:
+            f.write(gzip.compress(member))
+    return(path)
+
+# ------------------------------------------------------------------ #
+# reference: counts the reads with the wrong length line by line
+def count_wrong_reads(text, read_length):
+    lines = text.decode().split('\n')[:-1]
+    return(sum([len(lines[i + 1]) != read_length or len(lines[i + 3]) != read_length for i in range(0, len(lines), 4)]))
+
+
+# ------------------------------------------------------------------ #
+def test_profile_counts_all_reads_across_blocks():
+    rng     = numpy.random.RandomState(3)
+    lengths = list(numpy.where(rng.rand(5000) < 0.01, rng.randint(5, 30, size = 5000), 20))
+    text    = get_fastq(lengths)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # two gzip members, and blocks which end in the middle of lines
+        path = write_gzip(os.path.join(tmpdir, 'R1.fastq.gz'), text[:len(text) // 3], text[len(text) // 3:])
+        for block_size in [7, 4096, 10 ** 6]:
+            profile = validate_barcode_reads.profile_fastq(path, 20, block_size = block_size)
+            assert profile['reads'] == 5000
+            assert profile['wrong_length'] == count_wrong_reads(text, 20)
+            assert profile['sequence_lengths'] == {int(k) : int(v) for k, v in zip(*numpy.unique(lengths, return_counts = True))}
+            assert profile['quality_lengths'] == profile['sequence_lengths']
+            assert not profile['truncated'] and not profile['incomplete_record'] and profile['error'] == ''
+
+# ------------------------------------------------------------------ #
+def test_quality_length_mismatch_is_wrong():
+    text = get_fastq([12] * 10, [12] * 9 + [11])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path   = write_gzip(os.path.join(tmpdir, 'R1.fastq.gz'), text)
+        report = validate_barcode_reads.validate_barcode_reads([path], 12)
+        assert report['wrong_length'] == 1
+        assert not report['passed']
+        # passes with a tolerance
+        assert validate_barcode_reads.validate_barcode_reads([path], 12, max_wrong_fraction = 0.1)['passed']
+
+# ------------------------------------------------------------------ #
+def test_truncated_and_incomplete_files_fail():
+    text = get_fastq([20] * 2000)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        complete  = write_gzip(os.path.join(tmpdir, 'complete.fastq.gz'), text)
+        truncated = os.path.join(tmpdir, 'truncated.fastq.gz')
+        with open(complete, 'rb') as f, open(truncated, 'wb') as g:
+            g.write(f.read()[:-100])
+        # the gzip file is complete, the last fastq record ends in its sequence line
+        incomplete = write_gzip(os.path.join(tmpdir, 'incomplete.fastq.gz'), text[:-30])
+
+        report = validate_barcode_reads.validate_barcode_reads([complete, truncated, incomplete], 20, threads = 2)
+        profiles = {os.path.basename(profile['file']) : profile for profile in report['files']}
+        assert report['passed'] is False
+        assert profiles['complete.fastq.gz']['reads'] == 2000
+        assert profiles['truncated.fastq.gz']['truncated']
+        assert profiles['incomplete.fastq.gz']['incomplete_record'] and not profiles['incomplete.fastq.gz']['truncated']
+        assert len(report['errors']) == 2
+
+        assert validate_barcode_reads.validate_barcode_reads([complete], 20)['passed']
+
+# ------------------------------------------------------------------ #
+def test_last_record_without_newline_is_complete():
+    text = get_fastq([20] * 100)[:-1]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = write_gzip(os.path.join(tmpdir, 'R1.fastq.gz'), text)
+        for block_size in [7, len(text), 10 ** 6]:
+            profile = validate_barcode_reads.profile_fastq(path, 20, block_size = block_size)
+            assert profile['reads'] == 100 and profile['wrong_length'] == 0
+            assert not profile['incomplete_record']
+
+        path   = write_gzip(os.path.join(tmpdir, 'R1.single.fastq.gz'), b'@r1\nACGTACGT\n+\nIIIIIIII')
+        report = validate_barcode_reads.validate_barcode_reads([path], 8)
+        assert report['passed'] and report['reads'] == 1
+
+        # an unterminated quality line of the wrong length is a wrong read
+        path    = write_gzip(os.path.join(tmpdir, 'R1.short.fastq.gz'), b'@r1\nACGTACGT\n+\nIIII')
+        profile = validate_barcode_reads.profile_fastq(path, 8)
+        assert profile['reads'] == 1 and profile['wrong_length'] == 1 and not profile['incomplete_record']
+
+
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+    test_profile_counts_all_reads_across_blocks()
+    test_quality_length_mismatch_is_wrong()
+    test_truncated_and_incomplete_files_fail()
+    test_last_record_without_newline_is_complete()
+    print('OK')
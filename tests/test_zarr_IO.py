@@ -0,0 +1,174 @@
+"""
+Tests for the zarr store of the count matrices - scripts/zarr_IO.py
+
+Several samples are written concurrently, by separate processes, into one
+store on the local file system, and are read back as a combined matrix.
+
+Can be run either with pytest or as a plain script (make check)
+"""
+import concurrent.futures
+import multiprocessing
+import os
+import sys
+import tempfile
+
+import numpy
+
+PATH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+sys.path.append(PATH_SCRIPT)
+import zarr_IO
+
+# zarr is optional - exit code 77 marks a skipped test for make check
+if zarr_IO.zarr is None:
+    if __name__ == '__main__':
+        print('zarr is not installed - skipping')
+        sys.exit(77)
+    import pytest
+    pytest.skip('zarr is not installed', allow_module_level = True)
+
+GENES      = 70
+BATCH_SIZE = 16
+GENE_ORDER = 'gene_order_checksum'
+STORAGE    = {'chunks' : [32, 8], 'compression' : 'gzip', 'compression_level' : 2, 'shuffle' : True}
+
+
+# ------------------------------------------------------------------ #
+# the counts of each sample are derived from its index, so that the
+# writer processes and the test can generate the same matrices
+def get_sample(index):
+    rng    = numpy.random.RandomState(index)
+    ncells = [45, 0, 17, 64, 33][index % 5]
+    layers = {name : rng.randint(0, 300, size = (GENES, ncells)).astype(numpy.uint16) for name in ['', 'Spliced', 'Unspliced']}
+    cells  = numpy.array(['S' + str(index) + '_cell' + str(i) for i in range(ncells)])
+    return(layers, cells)
+
+# ------------------------------------------------------------------ #
+# writes one sample in column blocks, as the conversion jobs do
+def write_sample(store, index):
+    layers, cells = get_sample(index)
+    with zarr_IO.ZarrSampleWriter(store, 'S' + str(index), storage = STORAGE, file_attrs = {'gene_order' : GENE_ORDER}) as writer:
+        for start in range(0, max(len(cells), 1), BATCH_SIZE):
+            writer.add_columns({name : layer[:, start:start + BATCH_SIZE] for name, layer in layers.items()})
+        writer.row_attrs = {'gene_id' : numpy.array(['gene' + str(i) for i in range(GENES)])}
+        writer.col_attrs = {'cell_id' : cells, 'nUMI' : layers[''].sum(axis = 0)}
+    return(len(cells))
+
+# ------------------------------------------------------------------ #
+def write_samples_concurrently(store, indices):
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers = len(indices), mp_context = context) as executor:
+        futures = [executor.submit(write_sample, store, index) for index in indices]
+        return([future.result() for future in futures])
+
+
+# ------------------------------------------------------------------ #
+# opens a writer as soon as all processes are ready, so that the root and
+# samples groups of a new store are created at the same time
+def open_writer_at_barrier(store, index, barrier):
+    barrier.wait()
+    zarr_IO.ZarrSampleWriter(store, 'S' + str(index)).close()
+    return(index)
+
+
+# ------------------------------------------------------------------ #
+def test_writers_create_a_new_store_at_the_same_time():
+    nprocesses = 6
+    context    = multiprocessing.get_context('spawn')
+    with context.Manager() as manager, tempfile.TemporaryDirectory() as tmpdir:
+        barrier = manager.Barrier(nprocesses)
+        with concurrent.futures.ProcessPoolExecutor(max_workers = nprocesses, mp_context = context) as executor:
+            for repeat in range(5):
+                store   = os.path.join(tmpdir, str(repeat) + '.zarr')
+                futures = [executor.submit(open_writer_at_barrier, store, index, barrier) for index in range(nprocesses)]
+                assert [future.result() for future in futures] == list(range(nprocesses))
+                samples = zarr_IO.zarr.open_group(store, mode = 'r')['samples']
+                assert sorted(samples.group_keys()) == ['S' + str(index) for index in range(nprocesses)]
+
+# ------------------------------------------------------------------ #
+# replays the interleaving of two jobs: the group does not exist when it is
+# checked, and is created by the other job before it is initialized
+def test_writer_opens_groups_created_by_another_job():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = os.path.join(tmpdir, 'genome_UMI.zarr')
+        zarr_IO.zarr.open_group(store, mode = 'a').require_group('samples')
+        # the first check of each group misses it
+        contains_group = zarr_IO.zarr.hierarchy.contains_group
+        checked        = set()
+        def contains_group_late(store, path = None, **kwargs):
+            if not path in checked:
+                checked.add(path)
+                return(False)
+            return(contains_group(store, path, **kwargs))
+        try:
+            zarr_IO.zarr.hierarchy.contains_group = contains_group_late
+            writer = zarr_IO.ZarrSampleWriter(store, 'S0')
+        finally:
+            zarr_IO.zarr.hierarchy.contains_group = contains_group
+        writer.close()
+        assert list(zarr_IO.zarr.open_group(store, mode = 'r')['samples'].group_keys()) == ['S0']
+
+# ------------------------------------------------------------------ #
+def test_concurrent_writers_build_combined_matrix():
+    indices = list(range(5))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store  = os.path.join(tmpdir, 'genome_UMI.zarr')
+        ncells = write_samples_concurrently(store, indices)
+
+        # the manifest follows the given sample order, not the writing order
+        order    = [3, 0, 4, 1, 2]
+        manifest = zarr_IO.write_manifest(store, ['S' + str(index) for index in order])
+        assert [sample['ncells'] for sample in manifest['samples']] == [ncells[index] for index in order]
+        assert [sample['offset'] for sample in manifest['samples']] == list(numpy.cumsum([0] + [ncells[index] for index in order])[:-1])
+        assert manifest['gene_order'] == GENE_ORDER
+
+        matrix   = zarr_IO.ZarrMatrix(store)
+        expected = [get_sample(index) for index in order]
+        assert matrix.shape == (GENES, sum(ncells))
+        assert sorted(matrix.layers) == ['', 'Spliced', 'Unspliced']
+        for name in matrix.layers:
+            combined = numpy.concatenate([layers[name] for layers, cells in expected], axis = 1)
+            assert matrix.get_columns(0, matrix.shape[1], name).dtype == numpy.uint16
+            assert numpy.array_equal(matrix.get_columns(0, matrix.shape[1], name), combined)
+            # blocks which span several samples
+            for start in range(0, matrix.shape[1], 29):
+                assert numpy.array_equal(matrix.get_columns(start, start + 29, name), combined[:, start:start + 29])
+
+        assert list(matrix.get_col_attr('cell_id')) == [cell for layers, cells in expected for cell in cells]
+        assert list(matrix.get_row_attr('gene_id')) == ['gene' + str(i) for i in range(GENES)]
+
+# ------------------------------------------------------------------ #
+def test_manifest_rejects_incomplete_sample():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = os.path.join(tmpdir, 'genome_UMI.zarr')
+        write_sample(store, 0)
+        # a writer which did not finish leaves its sample incomplete
+        writer = zarr_IO.ZarrSampleWriter(store, 'S1', file_attrs = {'gene_order' : GENE_ORDER})
+        writer.add_columns({'' : numpy.zeros((GENES, 3), dtype = numpy.uint16)})
+        try:
+            zarr_IO.write_manifest(store, ['S0', 'S1'])
+            assert False, 'incomplete sample was accepted'
+        except ValueError as error:
+            assert 'S1' in str(error)
+
+# ------------------------------------------------------------------ #
+def test_manifest_rejects_different_gene_order():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = os.path.join(tmpdir, 'genome_UMI.zarr')
+        write_sample(store, 0)
+        with zarr_IO.ZarrSampleWriter(store, 'S1', file_attrs = {'gene_order' : 'other'}) as writer:
+            writer.add_columns({'' : numpy.zeros((GENES, 3), dtype = numpy.uint16)})
+        try:
+            zarr_IO.write_manifest(store, ['S0', 'S1'])
+            assert False, 'different gene order was accepted'
+        except ValueError as error:
+            assert 'gene order' in str(error)
+
+
+# ------------------------------------------------------------------ #
+if __name__ == '__main__':
+    test_writers_create_a_new_store_at_the_same_time()
+    test_writer_opens_groups_created_by_another_job()
+    test_concurrent_writers_build_combined_matrix()
+    test_manifest_rejects_incomplete_sample()
+    test_manifest_rejects_different_gene_order()
+    print('OK')